@@ -28,6 +28,8 @@ class PatchCoreBenchmarkContaminated(unittest.TestCase):
         self.args.batch_size = 1
         self.args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.args.img_input_size = (224, 224)
+        # the backbone features are extracted once and shared by every run with the same backbone
+        self.args.feature_cache_dir = "./feature_cache"
 
         self.transform = transforms.Compose([
             transforms.Resize(self.args.img_input_size),
@@ -62,7 +62,7 @@ def main_test_cfa(dataset_path: str, category: str, backbone: str, ad_layers: li
     cfa_model.eval()
 
     evaluator = Evaluator(test_dataloader, device)
-    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(cfa_model)
+    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(cfa_model).values()
 
     print("Evaluation performances:")
     print(f"""
@@ -25,7 +25,7 @@ def compress_features(dataset_path, categories, device, backbone, layer_idxs, co
         #load dataset
         train_dataset = MVTecDataset(TaskType.SEGMENTATION, dataset_path, category, "train")
         train_dataset.load_dataset()
-        dataset_images = train_dataset.samples.sample(len(train_dataset))
+        dataset_images = train_dataset.samples.to_dataframe().sample(len(train_dataset))
         print(f"Number of images to compress: {len(train_dataset)}")
     
         feature_extractor = CustomFeatureExtractor(backbone, layer_idxs, device = device)
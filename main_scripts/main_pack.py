@@ -0,0 +1,45 @@
+import os, sys
+import argparse
+
+script_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_path, ".."))
+
+from moviad.datasets.builder import DatasetConfig, DatasetFactory, DatasetType
+from moviad.datasets.packed.packed_dataset import pack_dataset
+from moviad.utilities.configurations import Split
+
+
+# Pack the train and test splits of some categories of a dataset at a given size, into
+# <output_dir>/<category>/<split>, the layout read by DatasetType.Packed with the
+# "packed": {"root_path": <output_dir>} entry of the dataset config.
+
+
+def main(args):
+    dataset_config = DatasetConfig(args.dataset_config)
+    dataset_factory = DatasetFactory(dataset_config)
+    dataset_type = DatasetType(args.dataset_type)
+    image_size = tuple(args.img_size)
+
+    for category in args.categories:
+        for split in (Split.TRAIN, Split.TEST):
+            # packed unnormalized, the ImageNet normalization of MVTec is applied when served
+            dataset = dataset_factory.build(dataset_type, split, category, image_size, norm=False)
+            dataset.load_dataset()
+            output_dir = os.path.join(args.output_dir, category, split.value)
+            pack_dataset(dataset, output_dir, norm=dataset_type == DatasetType.MVTec,
+                         batch_size=args.batch_size, num_workers=args.num_workers)
+            print(f"Packed {len(dataset)} {split.value} images of {category} in {output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_config", type=str, required=True, help="path of the json dataset config")
+    parser.add_argument("--dataset_type", type=str, required=True, help="mvtec, visa, realiad, miic")
+    parser.add_argument("--categories", type=str, nargs="+", required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--img_size", type=int, nargs=2, default=(224, 224), help="size of the images and masks")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=4, help="number of processes decoding the images")
+
+    args = parser.parse_args()
+    main(args)
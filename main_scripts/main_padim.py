@@ -55,7 +55,7 @@ def main_train_padim(
     evaluator = Evaluator(dataloader=test_dataloader, device=device)
     img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(
         padim
-    )
+    ).values()
 
     print("Evaluation performances:")
     print(
@@ -99,7 +99,7 @@ def test_padim(
     evaluator = Evaluator(dataloader=test_dataloader, device=device)
     img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(
         padim
-    )
+    ).values()
 
     print("Evaluation performances:")
     print(
@@ -221,7 +221,7 @@ def main(args):
 
                 # evaluate the model
                 evaluator = Evaluator(dataloader=test_dataloader, device=device)
-                scores = evaluator.evaluate(padim)
+                scores = evaluator.evaluate(padim).values()
 
                 if results_dirpath is not None:
                     metrics_savefile = Path(
@@ -80,7 +80,7 @@ def test_patchcore(dataset_path: str, category: str, backbone: str, ad_layers: l
     patchcore.eval()
 
     evaluator = Evaluator(test_dataloader, device)
-    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(patchcore)
+    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(patchcore).values()
 
     print("Evaluation performances:")
     print(f"""
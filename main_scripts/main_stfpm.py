@@ -141,7 +141,7 @@ def main(args):
 
             # evaluate the model
             evaluator = Evaluator(dataloader=test_dataloader, device=device)
-            scores = evaluator.evaluate(model)
+            scores = evaluator.evaluate(model).values()
 
             # save the scores
             metrics_filename = os.path.join(
@@ -1,10 +1,12 @@
 import json
 import os
 from enum import Enum
+from typing import Optional
 
 from moviad.datasets.iad_dataset import IadDataset
 from moviad.datasets.miic.miic_dataset import MiicDataset, MiicDatasetConfig
 from moviad.datasets.mvtec.mvtec_dataset import MVTecDataset
+from moviad.datasets.packed.packed_dataset import PackedIadDataset
 from moviad.datasets.realiad.realiad_dataset import RealIadDataset
 from moviad.datasets.visa.visa_dataset import VisaDataset
 from moviad.utilities.configurations import TaskType, Split
@@ -23,6 +25,7 @@ class DatasetConfig:
         self.visa_csv_path = self.convert_path(self.config['datasets'].get('visa', {}).get('csv_path', ''))
         self.mvtec_root_path = self.convert_path(self.config['datasets'].get('mvtec', {}).get('root_path', ''))
         self.miic_train_root_path = self.convert_path(self.config['datasets'].get('miic', {}).get('training_root_path', ''))
+        self.packed_root_path = self.convert_path(self.config['datasets'].get('packed', {}).get('root_path', ''))
         self.image_size = image_size
 
     def load_config(self, config_file):
@@ -45,21 +48,34 @@ class DatasetType(Enum):
     RealIad = "realiad"
     Visa = "visa"
     Miic = "miic"
+    Packed = "packed"
 
 class DatasetFactory:
     def __init__(self, config: DatasetConfig):
         self.config = config
         self.image_size = (256, 256)
 
-    def build(self, dataset_type: DatasetType, split: Split, class_name: str = None, image_size=(256, 256)) -> IadDataset:
+    def build(self, dataset_type: DatasetType, split: Split, class_name: str = None, image_size=(256, 256),
+              norm: Optional[bool] = None, cache_images: bool = False, raw: bool = False) -> IadDataset:
+        """
+        Args:
+            norm (bool): normalize the images to the ImageNet mean and std, if the dataset supports it.
+                None for the default of the dataset.
+            cache_images (bool): look the decoded images up in the process-wide image cache,
+                ignored by the packed datasets, which do not decode them
+            raw (bool): return uint8 images and masks, to preprocess the batches with a BatchPreprocessor
+        """
         if dataset_type == DatasetType.MVTec:
             return MVTecDataset(
                 TaskType.SEGMENTATION,
                 self.config.mvtec_root_path,
                 class_name,
                 split,
+                norm=True if norm is None else norm,
                 img_size=image_size,
-                gt_mask_size=image_size
+                gt_mask_size=image_size,
+                cache_images=cache_images,
+                raw=raw
             )
         elif dataset_type == DatasetType.RealIad:
             return RealIadDataset(
@@ -69,7 +85,9 @@ class DatasetFactory:
                 task=TaskType.SEGMENTATION,
                 split=split,
                 image_size=image_size,
-                gt_mask_size=image_size
+                gt_mask_size=image_size,
+                cache_images=cache_images,
+                raw=raw
             )
         elif dataset_type == DatasetType.Visa:
             return VisaDataset(
@@ -78,7 +96,9 @@ class DatasetFactory:
                 split=split,
                 class_name=class_name,
                 image_size=image_size,
-                gt_mask_size=image_size
+                gt_mask_size=image_size,
+                cache_images=cache_images,
+                raw=raw
             )
         elif dataset_type == DatasetType.Miic:
             miic_dataset_config = MiicDatasetConfig(
@@ -90,8 +110,18 @@ class DatasetFactory:
                 split=split,
                 task_type=TaskType.CLASSIFICATION,
                 image_shape=image_size,
-                mask_shape=image_size
+                mask_shape=image_size,
+                cache_images=cache_images,
+                raw=raw
             )
             return MiicDataset(miic_dataset_config)
+        elif dataset_type == DatasetType.Packed:
+            # the images were resized when packed: image_size is ignored
+            return PackedIadDataset(
+                os.path.join(self.config.packed_root_path, class_name, split.value),
+                split,
+                norm=norm,
+                raw=raw
+            )
         else:
             raise ValueError(f"Unknown dataset type: {dataset_type}")
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+Process-wide cache of the decoded images of the IAD datasets.
+
+The datasets built with cache_images=True look their images up in one least recently used
+cache, bounded in bytes, before decoding them. The images are keyed by their path and by the
+size and normalization they were transformed to, so the train and test datasets of several
+models in the same process decode each file once per preprocessing.
+
+With shared_memory=True the cached tensors are moved to shared memory. The cache is pickled
+with the datasets that use it, so the DataLoader workers, even the spawned ones, map the
+images cached by the main process, e.g. preloaded, instead of copying them. The images the
+workers decode are only cached in their own process.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import torch
+
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+
+
+class DecodedImageCache:
+    """
+    Least recently used cache of decoded images, evicting by bytes.
+
+    Args:
+        max_bytes (int): capacity of the cache, the images larger than it are not cached
+        shared_memory (bool): move the cached tensors to shared memory
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES, shared_memory: bool = False):
+        self.max_bytes = max_bytes
+        self.shared_memory = shared_memory
+        self.entries: OrderedDict[Hashable, torch.Tensor] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        with self.lock:
+            image = self.entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key: Hashable, image: torch.Tensor) -> None:
+        size = image.element_size() * image.nelement()
+        if size > self.max_bytes:
+            return
+        if self.shared_memory:
+            image.share_memory_()
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.element_size() * previous.nelement()
+            self.entries[key] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.element_size() * evicted.nelement()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> str:
+        return (f"{len(self.entries)} images cached, {self.bytes / 1024 ** 2:.1f}/{self.max_bytes / 1024 ** 2:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+_image_cache: Optional[DecodedImageCache] = None
+
+
+def configure_image_cache(max_bytes: int = DEFAULT_CACHE_BYTES, shared_memory: bool = False) -> DecodedImageCache:
+    """Replace the process-wide cache, to be called before building the datasets that use it."""
+    global _image_cache
+    _image_cache = DecodedImageCache(max_bytes, shared_memory)
+    return _image_cache
+
+
+def image_cache() -> DecodedImageCache:
+    """The process-wide cache, created with the default capacity on first use."""
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = DecodedImageCache()
+    return _image_cache
@@ -0,0 +1,125 @@
+"""
+Lazy and parallel decoding of the images of the IAD datasets.
+
+The datasets index their samples from the file names and metadata only, without opening any
+image, and hand the paths of the images to a LazyImages sequence. An image is then decoded,
+and transformed, when it is accessed, unless the dataset preloads them: the images are then
+decoded once by a thread pool, since PIL and the torchvision transforms release the GIL for
+most of their work, and kept in memory. Given a DecodedImageCache, the decoded images are
+looked up in it, by path and cache key, before being decoded.
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional, Sequence
+
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from moviad.datasets.image_cache import DecodedImageCache
+
+
+def decoded_size(value) -> int:
+    """Size in bytes of a decoded image, a tensor or a PIL image."""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    return 0
+
+
+class LazyImages:
+    """
+    Images decoded on access, or preloaded in parallel.
+
+    Args:
+        paths (Sequence[str]): paths of the images, in the order of the dataset
+        decode (Callable): decodes and transforms the image at a path
+        num_workers (int): number of threads decoding the images when preloaded,
+            the ThreadPoolExecutor default if None
+        cache (DecodedImageCache): cache of the decoded images, shared with other datasets
+        cache_key (Hashable): what the decoded images depend on besides their path,
+            e.g. their size and normalization
+    """
+
+    def __init__(self, paths: Sequence[str], decode: Callable[[str], Any], num_workers: Optional[int] = None,
+                 cache: Optional[DecodedImageCache] = None, cache_key: Hashable = None):
+        self.paths = [str(path) for path in paths]
+        self.decode = decode
+        self.num_workers = num_workers
+        self.cache = cache
+        self.cache_key = cache_key
+        self.images: list = [None] * len(self.paths)
+        self.preloaded = False
+        self.decoded_images = 0
+        self.decoded_bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def load(self, index: int):
+        if self.cache is not None:
+            key = (self.paths[index], self.cache_key)
+            image = self.cache.get(key)
+            if image is None:
+                image = self.decode_counted(index)
+                if isinstance(image, torch.Tensor):
+                    self.cache.put(key, image)
+            return image
+        return self.decode_counted(index)
+
+    def decode_counted(self, index: int):
+        image = self.decode(self.paths[index])
+        with self.lock:
+            self.decoded_images += 1
+            self.decoded_bytes += decoded_size(image)
+        return image
+
+    def __getitem__(self, index: int):
+        image = self.images[index]
+        if image is None:
+            image = self.load(index)
+            if self.preloaded:
+                # an image added after the preload
+                self.images[index] = image
+        return image
+
+    def preload(self, desc: str = "Loading images") -> None:
+        """Decode all the images not yet in memory with a thread pool, and keep them."""
+        missing = [index for index, image in enumerate(self.images) if image is None]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            progress = tqdm(pool.map(self.load, missing), total=len(missing), desc=desc)
+            for index, image in zip(missing, progress):
+                self.images[index] = image
+                progress.set_postfix(decoded_mb=f"{self.decoded_bytes / 1024 ** 2:.1f}")
+        self.preloaded = True
+
+    def subset(self, indices: Sequence[int]) -> LazyImages:
+        """The images at indices, sharing the decoded ones."""
+        subset = LazyImages([self.paths[index] for index in indices], self.decode, self.num_workers,
+                            self.cache, self.cache_key)
+        subset.images = [self.images[index] for index in indices]
+        subset.preloaded = self.preloaded
+        return subset
+
+    def extend(self, other: LazyImages) -> None:
+        """Append the images of other, the ones it did not decode yet being decoded by this sequence."""
+        self.paths.extend(other.paths)
+        self.images.extend(other.images)
+
+    def __getstate__(self):
+        # the DataLoader workers may pickle the dataset
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stats(self) -> str:
+        return f"{self.decoded_images} images decoded, {self.decoded_bytes / 1024 ** 2:.1f} MB"
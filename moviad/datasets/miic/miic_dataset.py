@@ -11,6 +11,8 @@ from torchvision import transforms
 from torchvision.transforms import InterpolationMode
 
 from moviad.datasets.iad_dataset import IadDataset
+from moviad.datasets.image_cache import image_cache
+from moviad.datasets.image_loader import LazyImages
 from moviad.utilities.configurations import Split, TaskType, LabelName
 
 """
@@ -46,15 +48,23 @@ class IadDatasetConfig:
         split (Split): The data split (e.g., train, test).
         image_shape (tuple): The shape of the images.
         mask_shape (tuple): The shape of the masks.
+        preload_images (bool): Whether the images are decoded when the dataset is loaded.
+        preload_workers (int): The number of threads decoding the preloaded images.
+        cache_images (bool): Whether the decoded images go through the process-wide image cache.
+        raw (bool): Whether the images and masks are returned as uint8 tensors of their original shape.
     """
 
     def __init__(self, task_type: TaskType, split: Split, image_shape: (int, int), mask_shape: (int, int),
-                 preload_images: bool = False):
+                 preload_images: bool = False, preload_workers: Optional[int] = None, cache_images: bool = False,
+                 raw: bool = False):
         self.task_type = task_type
         self.split = split
         self.image_shape = image_shape
         self.mask_shape = mask_shape
         self.preload_images = preload_images
+        self.preload_workers = preload_workers
+        self.cache_images = cache_images
+        self.raw = raw
 
 
 class MiicDatasetConfig(IadDatasetConfig):
@@ -70,8 +80,10 @@ class MiicDatasetConfig(IadDatasetConfig):
 
     def __init__(self, dataset_path: Optional[Path] = None, task_type: Optional[TaskType] = None,
                  split: Optional[Split] = None, image_shape: Optional[tuple[int, int]] = (224,224),
-                 mask_shape: Optional[tuple[int, int]] = (224, 224), normalize:bool = False,  preload_images: bool = False):
-        super().__init__(task_type, split, image_shape, mask_shape, preload_images)
+                 mask_shape: Optional[tuple[int, int]] = (224, 224), normalize:bool = False,  preload_images: bool = False,
+                 preload_workers: Optional[int] = None, cache_images: bool = False, raw: bool = False):
+        super().__init__(task_type, split, image_shape, mask_shape, preload_images, preload_workers, cache_images,
+                         raw)
 
         self.norm = normalize
 
@@ -124,12 +136,15 @@ class MiicDataset(IadDataset):
         self.config = miic_dataset_config
 
         self.data = []
+        self.images: LazyImages = None
         self.split = miic_dataset_config.split
         self.task = miic_dataset_config.task_type
         self.preload_images = self.config.preload_images
         self.category = 'semiconductor'
 
-        if self.config.norm:
+        if self.config.raw:
+            self.transform_img = transforms.PILToTensor()
+        elif self.config.norm:
             self.transform_img = transforms.Compose([
                 transforms.ToTensor(),
                 transforms.Resize(self.config.image_shape, antialias=True),
@@ -143,7 +158,7 @@ class MiicDataset(IadDataset):
                 transforms.Resize(self.config.image_shape, antialias=True),
             ])
 
-        self.transform_mask = transforms.Compose([
+        self.transform_mask = transforms.PILToTensor() if self.config.raw else transforms.Compose([
             transforms.ToTensor(),
             transforms.Resize(
                 self.config.image_shape,
@@ -165,12 +180,7 @@ class MiicDataset(IadDataset):
 
     def __getitem__(self, idx):
         image_entry = self.data[idx]
-        if not self.preload_images:
-            with PIL.Image.open(image_entry.image_path) as img:
-                image_entry.image = img.convert("RGB")
-
-        image = image_entry.image
-        image = self.transform_img(image)
+        image = self.images[idx]
 
         if self.split == Split.TRAIN:
             return image
@@ -179,10 +189,11 @@ class MiicDataset(IadDataset):
         mask_path = image_entry.mask_path
         path = str(image_entry.image_path)
         if mask_path is not None:
-            if not self.preload_images:
-                with PIL.Image.open(mask_path) as mask_img:
-                    mask = mask_img.convert("L")
+            with PIL.Image.open(mask_path) as mask_img:
+                mask = mask_img.convert("L")
             mask = self.transform_mask(mask)
+        elif self.config.raw:
+            mask = torch.zeros((1, *image.shape[-2:]), dtype=torch.uint8)
         else:
             mask = torch.zeros((1, *self.config.mask_shape), dtype=torch.float32)
 
@@ -198,6 +209,16 @@ class MiicDataset(IadDataset):
                 self.config.test_abnormal_mask_root_path,
                 self.config.test_abnormal_bounding_box_root_path
             )
+        self.images = LazyImages([entry.image_path for entry in self.data], self.load_image,
+                                 self.config.preload_workers,
+                                 cache=image_cache() if self.config.cache_images else None,
+                                 cache_key="raw" if self.config.raw else (tuple(self.config.image_shape), self.config.norm))
+        if self.preload_images:
+            self.images.preload(desc=f"Loading {self.category} {Split(self.split).value}")
+
+    def load_image(self, path: str):
+        with PIL.Image.open(path) as img:
+            return self.transform_img(img.convert("RGB"))
 
     def __load_training_data(self, normal_images_root_path: Path):
 
@@ -209,11 +230,7 @@ class MiicDataset(IadDataset):
             raise FileNotFoundError(f"No images found in {normal_images_root_path}")
 
         for image in image_file_list:
-            image_entry = MiicDatasetEntry(image)
-            if self.preload_images:
-                with PIL.Image.open(image_entry.image_path) as img:
-                    image_entry.image = img.convert("RGB")
-            self.data.append(image_entry)
+            self.data.append(MiicDatasetEntry(image))
 
     def __load_test_data(self, normal_images_root_path: Path,
                          abnormal_image_root_path: Path,
@@ -238,21 +255,11 @@ class MiicDataset(IadDataset):
             raise FileNotFoundError(f"No images found in {mask_root_path}")
 
         for image in normal_image_file_list:
-            image_entry = MiicDatasetEntry(image)
-            if self.preload_images:
-                with PIL.Image.open(image_entry.image_path) as img:
-                    image_entry.image = img.convert("RGB")
-            self.data.append(image_entry)
+            self.data.append(MiicDatasetEntry(image))
 
         for item in zip(abnormal_image_file_list, mask_file_list, bounding_box_file_list):
             abnormal_image_path, mask_path, bounding_box_path = item
-            image_entry = MiicDatasetEntry(abnormal_image_path, mask_path, bounding_box_path)
-            if self.preload_images:
-                with PIL.Image.open(abnormal_image_path) as img:
-                    image_entry.image = img.convert("RGB")
-                with PIL.Image.open(mask_path) as mask:
-                    image_entry.mask = mask.convert("L")
-            self.data.append(image_entry)
+            self.data.append(MiicDatasetEntry(abnormal_image_path, mask_path, bounding_box_path))
 
     def contaminate(self, source: 'IadDataset', ratio: float, seed: int = 42) -> int:
         raise NotImplementedError("Dataset contamination not yet supported on this dataset.")
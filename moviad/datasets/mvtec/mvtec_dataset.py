@@ -17,6 +17,9 @@ from torch.utils.data import Dataset
 
 from moviad.backbones.micronet.utils import compute_mask_contamination
 from moviad.datasets.iad_dataset import IadDataset
+from moviad.datasets.image_cache import image_cache
+from moviad.datasets.image_loader import LazyImages
+from moviad.datasets.sample_index import SampleIndex
 from moviad.datasets.exceptions.exceptions import DatasetTooSmallToContaminateException
 from moviad.utilities.configurations import TaskType, Split, LabelName
 
@@ -84,6 +87,15 @@ class MVTecDataset(IadDataset):
             Defaults to ``None``.
         split (str | Split | None): Split of the dataset, usually Split.TRAIN or Split.TEST
             Defaults to ``None``
+        preload_imgs (bool): Decode all the images when the dataset is loaded, instead of on access.
+            Defaults to ``True``
+        preload_workers (int, optional): Number of threads decoding the preloaded images.
+            Defaults to ``None``, the ThreadPoolExecutor default
+        cache_images (bool): Look the decoded images up in the process-wide image cache.
+            Defaults to ``False``
+        raw (bool): Return the images and masks as uint8 tensors of their original size,
+            to preprocess the batches with a BatchPreprocessor. norm and the sizes are then ignored.
+            Defaults to ``False``
 
     """
 
@@ -97,6 +109,9 @@ class MVTecDataset(IadDataset):
             img_size=(224, 224),
             gt_mask_size: Optional[tuple] = None,
             preload_imgs: bool = True,
+            preload_workers: Optional[int] = None,
+            cache_images: bool = False,
+            raw: bool = False,
     ) -> None:
         super(MVTecDataset)
 
@@ -108,10 +123,17 @@ class MVTecDataset(IadDataset):
         self.root_category = Path(root) / Path(category)
         self.category = category
         self.split = split
-        self.samples: pd.DataFrame = None
+        self.samples: SampleIndex = None
+        self.data: LazyImages = None
         self.preload_imgs = preload_imgs
-
-        if norm:
+        self.preload_workers = preload_workers
+        self.cache_images = cache_images
+        self.norm = norm
+        self.raw = raw
+
+        if raw:
+            t_list = [transforms.PILToTensor()]
+        elif norm:
             t_list = [
                 transforms.ToTensor(),
                 transforms.Resize(img_size, antialias=True),
@@ -128,7 +150,7 @@ class MVTecDataset(IadDataset):
         self.transform_image = transforms.Compose(t_list)
 
         self.transform_mask = transforms.Compose(
-            [
+            [transforms.PILToTensor()] if raw else [
                 transforms.ToTensor(),
                 transforms.Resize(
                     gt_mask_size,
@@ -143,15 +165,15 @@ class MVTecDataset(IadDataset):
             raise ValueError("Dataset is not loaded")
 
         contaminated_samples = self.samples[self.samples["label_index"] == LabelName.ABNORMAL.value]
-        if contaminated_samples.empty:
+        if not len(contaminated_samples):
             return 0
 
         total_contamination_ratio = 0
-        for index, row in contaminated_samples.iterrows():
-            if not Path(row["mask_path"]).exists():
+        for mask_path in contaminated_samples["mask_path"]:
+            if not Path(mask_path).exists():
                 raise ValueError("Mask file does not exist")
 
-            mask = Image.open(row["mask_path"]).convert("L")
+            mask = Image.open(mask_path).convert("L")
             mask = self.transform_mask(mask)
             total_contamination_ratio += compute_mask_contamination(mask)
         return total_contamination_ratio / len(contaminated_samples)
@@ -160,7 +182,7 @@ class MVTecDataset(IadDataset):
         return self.samples is not None
 
     def contains(self, item) -> bool:
-        return self.samples['image_path'].eq(item['image_path']).any()
+        return self.samples.contains(item['image_path'])
 
     def load_dataset(self):
         if self.is_loaded():
@@ -198,6 +220,8 @@ class MVTecDataset(IadDataset):
         samples.loc[(samples.label == "good"), "label_index"] = LabelName.NORMAL
         samples.loc[(samples.label != "good"), "label_index"] = LabelName.ABNORMAL
         samples.label_index = samples.label_index.astype(int)
+        # the training images have no mask, the column is kept for the contamination
+        samples["mask_path"] = ""
 
         if self.split == Split.TEST:
 
@@ -210,7 +234,6 @@ class MVTecDataset(IadDataset):
             )
 
             # assign mask paths to anomalous test images
-            samples["mask_path"] = ""
             samples.loc[
                 (samples.split == "test") & (samples.label_index == LabelName.ABNORMAL),
                 "mask_path",
@@ -229,14 +252,17 @@ class MVTecDataset(IadDataset):
                 anomalous images in the dataset (e.g. image: '000.png', mask: '000.png' or '000_mask.png')."""
                 raise Exception(msg)
 
-        self.samples = samples[samples.split == self.split].reset_index(drop=True)
+        samples = samples[samples.split == self.split]
+        self.samples = SampleIndex.from_dataframe(samples[["image_path", "label", "label_index", "mask_path"]])
+        self.data = LazyImages(self.samples["image_path"], self.load_image, self.preload_workers,
+                               cache=image_cache() if self.cache_images else None,
+                               cache_key="raw" if self.raw else (tuple(self.img_size), self.norm))
         if self.preload_imgs:
-            self.data = [
-                self.transform_image(
-                    Image.open(self.samples.iloc[index].image_path).convert("RGB")
-                )
-                for index in range(len(self.samples))
-            ]
+            self.data.preload(desc=f"Loading {self.category} {Split(self.split).value}")
+
+    def load_image(self, path: str) -> torch.Tensor:
+        with Image.open(path) as image:
+            return self.transform_image(image.convert("RGB"))
 
     def __len__(self) -> int:
         return len(self.samples)
@@ -251,7 +277,7 @@ class MVTecDataset(IadDataset):
 
         torch.manual_seed(seed)
         contamination_set_size = int(math.floor(len(self.samples) * ratio))
-        contaminated_entries_indices = source.samples[source.samples["label_index"] == LabelName.ABNORMAL.value].index
+        contaminated_entries_indices = np.flatnonzero(source.samples["label_index"] == LabelName.ABNORMAL.value)
         if len(contaminated_entries_indices) < contamination_set_size:
             raise DatasetTooSmallToContaminateException(
                 f"Source dataset does not contain enough abnormal entries to contaminate the destination dataset. "
@@ -261,23 +287,13 @@ class MVTecDataset(IadDataset):
 
         contaminated_entries_indices = np.random.choice(contaminated_entries_indices, contamination_set_size,
                                                         replace=False)
-        for index in contaminated_entries_indices:
-            entry_metadata = source.samples.iloc[index]
-            if source.preload_imgs:
-                entry = source.data[index]
-                self.data.append(entry)
-            else:
-                entry = self.transform_image(
-                    Image.open(self.samples.iloc[index].image_path).convert("RGB")
-                )
-                self.data.append(entry)
-                source.data = [e for e in source.data if hash(e) != hash(entry)]
+        # the decoded images move with their entries, the others are decoded on access
+        self.samples = self.samples.concat(source.samples[contaminated_entries_indices])
+        self.data.extend(source.data.subset(contaminated_entries_indices))
 
-            self.samples = pd.concat([self.samples, pd.DataFrame([entry_metadata])], ignore_index=True)
-            index_label = source.samples.index[index]
-
-        source.samples = source.samples.drop(contaminated_entries_indices).reset_index(drop=True)
-        source.data = [source.data[i] for i in range(len(source.data)) if i not in contaminated_entries_indices]
+        kept_indices = np.setdiff1d(np.arange(len(source.samples)), contaminated_entries_indices)
+        source.samples = source.samples[kept_indices]
+        source.data = source.data.subset(kept_indices)
         return contamination_set_size
 
     def __getitem__(self, index: int):
@@ -286,31 +302,28 @@ class MVTecDataset(IadDataset):
             index (int) : index of the element to be returned
 
         Returns:
-            image (Tensor) : tensor of shape (C,H,W) with values in [0,1]
+            image (Tensor) : tensor of shape (C,H,W) with values in [0,1], or uint8 if raw
             label (int) : label of the image
-            mask (Tensor) : tensor of shape (1,H,W) with values in [0,1]
+            mask (Tensor) : tensor of shape (1,H,W) with values in [0,1], or uint8 if raw
             path (str) : path of the input image
         """
 
-        # open the image and get the tensor
-        if self.preload_imgs:
-            image = self.data[index]
-        else:
-            image = self.transform_image(
-                Image.open(self.samples.iloc[index].image_path).convert("RGB")
-            )
+        # the preloaded image, or decoded from the file
+        image = self.data[index]
 
         if self.split == Split.TRAIN:
             return image
         else:
             # return also the label, the mask and the path
-            label = self.samples.iloc[index].label_index
-            path = self.samples.iloc[index].image_path
+            label = int(self.samples["label_index"][index])
+            path = self.samples["image_path"][index]
             if label == LabelName.ABNORMAL:
-                mask = Image.open(self.samples.iloc[index].mask_path).convert("L")
+                mask = Image.open(self.samples["mask_path"][index]).convert("L")
                 mask = self.transform_mask(mask)
 
+            elif self.raw:
+                mask = torch.zeros(1, *image.shape[-2:], dtype=torch.uint8)
             else:
                 mask = torch.zeros(1, *self.gt_mask_size)
 
-            return image, label, mask.int(), path
+            return image, label, mask if self.raw else mask.int(), path
@@ -0,0 +1,218 @@
+"""
+Pre-decoded, memory-mapped format of the splits of the IAD datasets.
+
+A split is packed once, at the image and mask sizes of the model, into a directory holding:
+    images.u8    the resized images, a contiguous (N, 3, H, W) uint8 array
+    masks.bits   the ground truth masks, one row of np.packbits per image, N x ceil(h * w / 8) bytes
+    index.json   the metadata: sizes, labels and paths of the images
+
+The PackedIadDataset serves the samples straight from the page cache through np.memmap, so
+the multi-epoch trainers neither decode nor resize the images again, and the full dataset
+never needs to fit in memory.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from moviad.backbones.micronet.utils import compute_mask_contamination
+from moviad.datasets.iad_dataset import IadDataset
+from moviad.datasets.sample_index import SampleIndex
+from moviad.utilities.configurations import Split, LabelName
+
+PACKED_FORMAT_VERSION = 1
+IMAGES_FILE = "images.u8"
+MASKS_FILE = "masks.bits"
+INDEX_FILE = "index.json"
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def pack_dataset(dataset: IadDataset, output_dir: str, norm: bool = False, batch_size: int = 32,
+                 num_workers: int = 0) -> str:
+    """
+    Pack a loaded dataset split into output_dir.
+
+    The images are quantized to uint8, so the dataset must yield images in [0, 1]: build it
+    without the ImageNet normalization, which the PackedIadDataset applies on the fly if norm.
+    The mask pixels are anomalous where > 0.
+
+    Args:
+        dataset (IadDataset): the loaded split, yielding an image (train) or (image, label, mask, path)
+        output_dir (str): directory of the packed split, created if needed
+        norm (bool): whether the PackedIadDataset normalizes the images by default
+        batch_size (int): number of samples decoded per batch
+        num_workers (int): number of DataLoader processes decoding the samples
+
+    Returns:
+        the path of the metadata index
+    """
+    if not len(dataset):
+        raise ValueError("Cannot pack an empty dataset")
+    os.makedirs(output_dir, exist_ok=True)
+
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    images, masks = None, None
+    labels, paths = [], []
+    mask_size = None
+    start = 0
+    for batch in tqdm(dataloader, desc="Packing"):
+        if isinstance(batch, torch.Tensor):
+            batch_images, batch_labels, batch_masks, batch_paths = batch, None, None, None
+        else:
+            batch_images, batch_labels, batch_masks, batch_paths = batch
+
+        if batch_images.min() < 0 or batch_images.max() > 1:
+            raise ValueError("The images must be in [0, 1]: pack the dataset without normalization")
+
+        if images is None:
+            images = np.memmap(os.path.join(output_dir, IMAGES_FILE), dtype=np.uint8, mode="w+",
+                               shape=(len(dataset), *batch_images.shape[1:]))
+            mask_size = tuple(batch_images.shape[-2:] if batch_masks is None else batch_masks.shape[-2:])
+            masks = np.memmap(os.path.join(output_dir, MASKS_FILE), dtype=np.uint8, mode="w+",
+                              shape=(len(dataset), (mask_size[0] * mask_size[1] + 7) // 8))
+
+        stop = start + len(batch_images)
+        images[start:stop] = batch_images.mul(255).round_().to(torch.uint8).numpy()
+        if batch_masks is None:
+            # the training splits only hold normal images
+            masks[start:stop] = 0
+            labels.extend([LabelName.NORMAL.value] * len(batch_images))
+            paths.extend([None] * len(batch_images))
+        else:
+            binary = batch_masks.reshape(len(batch_masks), -1).numpy() > 0
+            masks[start:stop] = np.packbits(binary, axis=1)
+            labels.extend(int(label) for label in batch_labels)
+            paths.extend(str(path) for path in batch_paths)
+        start = stop
+
+    images.flush()
+    masks.flush()
+    index = {
+        "format_version": PACKED_FORMAT_VERSION,
+        "category": getattr(dataset, "category", None),
+        "split": Split(dataset.split).value,
+        "num_samples": len(dataset),
+        "img_size": list(images.shape[-2:]),
+        "gt_mask_size": list(mask_size),
+        "norm": norm,
+        "labels": labels,
+        "paths": paths,
+    }
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    with open(index_path, "w") as file:
+        json.dump(index, file)
+    return index_path
+
+
+class PackedIadDataset(IadDataset):
+    """
+    Dataset split packed by pack_dataset.
+
+    Args:
+        root (str): directory of the packed split
+        split (Split): split of the dataset, checked against the packed one
+        norm (bool): normalize the images to the ImageNet mean and std, as packed if None
+        raw (bool): return the packed uint8 images and masks, to preprocess the batches
+            with a BatchPreprocessor, norm being then ignored
+    """
+
+    def __init__(self, root: str, split: Split, norm: Optional[bool] = None, raw: bool = False):
+        super().__init__(split, root, 0.0)
+        self.root = root
+        self.norm = norm
+        self.raw = raw
+        self.category: Optional[str] = None
+        self.img_size = None
+        self.gt_mask_size = None
+        self.images: Optional[np.memmap] = None
+        self.masks: Optional[np.memmap] = None
+        self.samples: Optional[SampleIndex] = None
+        self.mean = torch.tensor(IMAGENET_MEAN).view(3, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD).view(3, 1, 1)
+
+    def is_loaded(self) -> bool:
+        return self.images is not None
+
+    def load_dataset(self):
+        if self.is_loaded():
+            print("Dataset already loaded")
+            return
+
+        with open(os.path.join(self.root, INDEX_FILE)) as file:
+            index = json.load(file)
+        if index["format_version"] != PACKED_FORMAT_VERSION:
+            raise ValueError(f"Unsupported packed format version {index['format_version']}")
+        if index["split"] != Split(self.split).value:
+            raise ValueError(f"The dataset in {self.root} is a {index['split']} split, not {Split(self.split).value}")
+
+        num_samples = index["num_samples"]
+        self.category = index["category"]
+        self.img_size = tuple(index["img_size"])
+        self.gt_mask_size = tuple(index["gt_mask_size"])
+        self.samples = SampleIndex({
+            "image_path": np.asarray(index["paths"], dtype=object),
+            "label_index": np.asarray(index["labels"], dtype=np.int64),
+        })
+        if self.norm is None:
+            self.norm = index["norm"]
+        # copy-on-write maps: writable for torch.from_numpy, but never written back
+        self.images = np.memmap(os.path.join(self.root, IMAGES_FILE), dtype=np.uint8, mode="c",
+                                shape=(num_samples, 3, *self.img_size))
+        self.masks = np.memmap(os.path.join(self.root, MASKS_FILE), dtype=np.uint8, mode="c",
+                               shape=(num_samples, (self.gt_mask_size[0] * self.gt_mask_size[1] + 7) // 8))
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def contains(self, entry) -> bool:
+        return self.samples.contains(entry["image_path"])
+
+    def image(self, index: int) -> torch.Tensor:
+        if self.raw:
+            return torch.from_numpy(self.images[index])
+        image = torch.from_numpy(self.images[index]).float().div_(255)
+        if self.norm:
+            image = (image - self.mean) / self.std
+        return image
+
+    def mask(self, index: int) -> torch.Tensor:
+        bits = np.unpackbits(self.masks[index], count=self.gt_mask_size[0] * self.gt_mask_size[1])
+        mask = torch.from_numpy(bits).view(1, *self.gt_mask_size)
+        return mask if self.raw else mask.float()
+
+    def compute_contamination_ratio(self) -> float:
+        if not self.is_loaded():
+            raise ValueError("Dataset is not loaded")
+
+        abnormal = np.flatnonzero(self.samples["label_index"] == LabelName.ABNORMAL.value)
+        if not len(abnormal):
+            return 0
+        return sum(compute_mask_contamination(self.mask(index)) for index in abnormal) / len(abnormal)
+
+    def contaminate(self, source: IadDataset, ratio: float, seed: int = 42) -> int:
+        raise NotImplementedError("Dataset contamination not yet supported on packed datasets.")
+
+    def __getitem__(self, index: int):
+        """
+        Args:
+            index (int) : index of the element to be returned
+
+        Returns:
+            image (Tensor) : tensor of shape (C,H,W) with values in [0,1], or normalized, or uint8 if raw
+            label (int) : label of the image
+            mask (Tensor) : tensor of shape (1,H,W) with values in {0,1}, uint8 if raw
+            path (str) : path of the input image
+        """
+        image = self.image(index)
+        if self.split == Split.TRAIN:
+            return image
+        return image, int(self.samples["label_index"][index]), self.mask(index), self.samples["image_path"][index]
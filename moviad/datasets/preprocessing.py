@@ -0,0 +1,133 @@
+"""
+Batched preprocessing of the raw samples of the IAD datasets, on the target device.
+
+The datasets built with raw=True skip their per-sample transforms: they return the decoded
+images as uint8 (C, H, W) tensors at their original size, and the masks as uint8 (1, H, W)
+tensors, anomalous where > 0. After collation, a BatchPreprocessor moves a whole batch to
+the device, where it resizes the images, normalizes them to the ImageNet mean and std, and
+resizes and binarizes the masks. The DataLoader workers then only decode the images.
+
+The images of a category usually share their size, so the default collation stacks them.
+Otherwise collate them with raw_collate, which keeps the images of different sizes in lists.
+"""
+
+from __future__ import annotations
+
+from typing import Optional, Sequence, Union
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+Images = Union[torch.Tensor, Sequence[torch.Tensor]]
+
+
+def stack_or_list(tensors: Sequence[torch.Tensor]) -> Images:
+    if all(tensor.shape == tensors[0].shape for tensor in tensors):
+        return torch.stack(tensors)
+    return list(tensors)
+
+
+def raw_collate(batch: list):
+    """Collate raw samples, the images and masks of different sizes being kept in lists."""
+    if isinstance(batch[0], torch.Tensor):
+        return stack_or_list(batch)
+    images, labels, masks, paths = zip(*batch)
+    return stack_or_list(images), torch.as_tensor(labels), stack_or_list(masks), list(paths)
+
+
+class BatchPreprocessor:
+    """
+    Resize and normalize the images, resize and binarize the masks of a batch on a device.
+
+    Args:
+        img_size (tuple[int, int]): size of the images
+        gt_mask_size (tuple[int, int]): size of the masks, img_size if None
+        normalize (bool): normalize the images to the ImageNet mean and std
+        device (torch.device): device the batches are moved to and processed on
+    """
+
+    def __init__(
+        self,
+        img_size: tuple[int, int],
+        gt_mask_size: Optional[tuple[int, int]] = None,
+        normalize: bool = True,
+        device: Union[str, torch.device] = "cpu",
+    ):
+        self.img_size = tuple(img_size)
+        self.gt_mask_size = self.img_size if gt_mask_size is None else tuple(gt_mask_size)
+        self.normalize = normalize
+        self.device = torch.device(device)
+        self.mean = torch.tensor(IMAGENET_MEAN, device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD, device=self.device).view(1, 3, 1, 1)
+
+    def resize(self, batch: Images, size: tuple[int, int], mode: str) -> torch.Tensor:
+        """Move a batch to the device as float, scaled to [0, 1] if uint8 images, and resize it."""
+        if not isinstance(batch, torch.Tensor):
+            return torch.cat([self.resize(tensor.unsqueeze(0), size, mode) for tensor in batch])
+
+        is_uint8 = batch.dtype == torch.uint8
+        batch = batch.to(self.device, non_blocking=True).float()
+        if is_uint8 and mode != "nearest":
+            batch = batch.div_(255)
+        if tuple(batch.shape[-2:]) == size:
+            return batch
+        if mode == "nearest":
+            return F.interpolate(batch, size=size, mode="nearest")
+        return F.interpolate(batch, size=size, mode=mode, align_corners=False, antialias=True)
+
+    def images(self, images: Images) -> torch.Tensor:
+        """(B, 3, H, W) uint8 images, or a list of them, to float images of img_size."""
+        images = self.resize(images, self.img_size, "bilinear")
+        if self.normalize:
+            images = (images - self.mean) / self.std
+        return images
+
+    def masks(self, masks: Images) -> torch.Tensor:
+        """(B, 1, H, W) masks, or a list of them, to {0, 1} float masks of gt_mask_size."""
+        return (self.resize(masks, self.gt_mask_size, "nearest") > 0).float()
+
+    def __call__(self, batch):
+        """Preprocess a training batch of images, or a test batch of (images, labels, masks, paths)."""
+        is_test_batch = (
+            not isinstance(batch, torch.Tensor) and len(batch) == 4
+            and isinstance(batch[3], (list, tuple)) and isinstance(batch[3][0], str)
+        )
+        if not is_test_batch:
+            return self.images(batch)
+        images, labels, masks, paths = batch
+        return self.images(images), labels, self.masks(masks), paths
+
+
+class PreprocessedDataLoader:
+    """
+    Iterate over the batches of a DataLoader of raw samples, preprocessed on the device.
+    Exposes the dataset and the length of the DataLoader, to be used in its place by the
+    trainers and the Evaluator.
+
+    Args:
+        dataloader (DataLoader): dataloader of a dataset built with raw=True
+        preprocessor (BatchPreprocessor): the preprocessing applied to every batch
+    """
+
+    def __init__(self, dataloader: DataLoader, preprocessor: BatchPreprocessor):
+        self.dataloader = dataloader
+        self.preprocessor = preprocessor
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    @property
+    def batch_size(self):
+        return self.dataloader.batch_size
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            yield self.preprocessor(batch)
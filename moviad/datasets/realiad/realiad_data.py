@@ -29,11 +29,24 @@ class ImageData:
 
 @dataclass
 class DatasetImageEntry:
-    image: Image
-    mask: Image
+    """Entry of the index of the dataset, the image and mask being decoded on access."""
+    image_path: Path
+    mask_path: Optional[Path]
     category: RealIadClassEnum
     anomaly_class: RealIadAnomalyClass
 
+    @property
+    def image(self) -> Image:
+        with Image.open(self.image_path) as image:
+            return image.convert("RGB")
+
+    @property
+    def mask(self) -> Optional[Image]:
+        if self.mask_path is None:
+            return None
+        with Image.open(self.mask_path) as mask:
+            return mask.convert("L")
+
 
 @dataclass
 class RealIadData:
@@ -76,34 +89,38 @@ class RealIadData:
                            class_name=self.class_name)
 
     def load_images(self, img_root_dir: str) -> None:
+        """
+        Index the images and masks, without decoding them. The entries whose files are
+        missing are dropped from the data, which stays aligned with the images.
+        """
         self.images = []
-        image = None
-        mask = None
+        found_data = []
         images_not_found = []
         masks_not_found = []
 
+        class_image_root_path = os.path.join(img_root_dir, self.class_name)
         for image_entry in self.data:
-            class_image_root_path = os.path.join(img_root_dir, self.class_name)
             img_path = Path(os.path.join(class_image_root_path, image_entry.image_path))
             if not os.path.exists(img_path):
                 images_not_found.append(img_path)
                 continue
-            image = Image.open(img_path).convert("RGB")
 
+            image_mask_path = None
             if image_entry.mask_path is not None:
                 image_mask_path = Path(os.path.join(class_image_root_path, image_entry.mask_path))
                 if not os.path.exists(image_mask_path):
                     masks_not_found.append(image_mask_path)
                     continue
-                mask = Image.open(image_mask_path).convert("L")
 
-            self.images.append(DatasetImageEntry(image=image,
-                                                 mask=mask,
+            found_data.append(image_entry)
+            self.images.append(DatasetImageEntry(image_path=img_path,
+                                                 mask_path=image_mask_path,
                                                  category=image_entry.category,
                                                  anomaly_class=image_entry.anomaly_class))
 
         if len(images_not_found) == self.data.__len__():
             raise ValueError("No images found in the dataset. Check root directory or image paths.")
+        self.data = found_data
 
     def __len__(self) -> int:
         return len(self.images)
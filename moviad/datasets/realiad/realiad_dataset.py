@@ -3,10 +3,13 @@ import numpy as np
 import torch
 from typing import List, Optional
 import os
+from PIL import Image
 from torchvision import transforms
 from torchvision.transforms import InterpolationMode
 
 from moviad.datasets.iad_dataset import IadDataset
+from moviad.datasets.image_cache import image_cache
+from moviad.datasets.image_loader import LazyImages
 from moviad.datasets.exceptions.exceptions import DatasetTooSmallToContaminateException
 from moviad.datasets.realiad.realiad_data import RealIadData
 from moviad.datasets.realiad.realiad_dataset_configurations import RealIadClassEnum, RealIadAnomalyClass
@@ -17,7 +20,11 @@ class RealIadDataset(IadDataset):
     def __init__(self, class_name: str, img_root_dir: str, json_root_path: str, task: TaskType, split: Split,
                  gt_mask_size: Optional[tuple] = None,
                  transform=None,
-                 image_size=(224, 224)) -> None:
+                 image_size=(224, 224),
+                 preload_images: bool = False,
+                 preload_workers: Optional[int] = None,
+                 cache_images: bool = False,
+                 raw: bool = False) -> None:
         super().__init__()
         if img_root_dir is None:
             raise ValueError("img_dir should not be None")
@@ -30,19 +37,33 @@ class RealIadDataset(IadDataset):
         self.transform = transform
         self.category = class_name
         self.data: RealIadData = None
+        self.images: LazyImages = None
+        self.preload_images = preload_images
+        self.preload_workers = preload_workers
+        self.cache_images = cache_images
+        self.image_size = image_size
+        self.raw = raw
         self.task = task
         self.split = split
         self.gt_mask_size = gt_mask_size
 
-        if transform is None:
+        # a custom transform also applies to the masks
+        self.mask_transform = transform
+        if raw:
+            self.transform = transforms.PILToTensor()
+            self.mask_transform = transforms.PILToTensor()
+        elif transform is None:
             self.transform = transforms.Compose([
                 transforms.Resize(image_size),
                 transforms.PILToTensor(),
+                transforms.ConvertImageDtype(torch.float32),
+            ])
+            self.mask_transform = transforms.Compose([
                 transforms.Resize(
-                    image_size,
-                    antialias=True,
+                    image_size if gt_mask_size is None else gt_mask_size,
                     interpolation=InterpolationMode.NEAREST,
                 ),
+                transforms.PILToTensor(),
                 transforms.ConvertImageDtype(torch.float32),
             ])
 
@@ -62,23 +83,23 @@ class RealIadDataset(IadDataset):
 
         torch.manual_seed(seed)
         contamination_set_size = int(math.floor(len(self.data) * ratio))
-        contaminated_data_entries = [entry for entry in source.data.data if
-                                     entry.anomaly_class != RealIadAnomalyClass.OK]
-        contaminated_image_entries = [image for image in source.data.data if
-                                      image.anomaly_class != RealIadAnomalyClass.OK]
-        if len(contaminated_data_entries) < contamination_set_size:
+        contaminated_indices = [index for index, entry in enumerate(source.data.data) if
+                                entry.anomaly_class != RealIadAnomalyClass.OK]
+        if len(contaminated_indices) < contamination_set_size:
             raise DatasetTooSmallToContaminateException(
                 f"Source dataset does not have enough contaminated entries to contaminate the dataset. "
-                f"Found {len(contaminated_data_entries)} entries, but needed {contamination_set_size} entries")
-
-        contaminated_data_entries = np.random.choice(contaminated_data_entries, contamination_set_size,
-                                                     replace=False).tolist()
-        contaminated_image_entries = np.random.choice(contaminated_image_entries, contamination_set_size,
-                                                      replace=False).tolist()
-        self.data.data.extend(contaminated_data_entries)
-        self.data.images.extend(contaminated_image_entries)
-        source.data.data = [entry for entry in source.data.data if entry not in contaminated_data_entries]
-        source.data.data = [image for image in source.data.data if image not in contaminated_image_entries]
+                f"Found {len(contaminated_indices)} entries, but needed {contamination_set_size} entries")
+
+        # the data, the image entries and the decoded images move together
+        contaminated_indices = np.random.choice(contaminated_indices, contamination_set_size, replace=False)
+        self.data.data.extend(source.data.data[index] for index in contaminated_indices)
+        self.data.images.extend(source.data.images[index] for index in contaminated_indices)
+        self.images.extend(source.images.subset(contaminated_indices))
+
+        kept_indices = np.setdiff1d(np.arange(len(source.data)), contaminated_indices)
+        source.data.data = [source.data.data[index] for index in kept_indices]
+        source.data.images = [source.data.images[index] for index in kept_indices]
+        source.images = source.images.subset(kept_indices)
         return contamination_set_size
 
     def partition(self, dataset: IadDataset, ratio: float) -> ('RealIadDataset', 'RealIadDataset'):
@@ -103,19 +124,19 @@ class RealIadDataset(IadDataset):
 
     def __getitem__(self, item):
         image_data, image_entry = self.data.__getitem__(item)
+        image = self.images[item]
 
         if self.split == Split.TRAIN:
-            if self.transform:
-                image_entry = self.transform(image_entry.image)
-            return image_entry
+            return image
 
         if self.split == Split.TEST:
-            image = self.transform(image_entry.image)
             label = LabelName.NORMAL.value if image_data.anomaly_class == RealIadAnomalyClass.OK else LabelName.ABNORMAL.value
             path = image_data.image_path
-            if image_entry.mask is not None:
-                mask = image_entry.mask
-                mask = self.transform(mask)
+            mask = image_entry.mask
+            if mask is not None:
+                mask = self.mask_transform(mask)
+            elif self.raw:
+                mask = torch.zeros(1, *image.shape[-2:], dtype=torch.uint8)
             else:
                 mask = torch.zeros(1, *self.gt_mask_size, dtype=torch.float32)
 
@@ -123,3 +144,14 @@ class RealIadDataset(IadDataset):
 
     def __index_images_and_labels__(self) -> None:
         self.data.load_images(self.img_root_dir)
+        # the description of the transform stands for the normalization, as it may be custom
+        self.images = LazyImages([entry.image_path for entry in self.data.images], self.load_image,
+                                 self.preload_workers, cache=image_cache() if self.cache_images else None,
+                                 cache_key="raw" if self.raw else (tuple(self.image_size), repr(self.transform)))
+        if self.preload_images:
+            self.images.preload(desc=f"Loading {self.category} {self.split.value}")
+
+    def load_image(self, path: str):
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+        return self.transform(image) if self.transform else image
@@ -0,0 +1,64 @@
+"""
+Columnar index of the samples of a dataset.
+
+The metadata of the samples, e.g. their paths and labels, are held as one numpy array per
+column, so reading the fields of a sample is an array lookup, and the selection and
+concatenation of samples, e.g. to contaminate a dataset, work on whole index arrays.
+The image paths also go into a hash set, for the membership tests.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+class SampleIndex:
+    """
+    Samples of a dataset, as columns of the same length.
+
+    Args:
+        columns (dict[str, np.ndarray]): the columns by name, the strings in object arrays
+        path_column (str): the column of the unique paths of the samples
+    """
+
+    def __init__(self, columns: dict[str, np.ndarray], path_column: str = "image_path"):
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"The columns have different lengths: {sorted(lengths)}")
+        if path_column not in columns:
+            raise ValueError(f"Missing the path column {path_column}")
+        self.columns = {name: np.asarray(values) for name, values in columns.items()}
+        self.path_column = path_column
+        self._paths: Optional[set] = None
+
+    @classmethod
+    def from_dataframe(cls, dataframe: pd.DataFrame, path_column: str = "image_path") -> SampleIndex:
+        return cls({name: dataframe[name].to_numpy() for name in dataframe.columns}, path_column)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.columns)
+
+    def __len__(self) -> int:
+        return len(self.columns[self.path_column])
+
+    def __getitem__(self, key):
+        """
+        A column by name, or the samples selected by an index array, a boolean mask or a slice.
+        """
+        if isinstance(key, str):
+            return self.columns[key]
+        return SampleIndex({name: values[key] for name, values in self.columns.items()}, self.path_column)
+
+    def contains(self, path) -> bool:
+        if self._paths is None:
+            self._paths = set(self.columns[self.path_column].tolist())
+        return str(path) in self._paths
+
+    def concat(self, other: SampleIndex) -> SampleIndex:
+        if self.columns.keys() != other.columns.keys():
+            raise ValueError(f"Cannot concatenate the columns {list(self.columns)} and {list(other.columns)}")
+        return SampleIndex({name: np.concatenate((values, other.columns[name]))
+                            for name, values in self.columns.items()}, self.path_column)
@@ -50,10 +50,22 @@ class VisaImageData:
 
 @dataclass
 class DatasetImageEntry:
-    image: Image
-    mask: Image
+    """Entry of the index of the dataset, the image and mask being decoded on access."""
     label: VisaAnomalyClass
     image_path: Path
+    mask_path: Optional[Path] = None
+
+    @property
+    def image(self) -> Image:
+        with Image.open(self.image_path) as image:
+            return image.convert("RGB")
+
+    @property
+    def mask(self) -> Optional[Image]:
+        if self.mask_path is None:
+            return None
+        with Image.open(self.mask_path) as mask:
+            return min_max_scale_image(mask.convert("L"), output_dtype=np.uint8)
 
 @dataclass
 class VisaData:
@@ -74,30 +86,27 @@ class VisaData:
         return total_contamination_ratio / len(contaminated_samples)
 
     def load_images(self, img_root_dir: str, split: Split) -> None:
+        """Index the images and masks of the split, without decoding them."""
         self.images = []
-        image = None
-        mask = None
         images_not_found = []
         masks_not_found = []
-        for index, row in self.meta.iterrows():
-            img_path = Path(os.path.join(img_root_dir, row['image']))
+        for image, label, mask in zip(self.meta['image'], self.meta['label'], self.meta['mask']):
+            label = VisaAnomalyClass(label)
+            if split == Split.TRAIN and label == VisaAnomalyClass.ANOMALY:
+                continue
+            img_path = Path(os.path.join(img_root_dir, image))
             if not os.path.exists(img_path):
                 images_not_found.append(img_path)
                 continue
-            image = Image.open(img_path).convert("RGB")
-            label = VisaAnomalyClass(row['label'])
-            if split == Split.TRAIN and label == VisaAnomalyClass.ANOMALY:
-                continue
 
-            if row['label'] != VisaAnomalyClass.NORMAL.value:
-                image_mask_path = Path(os.path.join(img_root_dir, row['mask']))
+            image_mask_path = None
+            if label != VisaAnomalyClass.NORMAL:
+                image_mask_path = Path(os.path.join(img_root_dir, mask))
                 if not os.path.exists(image_mask_path):
                     masks_not_found.append(image_mask_path)
                     continue
-                mask = Image.open(image_mask_path).convert("L")
-                mask = min_max_scale_image(mask, output_dtype=np.uint8)
 
-            self.images.append(DatasetImageEntry(image=image, mask=mask, label=label, image_path=img_path))
+            self.images.append(DatasetImageEntry(label=label, image_path=img_path, mask_path=image_mask_path))
 
         if len(images_not_found) == self.data.__len__():
             raise ValueError("No images found in the dataset. Check root directory or image paths.")
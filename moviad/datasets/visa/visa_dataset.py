@@ -3,10 +3,13 @@ from typing import Optional
 import numpy as np
 import pandas as pd
 import torch
+from PIL import Image
 from torchvision import transforms
 from torchvision.transforms import InterpolationMode
 
 from moviad.datasets.iad_dataset import IadDataset
+from moviad.datasets.image_cache import image_cache
+from moviad.datasets.image_loader import LazyImages
 from moviad.datasets.exceptions.exceptions import DatasetTooSmallToContaminateException
 from moviad.datasets.visa.visa_data import VisaData, VisaAnomalyClass
 from moviad.datasets.visa.visa_dataset_configurations import VisaDatasetCategory
@@ -19,9 +22,12 @@ class VisaDataset(IadDataset):
     split: Split
     class_name: str
     data: VisaData
+    images: LazyImages
 
     def __init__(self, root_path: str, csv_path: str, split: Split, class_name: str,
-                 gt_mask_size: Optional[tuple] = None, image_size=(224,224), transform=None):
+                 gt_mask_size: Optional[tuple] = None, image_size=(224,224), transform=None,
+                 preload_images: bool = False, preload_workers: Optional[int] = None, cache_images: bool = False,
+                 raw: bool = False):
         self.root_path = root_path
         self.csv_path = csv_path
         self.split = split
@@ -32,16 +38,31 @@ class VisaDataset(IadDataset):
         self.dataframe = self.dataframe[self.dataframe["split"] == split.value]
         self.dataframe = self.dataframe[self.dataframe["object"] == class_name]
         self.category = class_name
-
-        if transform is None:
+        self.preload_images = preload_images
+        self.preload_workers = preload_workers
+        self.cache_images = cache_images
+        self.image_size = image_size
+        self.raw = raw
+        self.data = None
+        self.images = None
+
+        # a custom transform also applies to the masks
+        self.mask_transform = transform
+        if raw:
+            self.transform = transforms.PILToTensor()
+            self.mask_transform = transforms.PILToTensor()
+        elif transform is None:
             self.transform = transforms.Compose([
                 transforms.Resize(image_size),
                 transforms.PILToTensor(),
+                transforms.ConvertImageDtype(torch.float32),
+            ])
+            self.mask_transform = transforms.Compose([
                 transforms.Resize(
-                    image_size,
-                    antialias=True,
+                    image_size if gt_mask_size is None else gt_mask_size,
                     interpolation=InterpolationMode.NEAREST,
                 ),
+                transforms.PILToTensor(),
                 transforms.ConvertImageDtype(torch.float32),
             ])
 
@@ -65,42 +86,56 @@ class VisaDataset(IadDataset):
             raise ValueError("Source dataset is not loaded")
 
         torch.manual_seed(seed)
-        contamination_set_size = int(len(self.data) * ratio)
-        contaminated_entries = [entry for entry in source.data.data if entry.label == VisaAnomalyClass.ANOMALY]
-        if len(contaminated_entries) < contamination_set_size:
+        contamination_set_size = int(len(self) * ratio)
+        contaminated_indices = [index for index, entry in enumerate(source.data.images)
+                                if entry.label == VisaAnomalyClass.ANOMALY]
+        if len(contaminated_indices) < contamination_set_size:
             raise DatasetTooSmallToContaminateException(f"Source dataset does not have enough contaminated entries to contaminate the dataset. "
-                             f"Found {len(contaminated_entries)} entries, but needed {contamination_set_size} entries")
-        contaminated_entries = np.random.choice(contaminated_entries, contamination_set_size, replace=False).tolist()
-        self.data.images.extend(contaminated_entries)
-        source.data.data = [entry for entry in source.data.data if entry not in contaminated_entries]
+                             f"Found {len(contaminated_indices)} entries, but needed {contamination_set_size} entries")
+        contaminated_indices = np.random.choice(contaminated_indices, contamination_set_size, replace=False)
+        self.data.images.extend(source.data.images[index] for index in contaminated_indices)
+        self.images.extend(source.images.subset(contaminated_indices))
+
+        kept_indices = np.setdiff1d(np.arange(len(source)), contaminated_indices)
+        source.data.images = [source.data.images[index] for index in kept_indices]
+        source.images = source.images.subset(kept_indices)
         return contamination_set_size
 
 
     def __load__(self):
         self.data = VisaData(meta=self.dataframe, data=self.dataframe)
         self.data.load_images(self.root_path, split=self.split)
+        # the description of the transform stands for the normalization, as it may be custom
+        self.images = LazyImages([entry.image_path for entry in self.data.images], self.load_image,
+                                 self.preload_workers, cache=image_cache() if self.cache_images else None,
+                                 cache_key="raw" if self.raw else (tuple(self.image_size), repr(self.transform)))
+        if self.preload_images:
+            self.images.preload(desc=f"Loading {self.category} {self.split.value}")
+
+    def load_image(self, path: str):
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+        return self.transform(image) if self.transform else image
 
     def __len__(self):
         return len(self.data.images)
 
     def __getitem__(self, item):
         image_data_entry = self.data.images[item]
-        image = image_data_entry.image
-        mask = image_data_entry.mask
+        image = self.images[item]
 
         if self.split == Split.TRAIN:
-            if self.transform:
-                image = self.transform(image)
             return image
 
         if self.split == Split.TEST:
             label = LabelName.NORMAL.value if image_data_entry.label == VisaAnomalyClass.NORMAL else LabelName.ABNORMAL.value
             path = str(image_data_entry.image_path)
+            mask = image_data_entry.mask
             if mask is not None:
-                mask = self.transform(mask)
+                mask = self.mask_transform(mask)
+            elif self.raw:
+                mask = torch.zeros(1, *image.shape[-2:], dtype=torch.uint8)
             else:
                 mask = torch.zeros(1, *self.gt_mask_size, dtype=torch.float32)
-            if self.transform:
-                image = self.transform(image)
 
             return image, label, mask, path
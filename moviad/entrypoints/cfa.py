@@ -93,7 +93,7 @@ def test_cfa(args: CFAArguments, logger=None):
     cfa_model.eval()
 
     evaluator = Evaluator(test_dataloader, args.device)
-    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(cfa_model)
+    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(cfa_model).values()
 
     if logger is not None:
         logger.log({
@@ -1,15 +1,22 @@
 from moviad.datasets.builder import DatasetFactory, DatasetConfig, DatasetType
 from moviad.datasets.iad_dataset import IadDataset
+from moviad.datasets.preprocessing import BatchPreprocessor, PreprocessedDataLoader
 from moviad.utilities.configurations import Split
 
 
-def load_datasets(dataset_config: DatasetConfig, dataset_type: DatasetType, dataset_category: str, image_size: (int, int) = None)\
-        -> (IadDataset, IadDataset):
+def load_datasets(dataset_config: DatasetConfig, dataset_type: DatasetType, dataset_category: str, image_size: (int, int) = None,
+                  raw: bool = False) -> (IadDataset, IadDataset):
     if image_size is None:
         image_size = dataset_config.image_size
     dataset_factory = DatasetFactory(dataset_config)
-    train_dataset = dataset_factory.build(dataset_type, Split.TRAIN, dataset_category, image_size)
-    test_dataset = dataset_factory.build(dataset_type, Split.TEST, dataset_category, image_size)
+    train_dataset = dataset_factory.build(dataset_type, Split.TRAIN, dataset_category, image_size, raw=raw)
+    test_dataset = dataset_factory.build(dataset_type, Split.TEST, dataset_category, image_size, raw=raw)
     train_dataset.load_dataset()
     test_dataset.load_dataset()
-    return train_dataset, test_dataset
\ No newline at end of file
+    return train_dataset, test_dataset
+
+
+def preprocess_on_device(dataloader, image_size: (int, int), device) -> PreprocessedDataLoader:
+    """Wrap the dataloader of a raw dataset, to resize and normalize its batches like the dataset would have."""
+    normalize = bool(getattr(dataloader.dataset, "norm", False))
+    return PreprocessedDataLoader(dataloader, BatchPreprocessor(image_size, normalize=normalize, device=device))
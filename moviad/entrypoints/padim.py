@@ -9,6 +9,7 @@ from moviad.datasets.iad_dataset import IadDataset
 from moviad.entrypoints.common import load_datasets
 from moviad.models.padim.padim import Padim
 from moviad.trainers.trainer_padim import TrainerPadim
+from moviad.utilities.evaluation.evaluator import Evaluator
 
 BATCH_SIZE = 2
 IMAGE_INPUT_SIZE = (224, 224)
@@ -24,18 +25,25 @@ class PadimArgs(Args):
     ad_layers: list | None = None
     model_checkpoint_save_path: str | None = None
     diagonal_convergence: bool | None = False
+    online_fit: bool = False  # fit the gaussians batch by batch, without storing the training embeddings
+    covariance_type: str = "full"  # or one of the compact models 'shared', 'low_rank', 'clustered'
+    covariance_params: dict | None = None  # e.g. {"rank": 16} for 'low_rank', {"grid": (4, 4)} for 'clustered'
+    dtype: str = "float32"  # type of the fit and of the distances, "float32" or "float64"
     results_dirpath: str | None = None
     logger = None
 
 
 def train_padim(args: PadimArgs, logger=None) -> None:
     train_dataset, test_dataset = load_datasets(args.dataset_config, args.dataset_type, args.category)
-    padim = Padi m(
+    padim = Padim(
         args.backbone,
         args.category,
         device=args.device,
         diag_cov=args.diagonal_convergence,
         layers_idxs=args.ad_layers,
+        covariance_type=args.covariance_type,
+        covariance_params=args.covariance_params,
+        dtype=args.dtype,
     )
     padim.to(args.device)
 
@@ -53,12 +61,13 @@ def train_padim(args: PadimArgs, logger=None) -> None:
         eval_dataloader=None,
         device=args.device,
         logger=logger,
+        online_fit=args.online_fit,
     )
     trainer.train()
 
-    evaluator = Evaluator(test_dataloader=test_dataloader, device=args.device)
+    evaluator = Evaluator(dataloader=test_dataloader, device=args.device)
 
-    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(padim)
+    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(padim).values()
 
     torch.cuda.empty_cache()
 
@@ -108,8 +117,8 @@ def test_padim(args: PadimArgs, logger=None) -> None:
     )
 
     # evaluate the model
-    evaluator = Evaluator(test_dataloader=test_dataloader, device=args.device)
-    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(padim)
+    evaluator = Evaluator(dataloader=test_dataloader, device=args.device)
+    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(padim).values()
 
     if logger is not None:
         logger.log({
@@ -1,18 +1,27 @@
 import gc
+import os
 import pathlib
 import torch
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Optional
 from tqdm import tqdm
 from moviad.common.args import Args
 from moviad.datasets.builder import DatasetFactory
 from moviad.datasets.iad_dataset import IadDataset
-from moviad.entrypoints.common import load_datasets
+from moviad.entrypoints.common import load_datasets, preprocess_on_device
 from moviad.trainers.batched_trainer_patchcore import BatchPatchCoreTrainer
+from moviad.trainers.out_of_core_trainer_patchcore import OutOfCorePatchCoreTrainer
 from moviad.utilities.custom_feature_extractor_trimmed import CustomFeatureExtractor
 from moviad.models.patchcore.patchcore import PatchCore
+from moviad.models.patchcore.anomaly_map import AnomalyMapGenerator
+from moviad.utilities.feature_cache import FeatureCache
+from moviad.models.patchcore.nearest_neighbor_search import NearestNeighborSearch, ChunkedNearestNeighborSearch, \
+    ShardedNearestNeighborSearch
+from moviad.models.patchcore.memory_bank_index import MemoryBankIndex, ExactIndex, build_memory_bank_index
 from moviad.trainers.trainer_patchcore import TrainerPatchCore
 from moviad.utilities.configurations import TaskType, Split
 from moviad.utilities.evaluation.evaluator import Evaluator
+from moviad.utilities.evaluation.calibration import ThresholdCalibrator, OperatingPoints
 
 
 @dataclass
@@ -31,14 +40,72 @@ class PatchCoreArgs(Args):
     device: torch.device = None
     quantized: bool = False
     k: int = 1000
+    nn_search_max_bytes: int = 256 * 1024**2
+    nn_search_workers: int = 0  # split the k-nn search across this many CPU processes, 0 to search in process
+    memory_bank_dtype: str = "float32"  # one of "float32", "float16", "bfloat16", "int8"
+    memory_bank_index: str = "exact"  # one of "exact", "ivf_flat", "hnsw", "ivf_pq"
+    memory_bank_index_params: dict = field(default_factory=dict)  # e.g. {"nlist": 1024, "nprobe": 8}
+    out_of_core: bool = False  # spill the training embeddings to disk while building the memory bank
+    out_of_core_dir: str = None
+    out_of_core_dtype: str = "float16"  # "float16" or "int8"
+    anomaly_map_normalization: str = "batch"  # one of "batch", "image", "none"
+    blur_at_feature_resolution: bool = False
+    feature_cache_dir: str = None  # cache the backbone features on disk, shared by runs with the same backbone
+    # save the operating points next to save_path, calibrated on validation_dataset, distinct from the
+    # test set, with anomaly_map_normalization "none" since the thresholds apply to the raw maps at inference
+    calibrate_thresholds: bool = False
+    validation_dataset: IadDataset = None
+    device_preprocessing: bool = False  # resize and normalize whole batches on the device instead of per image
+
+
+def build_patchcore_nn_search(args: PatchCoreArgs) -> NearestNeighborSearch:
+    if args.nn_search_workers > 0:
+        return ShardedNearestNeighborSearch(args.nn_search_workers, args.nn_search_max_bytes)
+    return ChunkedNearestNeighborSearch(args.nn_search_max_bytes)
+
+
+def build_patchcore_index(args: PatchCoreArgs, nn_search: NearestNeighborSearch) -> MemoryBankIndex:
+    if args.memory_bank_index == ExactIndex.name:
+        return ExactIndex(nn_search)
+    return build_memory_bank_index(args.memory_bank_index, **args.memory_bank_index_params)
+
+
+def build_anomaly_map_generator(args: PatchCoreArgs) -> AnomalyMapGenerator:
+    return AnomalyMapGenerator(normalization=args.anomaly_map_normalization,
+                               blur_at_feature_resolution=args.blur_at_feature_resolution)
+
+
+def check_calibration_args(args: PatchCoreArgs) -> None:
+    if args.validation_dataset is None:
+        raise ValueError("calibrate_thresholds needs a validation_dataset, distinct from the test set")
+    if args.anomaly_map_normalization != "none":
+        raise ValueError(
+            f'calibrate_thresholds needs anomaly_map_normalization "none", the "{args.anomaly_map_normalization}" '
+            "normalization rescales the maps with statistics that are not available at inference"
+        )
+
+
+def load_operating_points(args: PatchCoreArgs) -> Optional[OperatingPoints]:
+    """The operating points calibrated by train_patchcore next to the model checkpoint, None if there are none."""
+    if not os.path.isfile(OperatingPoints.path(args.model_checkpoint_path)):
+        return None
+    operating_points = OperatingPoints.load(args.model_checkpoint_path)
+    if operating_points.pixel and args.anomaly_map_normalization != "none":
+        # the pixel thresholds apply to the raw anomaly maps, the image scores are not normalized
+        print('The pixel thresholds need anomaly_map_normalization "none", only the image decisions are made')
+        operating_points.pixel = {}
+    return operating_points
 
 
 def train_patchcore(args: PatchCoreArgs, logger=None) -> None:
+    if args.calibrate_thresholds:
+        check_calibration_args(args)
     if logger is not None:
         logger.config.update({
             "k_centroids": args.k
         }, allow_val_change=True)
-    train_dataset, test_dataset = load_datasets(args.dataset_config, args.dataset_type, args.category, image_size=args.img_input_size)
+    train_dataset, test_dataset = load_datasets(args.dataset_config, args.dataset_type, args.category,
+                                                image_size=args.img_input_size, raw=args.device_preprocessing)
     feature_extractor = CustomFeatureExtractor(args.backbone, args.ad_layers, args.device, True, False, None)
 
     train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
@@ -46,18 +113,37 @@ def train_patchcore(args: PatchCoreArgs, logger=None) -> None:
 
     test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=True,
                                                   drop_last=True)
+    if args.device_preprocessing:
+        train_dataloader = preprocess_on_device(train_dataloader, args.img_input_size, args.device)
+        test_dataloader = preprocess_on_device(test_dataloader, args.img_input_size, args.device)
 
     # define the model
+    nn_search = build_patchcore_nn_search(args)
     patchcore = PatchCore(args.device, input_size=args.img_input_size, feature_extractor=feature_extractor,
-                          apply_quantization=args.quantized, k=args.k)
+                          apply_quantization=args.quantized, k=args.k, memory_bank_dtype=args.memory_bank_dtype,
+                          nn_search=nn_search,
+                          memory_bank_index=build_patchcore_index(args, nn_search),
+                          anomaly_map_generator=build_anomaly_map_generator(args),
+                          feature_cache=FeatureCache(args.feature_cache_dir) if args.feature_cache_dir else None)
     patchcore.to(args.device)
     patchcore.train()
-    trainer = TrainerPatchCore(patchcore, train_dataloader, test_dataloader, args.device, logger=logger)
+    if args.out_of_core:
+        trainer = OutOfCorePatchCoreTrainer(patchcore, train_dataloader, test_dataloader, args.device, logger=logger,
+                                            store_dir=args.out_of_core_dir, store_dtype=args.out_of_core_dtype)
+    else:
+        trainer = TrainerPatchCore(patchcore, train_dataloader, test_dataloader, args.device, logger=logger)
     trainer.train()
 
     # save the model
     if args.save_path:
         torch.save(patchcore.state_dict(), args.save_path)
+        patchcore.save_memory_bank_index(args.save_path)
+        if args.calibrate_thresholds:
+            validation_dataloader = torch.utils.data.DataLoader(args.validation_dataset, batch_size=args.batch_size)
+            if args.device_preprocessing:
+                validation_dataloader = preprocess_on_device(validation_dataloader, args.img_input_size, args.device)
+            operating_points = ThresholdCalibrator().calibrate(patchcore, validation_dataloader, args.device)
+            print(f"Operating points saved to {operating_points.save(args.save_path)}")
 
     # force garbage collector in case
     del patchcore
@@ -69,19 +155,26 @@ def train_patchcore(args: PatchCoreArgs, logger=None) -> None:
 
 def test_patchcore(args: PatchCoreArgs, logger=None) -> None:
     dataset_factory = DatasetFactory(args.dataset_config)
-    test_dataset = dataset_factory.build(args.dataset_type, Split.TEST, args.category)
+    test_dataset = dataset_factory.build(args.dataset_type, Split.TEST, args.category, raw=args.device_preprocessing)
     print(f"Length test dataset: {len(test_dataset)}")
     test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=32, shuffle=True)
+    if args.device_preprocessing:
+        test_dataloader = preprocess_on_device(test_dataloader, args.img_input_size, args.device)
 
     # load the model
     feature_extractor = CustomFeatureExtractor(args.backbone, args.ad_layers, args.device, True, False, None)
-    patchcore = PatchCore(args.device, input_size=args.img_input_size, feature_extractor=feature_extractor)
+    nn_search = build_patchcore_nn_search(args)
+    patchcore = PatchCore(args.device, input_size=args.img_input_size, feature_extractor=feature_extractor,
+                          nn_search=nn_search,
+                          memory_bank_index=build_patchcore_index(args, nn_search),
+                          anomaly_map_generator=build_anomaly_map_generator(args),
+                          feature_cache=FeatureCache(args.feature_cache_dir) if args.feature_cache_dir else None)
     patchcore.load_model(args.model_checkpoint_path)
     patchcore.to(args.device)
     patchcore.eval()
 
     evaluator = Evaluator(test_dataloader, args.device)
-    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(patchcore)
+    img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(patchcore).values()
 
     print("Evaluation performances:")
     print(f"""
@@ -112,12 +205,23 @@ def test_patchcore(args: PatchCoreArgs, logger=None) -> None:
         dirpath = pathlib.Path(args.visual_test_path)
         dirpath.mkdir(parents=True, exist_ok=True)
 
+        # the decisions and masks at the operating points calibrated with the model, if any
+        operating_points = load_operating_points(args)
+
         for images, labels, masks, paths in tqdm(iter(test_dataloader)):
             anomaly_maps, pred_scores = patchcore(images.to(args.device))
 
             anomaly_maps = torch.permute(anomaly_maps, (0, 2, 3, 1))
+            decisions, predicted_masks = None, None
+            if operating_points is not None:
+                decisions = operating_points.decide(pred_scores)
+                if operating_points.pixel:
+                    predicted_masks = operating_points.segment(anomaly_maps)
 
             for i in range(anomaly_maps.shape[0]):
                 patchcore.save_anomaly_map(args.visual_test_path, anomaly_maps[i].cpu().numpy(), pred_scores[i],
                                            paths[i],
-                                           labels[i], masks[i])
+                                           labels[i], masks[i],
+                                           decision=None if decisions is None else bool(decisions[i]),
+                                           predicted_mask=None if predicted_masks is None
+                                           else predicted_masks[i].cpu().numpy())
@@ -136,7 +136,7 @@ def test_stfpm(params: STFPMArgs, logger=None) -> None:
 
         # evaluate the model
         evaluator = Evaluator(dataloader=test_dataloader, device=params.device)
-        scores = evaluator.evaluate(model, logger)
+        scores = evaluator.evaluate(model).values()
 
         # save the scores
         metrics_filename = os.path.join(
@@ -11,7 +11,6 @@ from einops import rearrange
 from tqdm import tqdm
 from sklearn.cluster import KMeans
 from scipy.ndimage import gaussian_filter
-from sklearn.metrics import precision_recall_curve
 import numpy as np
 import cv2 as cv
 import matplotlib.pyplot as plt
@@ -19,6 +18,7 @@ import matplotlib.pyplot as plt
 from moviad.models.components.cfa.descriptor import Descriptor
 from moviad.utilities.custom_feature_extractor_trimmed import CustomFeatureExtractor
 from moviad.utilities.get_sizes import *
+from moviad.utilities.evaluation.metrics import BinaryCurve
 
 class CFA(nn.Module):
 
@@ -346,15 +346,5 @@ class CFA(nn.Module):
             threshold (float) : segmentation threshold
         """
 
-        gt_mask = np.asarray(gt)
-        precision, recall, thresholds = precision_recall_curve(
-            gt_mask.flatten(), score.flatten()
-        )
-        a = 2 * precision * recall
-        b = precision + recall
-        f1 = np.divide(a, b, out=np.zeros_like(a), where=b != 0)
-
         # consider the threshold with the highest f1 score
-        threshold = thresholds[np.argmax(f1)]
-
-        return threshold
+        return BinaryCurve(np.asarray(gt), score).max_f1_threshold()
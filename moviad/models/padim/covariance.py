@@ -0,0 +1,217 @@
+"""Compact covariance models of the PaDiM per-patch gaussians.
+
+The full model stores one C x C covariance per patch. The models below trade some of
+its accuracy for size and speed, and are all fitted from the per-patch means and
+covariances and scored with batched tensor operations:
+
+- SharedCovariance: a single covariance, pooled over all the patches
+- LowRankCovariance: a rank-k plus diagonal covariance per patch, scored with the Woodbury identity
+- ClusteredCovariance: one pooled covariance per block of neighbouring patches
+"""
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+
+import torch
+from torch import Tensor
+
+from .mahalanobis import cholesky_with_jitter
+
+
+class CovarianceModel(ABC):
+    """Base class of the compact covariance models.
+
+    The fitted parameters are kept in ``self.params``, a dict of tensors, which is what
+    is saved with the model and what ``size`` accounts for.
+    """
+
+    name: str
+
+    def __init__(self, dtype: torch.dtype = torch.float32) -> None:
+        self.dtype = dtype
+        self.params: dict[str, Tensor] = {}
+
+    @abstractmethod
+    def fit(self, mean: Tensor, cov: Tensor, feature_size: tuple[int, int]) -> None:
+        """
+        Fit the model from the per-patch gaussians.
+
+        Args:
+            mean (Tensor): means of shape (C, H*W)
+            cov (Tensor): regularized covariances of shape (H*W, C, C)
+            feature_size (tuple[int, int]): height and width of the feature maps
+        """
+
+    @abstractmethod
+    def distances(self, embedding_vectors: Tensor) -> Tensor:
+        """
+        Args:
+            embedding_vectors (Tensor): embeddings of shape (B, C, H*W)
+
+        Returns:
+            Tensor: Mahalanobis distances of shape (B, H*W)
+        """
+
+    def centered(self, embedding_vectors: Tensor) -> Tensor:
+        assert self.params, "The covariance model must be fitted first."
+        mean = self.params["mean"]
+        return embedding_vectors.to(mean) - mean.unsqueeze(0)
+
+    def to(self, device: torch.device) -> CovarianceModel:
+        self.params = {name: param.to(device) for name, param in self.params.items()}
+        return self
+
+    def state(self) -> dict[str, Tensor]:
+        return {name: param.cpu() for name, param in self.params.items()}
+
+    def load_state(self, state: dict[str, Tensor]) -> None:
+        self.params = dict(state)
+
+    @property
+    def size(self) -> float:
+        """Size of the fitted parameters in MB."""
+        return sum(param.numel() * param.element_size() for param in self.params.values()) / 1024**2
+
+
+def pooled_precision(cov: Tensor, dtype: torch.dtype) -> Tensor:
+    """Inverse of the mean of the given covariances, of shape (..., C, C)."""
+    return torch.cholesky_inverse(cholesky_with_jitter(cov.mean(dim=0))).to(dtype)
+
+
+def quadratic_form(delta: Tensor, precision: Tensor) -> Tensor:
+    """Squared Mahalanobis distances of delta (B, C, N) for a single precision matrix (C, C)."""
+    return (torch.einsum("cd,bdn->bcn", precision, delta) * delta).sum(dim=1)
+
+
+class SharedCovariance(CovarianceModel):
+    """Per-patch means with one covariance shared by all the patches, C^2 parameters instead of H*W*C^2."""
+
+    name = "shared"
+
+    def fit(self, mean: Tensor, cov: Tensor, feature_size: tuple[int, int]) -> None:
+        self.params = {
+            "mean": mean.to(self.dtype),
+            "precision": pooled_precision(cov, self.dtype),
+        }
+
+    def distances(self, embedding_vectors: Tensor) -> Tensor:
+        delta = self.centered(embedding_vectors)
+        return quadratic_form(delta, self.params["precision"]).clamp_(min=0).sqrt_()
+
+
+class LowRankCovariance(CovarianceModel):
+    """Per-patch covariance approximated as W W^T + D, with W of rank k and D diagonal.
+
+    The k leading eigenvectors of each covariance give W, and D keeps the residual variances,
+    so the diagonal of the covariance is preserved. The regularization lambda*I added to every
+    covariance is left out of W, whose eigenvalues are lowered by lambda, so D is at least lambda:
+    it stays well conditioned, and a full rank model is exact. The inverse is never formed: with
+    M = I + W^T D^-1 W = L L^T, the Woodbury identity gives
+    d^2 = delta^T D^-1 delta - ||L^-1 W^T D^-1 delta||^2, which needs O(k*C) parameters per patch.
+
+    Args:
+        rank (int): rank k of the low-rank term
+        regularization (float): the lambda added to the diagonal of the covariances. When it is 0,
+            D is floored at 1e-3 of the mean variance of the patch instead
+    """
+
+    name = "low_rank"
+
+    def __init__(self, rank: int = 16, regularization: float = 0.01, dtype: torch.dtype = torch.float32) -> None:
+        super().__init__(dtype)
+        self.rank = rank
+        self.regularization = regularization
+
+    def fit(self, mean: Tensor, cov: Tensor, feature_size: tuple[int, int]) -> None:
+        rank = min(self.rank, cov.shape[-1])
+        diagonal = torch.diagonal(cov, dim1=1, dim2=2)  # (H*W, C)
+        floor = self.regularization if self.regularization > 0 else 1e-3 * diagonal.mean(dim=1, keepdim=True)
+
+        eigenvalues, eigenvectors = torch.linalg.eigh(cov)
+        eigenvalues = (eigenvalues[:, -rank:] - self.regularization).clamp(min=0)
+        w = eigenvectors[:, :, -rank:] * eigenvalues.sqrt().unsqueeze(1)  # (H*W, C, k)
+
+        residual = (diagonal - w.pow(2).sum(dim=2)).clamp(min=floor)  # (H*W, C)
+
+        a = w.transpose(1, 2) / residual.unsqueeze(1)  # W^T D^-1, (H*W, k, C)
+        m = torch.eye(rank, dtype=cov.dtype, device=cov.device) + a @ w
+        g = torch.linalg.solve_triangular(torch.linalg.cholesky(m), a, upper=False)
+
+        self.params = {
+            "mean": mean.to(self.dtype),
+            "inv_diagonal": (1 / residual).to(self.dtype),
+            "projection": g.to(self.dtype),
+        }
+
+    def distances(self, embedding_vectors: Tensor) -> Tensor:
+        delta = self.centered(embedding_vectors).permute(2, 0, 1)  # (H*W, B, C)
+        squared = (delta.pow(2) * self.params["inv_diagonal"].unsqueeze(1)).sum(dim=2)
+        projected = torch.bmm(delta, self.params["projection"].transpose(1, 2))
+        squared -= projected.pow(2).sum(dim=2)
+        return squared.clamp_(min=0).sqrt_().transpose(0, 1)
+
+
+class ClusteredCovariance(CovarianceModel):
+    """Per-patch means with one pooled covariance per block of a grid of neighbouring patches.
+
+    Args:
+        grid (tuple[int, int]): number of blocks along the height and the width of the feature maps
+    """
+
+    name = "clustered"
+
+    def __init__(self, grid: tuple[int, int] = (4, 4), dtype: torch.dtype = torch.float32) -> None:
+        super().__init__(dtype)
+        self.grid = tuple(grid)
+        self._clusters: list[Tensor] | None = None
+
+    def fit(self, mean: Tensor, cov: Tensor, feature_size: tuple[int, int]) -> None:
+        H, W = feature_size
+        rows = torch.arange(H, device=cov.device) * min(self.grid[0], H) // H
+        cols = torch.arange(W, device=cov.device) * min(self.grid[1], W) // W
+        assignment = (rows.unsqueeze(1) * min(self.grid[1], W) + cols.unsqueeze(0)).flatten()
+
+        precisions = [pooled_precision(cov[assignment == cluster], self.dtype) for cluster in assignment.unique()]
+        self.params = {
+            "mean": mean.to(self.dtype),
+            "precision": torch.stack(precisions),
+            "assignment": assignment,
+        }
+        self._clusters = None
+
+    def clusters(self) -> list[Tensor]:
+        """Patch indices of every cluster, computed once from the assignment."""
+        if self._clusters is None or self._clusters[0].device != self.params["assignment"].device:
+            assignment = self.params["assignment"]
+            self._clusters = [torch.nonzero(assignment == c).squeeze(1) for c in range(int(assignment.max()) + 1)]
+        return self._clusters
+
+    def load_state(self, state: dict[str, Tensor]) -> None:
+        super().load_state(state)
+        self._clusters = None
+
+    def distances(self, embedding_vectors: Tensor) -> Tensor:
+        delta = self.centered(embedding_vectors)
+        squared = torch.empty(delta.shape[0], delta.shape[2], dtype=delta.dtype, device=delta.device)
+        for cluster, patches in enumerate(self.clusters()):
+            squared[:, patches] = quadratic_form(delta[:, :, patches], self.params["precision"][cluster])
+        return squared.clamp_(min=0).sqrt_()
+
+
+COVARIANCE_MODELS = {
+    model_class.name: model_class for model_class in (SharedCovariance, LowRankCovariance, ClusteredCovariance)
+}
+
+
+def build_covariance_model(name: str, **params) -> CovarianceModel:
+    """
+    Instantiate a compact covariance model by name.
+
+    Args:
+        name (str): one of 'shared', 'low_rank', 'clustered'
+        params: parameters of the chosen model, e.g. rank or grid
+    """
+    if name not in COVARIANCE_MODELS:
+        raise ValueError(f"Unknown covariance model {name}, choose one of {list(COVARIANCE_MODELS)}")
+    return COVARIANCE_MODELS[name](**params)
@@ -0,0 +1,101 @@
+"""Batched Mahalanobis scoring of the PaDiM patch embeddings."""
+
+from __future__ import annotations
+
+import numpy as np
+import torch
+
+
+def to_patch_major(cov: np.ndarray | torch.Tensor) -> torch.Tensor:
+    """Convert covariances stored as (C, C, H*W), as in Padim.gauss_cov, to a (H*W, C, C) tensor."""
+    return torch.as_tensor(cov).permute(2, 0, 1)
+
+
+def cholesky_with_jitter(cov: torch.Tensor, max_tries: int = 6) -> torch.Tensor:
+    """
+    Batched Cholesky factorization that retries only the ill-conditioned matrices, adding to their
+    diagonal a jitter that starts at 1e-6 of their mean variance and grows tenfold at every try.
+
+    Args:
+        cov: symmetric matrices of shape (..., C, C)
+        max_tries: number of retries with an increasing jitter
+
+    Returns:
+        torch.Tensor: lower triangular factors of shape (..., C, C)
+    """
+    cholesky, info = torch.linalg.cholesky_ex(cov)
+    failed = info > 0
+    if not failed.any():
+        return cholesky
+
+    eye = torch.eye(cov.shape[-1], dtype=cov.dtype, device=cov.device)
+    jitter = torch.diagonal(cov, dim1=-2, dim2=-1).mean(dim=-1).abs().clamp(min=torch.finfo(cov.dtype).eps) * 1e-6
+    for _ in range(max_tries):
+        retried, retried_info = torch.linalg.cholesky_ex(
+            cov[failed] + jitter[failed][..., None, None] * eye
+        )
+        cholesky[failed] = retried
+        info[failed] = retried_info
+        failed = info > 0
+        if not failed.any():
+            return cholesky
+        jitter = jitter * 10
+    raise RuntimeError(f"{int(failed.sum())} covariance matrices are not positive definite, even with jitter")
+
+
+def precision_matrices(
+    cov: np.ndarray | torch.Tensor,
+    dtype: torch.dtype = torch.float32,
+    device: torch.device | str | None = None,
+) -> torch.Tensor:
+    """
+    Invert all the per-patch covariance matrices at once, through their Cholesky factors.
+
+    Args:
+        cov: covariance matrices of shape (C, C, H*W)
+        dtype: type in which the covariances are factorized and inverted
+        device: device of the inversion and of the returned matrices, that of cov if None
+
+    Returns:
+        torch.Tensor: precision matrices of shape (H*W, C, C)
+    """
+    cov = to_patch_major(cov).to(device=device, dtype=dtype)
+    return torch.cholesky_inverse(cholesky_with_jitter(cov))
+
+
+def mahalanobis_distances(
+    embedding_vectors: torch.Tensor, mean: torch.Tensor, precision: torch.Tensor
+) -> torch.Tensor:
+    """
+    Mahalanobis distances of a batch of embeddings from the per-patch gaussians, in one batched matmul.
+
+    Args:
+        embedding_vectors: embeddings of shape (B, C, H*W)
+        mean: means of shape (C, H*W)
+        precision: precision matrices of shape (H*W, C, C)
+
+    Returns:
+        torch.Tensor: distances of shape (B, H*W)
+    """
+    # (H*W, B, C) differences, so that the patches are the batch dimension of the matmul
+    delta = (embedding_vectors - mean.unsqueeze(0)).permute(2, 0, 1)
+    squared = torch.bmm(delta, precision).mul_(delta).sum(dim=2)
+    return squared.clamp_(min=0).sqrt_().transpose(0, 1)
+
+
+def mahalanobis_distances_diagonal(
+    embedding_vectors: torch.Tensor, mean: torch.Tensor, variances: torch.Tensor
+) -> torch.Tensor:
+    """
+    Mahalanobis distances of a batch of embeddings from per-patch gaussians with diagonal covariances.
+
+    Args:
+        embedding_vectors: embeddings of shape (B, C, H*W)
+        mean: means of shape (C, H*W)
+        variances: diagonals of the covariance matrices, of shape (C, H*W)
+
+    Returns:
+        torch.Tensor: distances of shape (B, H*W)
+    """
+    delta = embedding_vectors - mean.unsqueeze(0)
+    return (delta.pow(2) / variances.unsqueeze(0)).sum(dim=1).sqrt_()
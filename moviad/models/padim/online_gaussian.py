@@ -0,0 +1,85 @@
+"""Streaming estimation of the per-patch gaussians of PaDiM."""
+
+from __future__ import annotations
+
+import numpy as np
+import torch
+
+
+class OnlineGaussianEstimator:
+    """Running per-patch mean and covariance of the embeddings, updated one batch at a time.
+
+    Each batch is reduced to its mean and its sum of centered outer products with a single
+    batched einsum, then merged into the running statistics with the pairwise update of
+    Chan et al., which is numerically stable unlike the raw sums of x and x^2.
+    The memory is O(H*W*C^2) whatever the number of training images, and the statistics
+    stay on the device of the embeddings.
+
+    Args:
+        diagonal: keep only the variances, the memory is then O(H*W*C)
+        dtype: type of the running statistics
+    """
+
+    def __init__(self, diagonal: bool = False, dtype: torch.dtype = torch.float64):
+        self.diagonal = diagonal
+        self.dtype = dtype
+        self.count = 0
+        self.feature_size: tuple[int, int] | None = None  # (H, W) of the feature maps
+        self.mean: torch.Tensor | None = None  # (C, H*W)
+        self.m2: torch.Tensor | None = None  # (H*W, C, C), or (C, H*W) when diagonal
+
+    def update(self, embedding_vectors: torch.Tensor) -> None:
+        """
+        Add a batch of embeddings to the running statistics.
+
+        Args:
+            embedding_vectors: embeddings of shape (B, C, H, W)
+        """
+        B, C, H, W = embedding_vectors.size()
+        x = embedding_vectors.reshape(B, C, H * W).to(self.dtype)
+        self.feature_size = (H, W)
+
+        batch_mean = x.mean(dim=0)
+        centered = x - batch_mean
+        if self.diagonal:
+            batch_m2 = centered.pow(2).sum(dim=0)
+        else:
+            batch_m2 = torch.einsum("bci,bdi->icd", centered, centered)
+
+        if self.count == 0:
+            self.count, self.mean, self.m2 = B, batch_mean, batch_m2
+            return
+
+        total = self.count + B
+        delta = batch_mean - self.mean
+        self.mean += delta * (B / total)
+        weight = self.count * B / total
+        if self.diagonal:
+            self.m2 += batch_m2 + delta.pow(2) * weight
+        else:
+            delta = delta.T
+            self.m2 += batch_m2 + torch.einsum("ic,id->icd", delta, delta) * weight
+        self.count = total
+
+    def finalize(self, regularization: float = 0.01) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the sample mean and covariance, in the layout of the Padim parameters.
+
+        Args:
+            regularization: added to the diagonal of the covariance matrices
+
+        Returns:
+            np.ndarray: means of shape (C, H*W)
+            np.ndarray: covariances of shape (C, C, H*W), or their diagonals of shape (C, H*W)
+        """
+        if self.count < 2:
+            raise RuntimeError("At least two embeddings are needed to estimate a covariance")
+
+        cov = self.m2 / (self.count - 1)
+        if self.diagonal:
+            cov = cov + regularization
+        else:
+            cov = cov + regularization * torch.eye(cov.shape[1], dtype=cov.dtype, device=cov.device)
+            cov = cov.permute(1, 2, 0)
+
+        return self.mean.cpu().numpy(), cov.contiguous().cpu().numpy()
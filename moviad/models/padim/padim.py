@@ -1,5 +1,6 @@
 from __future__ import annotations
 import os
+from concurrent.futures import ThreadPoolExecutor
 from random import sample
 from typing import Mapping, Union, Any, Dict, List, Tuple
 from dataclasses import dataclass
@@ -7,13 +8,16 @@ from dataclasses import dataclass
 import numpy as np
 #from profiler import profile
 from scipy.ndimage import gaussian_filter
-from scipy.spatial.distance import mahalanobis
 
 import torch
 from torch import nn
 from torch.nn import functional as F
 
 from ...utilities.custom_feature_extractor_trimmed import CustomFeatureExtractor
+from ...utilities.get_sizes import *
+from .mahalanobis import precision_matrices, mahalanobis_distances, mahalanobis_distances_diagonal, to_patch_major
+from .covariance import CovarianceModel, build_covariance_model
+from .online_gaussian import OnlineGaussianEstimator
 
 # Dict: "backbone_model_name" -> {(layer_idxs): (true_dimension, random_projection_dimension)}
 EMBEDDING_SIZES = {
@@ -45,6 +49,10 @@ EMBEDDING_SIZES = {
 }
 
 
+# types of the fit and of the scoring, float64 is only needed for ill-conditioned features
+PADIM_DTYPES = {"float32": torch.float32, "float64": torch.float64}
+
+
 def idx_to_layer_name(backbone_model_name, idx: Union[Tuple, List]):
     if backbone_model_name in ["wide_resnet50_2"]:
         return tuple(f"layer{i}" for i in idx)
@@ -77,21 +85,42 @@ class Padim(nn.Module):
         "gauss_cov",
         "diag_cov",
         "layers_idxs",
+        "covariance_type",
+        "covariance_params",
+        "dtype",
     ]
+    # hyperparameters missing from the checkpoints saved before they were introduced
+    OPTIONAL_HYPERPARAMS = {"covariance_type": "full", "covariance_params": {}, "dtype": "float32"}
 
     def __init__(
             self,
-            args: PadimArgs,
+            backbone_model_name: str,
+            class_name: str,
+            device: torch.device,
+            diag_cov: bool = False,
+            layers_idxs: list | None = None,
+            covariance_type: str = "full",
+            covariance_params: dict | None = None,
+            dtype: str = "float32",
     ):
         """
         Args:
             backbone_model_name: one of the following strings: 'wide_resnet50_2', 'mobilenet_v2'
-            save_path: path to save the model and the extracted features
             class_name: one of the following strings: 'bottle', 'cable', 'capsule', 'carpet', 'grid', 'hazelnut',
                 'leather', 'metal_nut', 'pill', 'screw', 'tile', 'toothbrush', 'transistor', 'wood', 'zipper'
+            device: device where the backbone runs and the distances are computed
             diag_cov: if True, keep only the diagonal elements of the covariance matrices
+            layers_idxs: indexes or names of the feature extraction layers
+            covariance_type: 'full' for one covariance matrix per patch, or one of the compact
+                models 'shared', 'low_rank', 'clustered' of moviad.models.padim.covariance
+            covariance_params: parameters of the compact covariance model, e.g. {"rank": 16}
+                for 'low_rank' or {"grid": (4, 4)} for 'clustered'
+            dtype: 'float32' or 'float64', type of the fitted gaussians and of the distances
         """
+        if dtype not in PADIM_DTYPES:
+            raise ValueError(f"Unknown Padim type {dtype}, choose one of {list(PADIM_DTYPES)}")
         super(Padim, self).__init__()
+        self.dtype = dtype
         self.diagonal_gauss_cov = None
         self.class_name = class_name
         self.device = device
@@ -108,25 +137,90 @@ class Padim(nn.Module):
         # dimensionality reduction: random projection
         random_dims = torch.tensor(sample(range(0, self.t_d), self.d))
         self.random_dimensions = torch.nn.Parameter(random_dims, requires_grad=False)
+        # per-layer channel indices and restoring permutation of the random dimensions, by layer sizes and device
+        self._channel_selections = {}
         # training: learn the multivariate Gaussian distribution from the extracted features
         self.train_outputs = None  # list of mean and covariance matrix numpy arrays
         self.gauss_mean = None
         self.gauss_cov = None
+        # (H*W, C, C) inverses of gauss_cov, computed once at the first inference after fitting or loading
+        self.gauss_precision = None
+        # compact covariance model, replacing gauss_cov when covariance_type is not 'full'
+        self.covariance_type = covariance_type
+        self.covariance_params = dict(covariance_params or {})
+        self.covariance_model = self.build_covariance_model()
+
+    def build_covariance_model(self) -> CovarianceModel | None:
+        if self.covariance_type == "full":
+            return None
+        if self.diag_cov:
+            raise ValueError("diag_cov can only be used with the full covariance type")
+        return build_covariance_model(self.covariance_type, dtype=self.torch_dtype, **self.covariance_params)
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        return PADIM_DTYPES[self.dtype]
 
     @staticmethod
     def embedding_concat(x, y):
-        B, C1, H1, W1 = x.size()
-        _, C2, H2, W2 = y.size()
-        s = int(H1 / H2)
-        x = F.unfold(x, kernel_size=s, dilation=1, stride=s)
-        x = x.view(B, C1, -1, H2, W2)
-        z = torch.zeros(B, C1 + C2, x.size(2), H2, W2)
-        for i in range(x.size(2)):
-            z[:, :, i, :, :] = torch.cat((x[:, :, i, :, :], y), 1)
-        z = z.view(B, -1, H2 * W2)
-        z = F.fold(z, kernel_size=s, output_size=(H1, W1), stride=s)
-
-        return z
+        """
+        Concatenate y to x, repeating every location of the lower resolution y over
+        the s x s block of x it covers, i.e. a nearest upsampling by the integer factor s.
+        """
+        s = int(x.size(2) / y.size(2))
+        return torch.cat((x, F.interpolate(y, scale_factor=s, mode="nearest")), 1)
+
+    def channel_selection(self, layer_channels: list[int], device: torch.device):
+        """
+        Split the random dimensions among the layers, so that the channels are selected
+        before the feature maps are upsampled and concatenated.
+
+        Args:
+            layer_channels: number of channels of the feature map of each layer
+            device: device of the feature maps
+
+        Returns:
+            list of the channel indices to select from each layer, and the permutation
+            that restores the order of random_dimensions after the concatenation
+        """
+        key = (tuple(layer_channels), str(device))
+        if key not in self._channel_selections:
+            dims = self.random_dimensions.detach().to(device)
+            indices, positions = [], []
+            offset = 0
+            for channels in layer_channels:
+                in_layer = (dims >= offset) & (dims < offset + channels)
+                indices.append(dims[in_layer] - offset)
+                positions.append(torch.nonzero(in_layer).squeeze(1))
+                offset += channels
+            self._channel_selections[key] = (indices, torch.argsort(torch.cat(positions)))
+        return self._channel_selections[key]
+
+    def fuse_feature_maps(self, feature_maps: List[torch.Tensor]) -> torch.Tensor:
+        """
+        Select the random dimensions of the feature maps of the layers, upsample them to
+        the resolution of the first layer and concatenate them, without loops and on the
+        device of the feature maps. Equivalent to chaining embedding_concat over the layers
+        and selecting the random dimensions afterwards.
+
+        Args:
+            feature_maps: feature maps of the layers, in the order of layers_idxs
+
+        Returns:
+            embedding vectors of shape (B, d, H, W)
+        """
+        H, W = feature_maps[0].shape[-2:]
+        indices, permutation = self.channel_selection(
+            [feature_map.size(1) for feature_map in feature_maps], feature_maps[0].device
+        )
+        selected = []
+        for feature_map, layer_indices in zip(feature_maps, indices):
+            feature_map = torch.index_select(feature_map, 1, layer_indices)
+            if feature_map.shape[-2:] != (H, W):
+                s = int(H / feature_map.size(2))
+                feature_map = F.interpolate(feature_map, scale_factor=s, mode="nearest")
+            selected.append(feature_map)
+        return torch.index_select(torch.cat(selected, 1), 1, permutation)
 
     def raw_feature_maps_to_embeddings(
             self, layer_outputs: Dict[str, List[torch.Tensor]]
@@ -142,19 +236,23 @@ class Padim(nn.Module):
         """
         # concatenate the outputs of the different dataloader batches
         output_tensors: dict[str, torch.Tensor] = {
-            layer: torch.cat(outputs, 0) for layer, outputs in layer_outputs.items()
+            layer: torch.cat(outputs, 0).to(self.device) for layer, outputs in layer_outputs.items()
         }
-        # concatenate the feature maps to get the raw embedding vectors
-        embedding_vectors: torch.Tensor = output_tensors[self.layers_idxs[0]]
-        for layer in self.layers_idxs[1:]:
-            embedding_vectors = Padim.embedding_concat(
-                embedding_vectors, output_tensors[layer]
-            )
-        # dimensionality reduction: select the random dimensions to reduce the embedding vectors
-        embedding_vectors = torch.index_select(
-            embedding_vectors.to(self.device), 1, self.random_dimensions
-        )
-        return embedding_vectors
+        # select the random dimensions and concatenate the feature maps to get the embedding vectors
+        return self.fuse_feature_maps([output_tensors[layer] for layer in self.layers_idxs])
+
+    def embed(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Return the embedding vectors of a batch of images, of shape (B, C, H, W),
+        keeping the feature maps on the device of the backbone.
+        """
+        with torch.no_grad():
+            self.backbone(x)
+        layer_outputs = {
+            layer: [output.detach()] for layer, output in zip(self.layers_idxs, self.outputs)
+        }
+        self.outputs = []
+        return self.raw_feature_maps_to_embeddings(layer_outputs)
 
     def forward(self, x):
         # 1. extract feature maps and get the raw layer outputs (conv. feature maps)
@@ -165,9 +263,9 @@ class Padim(nn.Module):
         with torch.no_grad():
             # _ = self.backbone(x)
             _ = self.backbone(x)
-        # get intermediate layer outputs
+        # get intermediate layer outputs, on the device of the backbone
         for layer, output in zip(self.layers_idxs, self.outputs):  # new
-            layer_outputs[layer].append(output.cpu().detach())  # new
+            layer_outputs[layer].append(output.detach())  # new
         # initialize hook outputs
         self.outputs = []
 
@@ -178,7 +276,9 @@ class Padim(nn.Module):
         # 2. use the feature maps to get the embeddings
         embedding_vectors = self.raw_feature_maps_to_embeddings(layer_outputs)
         # 3. compute the distance matrix
-        if self.diag_cov:
+        if self.covariance_model is not None:
+            dist_list = self.compute_distances_covariance_model(embedding_vectors)
+        elif self.diag_cov:
             dist_list = self.compute_distances_diagonal(embedding_vectors)
         else:
             dist_list = self.compute_distances(embedding_vectors)
@@ -193,9 +293,8 @@ class Padim(nn.Module):
             .squeeze()
             .numpy()
         )
-        # 5. apply gaussian smoothing on the score map
-        for i in range(score_map.shape[0]):
-            score_map[i] = gaussian_filter(score_map[i], sigma=4)
+        # 5. apply gaussian smoothing on the score map, one image per thread
+        self.smooth_score_maps(score_map)
         # 6. the image anomaly score is the maximum score in the score map
         img_scores = score_map.reshape(score_map.shape[0], -1).max(axis=1)
 
@@ -205,6 +304,19 @@ class Padim(nn.Module):
 
         return score_map, img_scores
 
+    def estimate_gaussian(self, embedding_vectors: torch.Tensor, diagonal: bool, chunk_size: int = 64):
+        """
+        Estimate the per-patch means and covariances of the given embedding vectors, of shape (B, C, H, W),
+        on the device and in the type of the model, chunk_size images at a time.
+
+        Returns:
+            the OnlineGaussianEstimator holding the statistics
+        """
+        estimator = OnlineGaussianEstimator(diagonal=diagonal, dtype=self.torch_dtype)
+        for chunk in embedding_vectors.split(chunk_size):
+            estimator.update(chunk.to(self.device))
+        return estimator
+
     def fit_multivariate_diagonal_gaussian(self, embedding_vectors: torch.Tensor, update_params: bool, logger=None) -> (torch.Tensor, torch.Tensor):
         """
         Fit a multivariate Gaussian distribution to the set of given embedding vectors.
@@ -212,24 +324,11 @@ class Padim(nn.Module):
         Returns:
             List of mean and covariance matrix diagonal numpy arrays
         """
-        B, C, H, W = embedding_vectors.size()
-
-        embedding_vectors = embedding_vectors.view(B, C, H * W)
-        mean = torch.mean(embedding_vectors.cpu(), dim=0).numpy()
-        diagonal_cov = torch.zeros(C, H*W).numpy()
-        I = np.identity(C)
-        # for every "patch" in the feature map, compute the covariance across the batch
-        for i in range(H * W):
-            # TODO: use np.var instead of np.cov in diagonal covariance computation
-            temp_cov = (
-                    np.cov(embedding_vectors[:, :, i].cpu().numpy(), rowvar=False)
-                    + 0.01 * I
-            )
-
-            diagonal_cov[:, i] = np.diag(temp_cov)
+        mean, diagonal_cov = self.estimate_gaussian(embedding_vectors, diagonal=True).finalize()
 
         if update_params:
             self.gauss_mean, self.diagonal_gauss_cov = mean, diagonal_cov
+            self.gauss_precision = None
         return mean, diagonal_cov
 
     def fit_multivariate_gaussian(self, embedding_vectors, update_params, logger=None):
@@ -239,35 +338,81 @@ class Padim(nn.Module):
         Returns:
             List of mean and covariance matrix numpy arrays
         """
-        B, C, H, W = embedding_vectors.size()
-
-        embedding_vectors = embedding_vectors.view(B, C, H * W)
-        mean = torch.mean(embedding_vectors.cpu(), dim=0).numpy()
-        cov = torch.zeros(C, C, H * W).numpy()
-        I = np.identity(C)
-        # for every "patch" in the feature map, compute the covariance across the batch
-        for i in range(H * W):
-            if self.diag_cov:
-                temp_cov = (
-                        np.cov(embedding_vectors[:, :, i].cpu().numpy(), rowvar=False)
-                        + 0.01 * I
-                )
-                temp_cov[~I.astype(bool)] = 0
-                cov[:, :, i] = temp_cov
-            else:
-                cov[:, :, i] = (
-                        np.cov(embedding_vectors[:, :, i].cpu().numpy(), rowvar=False)
-                        + 0.01 * I
-                )
-            if logger is not None:
+        mean, cov = self.estimate_gaussian(embedding_vectors, diagonal=False).finalize()
+        if self.diag_cov:
+            cov = cov * np.eye(cov.shape[0], dtype=cov.dtype)[:, :, None]
+        if logger is not None:
+            for i in range(cov.shape[2]):
                 logger.log({
                     "cov": cov[:, :, i],
                     "mean": mean[:, i], }
                 )
         if update_params:
             self.gauss_mean, self.gauss_cov = mean, cov
+            self.gauss_precision = None
         return mean, cov
 
+    @staticmethod
+    def smooth_score_maps(score_map: np.ndarray, sigma: float = 4, num_threads: int | None = None) -> np.ndarray:
+        """
+        Apply the gaussian smoothing in place to each map of a (B, H, W) batch, splitting the
+        maps across a thread pool, as scipy releases the GIL while filtering.
+        """
+        def smooth(i):
+            score_map[i] = gaussian_filter(score_map[i], sigma=sigma)
+
+        if score_map.shape[0] == 1:
+            smooth(0)
+        else:
+            with ThreadPoolExecutor(max_workers=num_threads or min(score_map.shape[0], os.cpu_count() or 1)) as pool:
+                list(pool.map(smooth, range(score_map.shape[0])))
+        return score_map
+
+    def fit_covariance_model(self, embedding_vectors: torch.Tensor) -> None:
+        """
+        Fit the compact covariance model to the set of given embedding vectors, of shape (B, C, H, W).
+        """
+        estimator = self.estimate_gaussian(embedding_vectors, diagonal=False)
+        mean, cov = estimator.finalize()
+        self.set_gaussian(mean, cov, feature_size=estimator.feature_size)
+
+    def set_gaussian(
+            self,
+            mean: np.ndarray,
+            cov: np.ndarray,
+            diagonal: bool = False,
+            feature_size: tuple[int, int] | None = None,
+    ) -> None:
+        """
+        Set the parameters of the per-patch gaussians, e.g. estimated by an OnlineGaussianEstimator.
+
+        Args:
+            mean: means of shape (C, H*W)
+            cov: covariances of shape (C, C, H*W), or their diagonals of shape (C, H*W) if diagonal
+            diagonal: whether cov holds only the diagonals
+            feature_size: height and width of the feature maps, needed by the compact covariance models
+        """
+        self.gauss_mean = mean
+        if self.covariance_model is not None:
+            if diagonal or feature_size is None:
+                raise ValueError(f"The {self.covariance_type} covariance model needs the full covariances and the feature size")
+            # the full covariances are only used to fit the compact model, and are not kept
+            self.covariance_model.fit(
+                torch.as_tensor(mean).to(self.device, self.torch_dtype),
+                to_patch_major(cov).to(self.device, self.torch_dtype),
+                feature_size,
+            )
+            self.gauss_cov = None
+            self.gauss_precision = None
+            return
+        if diagonal:
+            self.diagonal_gauss_cov = cov
+        else:
+            if self.diag_cov:
+                cov = cov * np.eye(cov.shape[0], dtype=cov.dtype)[:, :, None]
+            self.gauss_cov = cov
+        self.gauss_precision = None
+
     def load_backbone(self):
         """
         Load the backbone model
@@ -306,60 +451,114 @@ class Padim(nn.Module):
         # add all the hyperparameters to the state dict
         for p in self.HYPERPARAMS:
             state_dict[p] = getattr(self, p)
+        if self.covariance_model is not None:
+            state_dict["covariance_state"] = self.covariance_model.state()
         return state_dict
 
     def load_state_dict(self, state_dict: Mapping[str, Any], strict: bool = True):
         # load the hyperparameters
         for p in self.HYPERPARAMS:
-            setattr(self, p, state_dict[p])
+            if p in self.OPTIONAL_HYPERPARAMS:
+                setattr(self, p, state_dict.get(p, self.OPTIONAL_HYPERPARAMS[p]))
+            else:
+                setattr(self, p, state_dict[p])
+        self.gauss_precision = None
+        self._channel_selections = {}
+        self.covariance_model = self.build_covariance_model()
+        if self.covariance_model is not None:
+            self.covariance_model.load_state(state_dict["covariance_state"])
+            self.covariance_model.to(self.device)
         # load the backbone models
         self.load_backbone()
         # remove the hyperparameters from the state dict
-        state_dict = {k: v for k, v in state_dict.items() if k not in self.HYPERPARAMS}
+        state_dict = {
+            k: v for k, v in state_dict.items() if k not in self.HYPERPARAMS and k != "covariance_state"
+        }
         return super().load_state_dict(state_dict, strict=strict)
 
 
+    def precision_matrices(self) -> torch.Tensor:
+        """
+        Return the precision matrices of the per-patch gaussians, of shape (H*W, C, C),
+        inverting the covariance matrices only the first time after fitting or loading.
+        """
+        assert self.gauss_cov is not None, "The model must be trained first."
+        if self.gauss_precision is None:
+            self.gauss_precision = precision_matrices(self.gauss_cov, dtype=self.torch_dtype, device=self.device)
+        return self.gauss_precision
+
     def compute_distances(self, embedding_vectors: torch.Tensor):
         """
         Compute the Mahalanobis distances between the embedding vectors and the
-        multivariate Gaussian distribution.
+        multivariate Gaussian distribution, for the whole batch at once.
         """
         B, C, H, W = embedding_vectors.size()
-        embedding_vectors = embedding_vectors.view(B, C, H * W).cpu().numpy()
-        dist_list = []
         assert (
                 self.gauss_mean is not None and self.gauss_cov is not None
         ), "The model must be trained first."
-        # compute each patch-embedding distance
-        for i in range(H * W):
-            mean = self.gauss_mean[:, i]
-            cov_inv = np.linalg.inv(self.gauss_cov[:, :, i])
-            dist = [
-                mahalanobis(sample[:, i], mean, cov_inv) for sample in embedding_vectors
-            ]
-            dist_list.append(dist)
-        dist_list = np.array(dist_list).transpose(1, 0).reshape(B, H, W)
-        return torch.tensor(dist_list)
-
+        embedding_vectors = embedding_vectors.view(B, C, H * W).to(self.device, self.torch_dtype)
+        mean = torch.as_tensor(self.gauss_mean, dtype=self.torch_dtype, device=self.device)
+        dist_list = mahalanobis_distances(embedding_vectors, mean, self.precision_matrices())
+        return dist_list.reshape(B, H, W).float().cpu()
 
     def compute_distances_diagonal(self, embedding_vectors: torch.Tensor):
         """
         Compute the Mahalanobis distances between the embedding vectors and the
-        multivariate Gaussian distribution.
+        multivariate Gaussian distribution with diagonal covariances.
         """
         B, C, H, W = embedding_vectors.size()
-        embedding_vectors = embedding_vectors.view(B, C, H * W).cpu().numpy()
-        dist_list = []
+        if self.diagonal_gauss_cov is None and self.gauss_cov is not None:
+            # a full covariance fitted with diag_cov, or loaded from a checkpoint
+            self.diagonal_gauss_cov = np.ascontiguousarray(np.diagonal(self.gauss_cov, axis1=0, axis2=1).T)
         assert (
                 self.gauss_mean is not None and self.diagonal_gauss_cov is not None
         ), "The model must be trained first."
-        # compute each patch-embedding distance
-        for i in range(H * W):
-            mean = self.gauss_mean[:, i]
-            diag_cov_i = self.diagonal_gauss_cov[:, i]
-            dist = [
-                malahanobis_distance_diagonal(sample[:, i], mean, diag_cov_i) for sample in embedding_vectors
-            ]
-            dist_list.append(dist)
-        dist_list = np.array(dist_list).transpose(1, 0).reshape(B, H, W)
-        return torch.tensor(dist_list)
+        embedding_vectors = embedding_vectors.view(B, C, H * W).to(self.device, self.torch_dtype)
+        mean = torch.as_tensor(self.gauss_mean, dtype=self.torch_dtype, device=self.device)
+        variances = torch.as_tensor(self.diagonal_gauss_cov, dtype=self.torch_dtype, device=self.device)
+        dist_list = mahalanobis_distances_diagonal(embedding_vectors, mean, variances)
+        return dist_list.reshape(B, H, W).float().cpu()
+
+    def compute_distances_covariance_model(self, embedding_vectors: torch.Tensor):
+        """
+        Compute the Mahalanobis distances between the embedding vectors and the
+        multivariate Gaussian distribution with the compact covariance model.
+        """
+        B, C, H, W = embedding_vectors.size()
+        embedding_vectors = embedding_vectors.view(B, C, H * W).to(self.device)
+        dist_list = self.covariance_model.distances(embedding_vectors)
+        return dist_list.reshape(B, H, W).float().cpu()
+
+    def gaussian_size(self) -> float:
+        """Size in MB of the fitted gaussian parameters, as used at inference."""
+        if self.covariance_model is not None:
+            return self.covariance_model.size
+        covariances = self.diagonal_gauss_cov if self.diag_cov and self.diagonal_gauss_cov is not None else self.gauss_cov
+        return sum(np.asarray(param).nbytes for param in (self.gauss_mean, covariances) if param is not None) / 1024**2
+
+    def get_model_size_and_macs(self) -> tuple[dict, float]:
+        """
+        This method returns the model size and inference MACs
+
+        Returns:
+            tuple:
+                [0] : dict with all model components sizes, macs and number of parameters
+                [1] : total size of the AD model
+        """
+        sizes = {}
+
+        macs, params = get_model_macs(self.backbone_model.model)
+        sizes["feature_extractor"] = {
+            "size" : get_torch_model_size(self.backbone_model.model),
+            "params" : params,
+            "macs" : macs
+        }
+
+        sizes["gaussian"] = {
+            "size" : self.gaussian_size(),
+            "type" : self.covariance_type if not self.diag_cov else "diagonal",
+        }
+
+        total_size = sizes["feature_extractor"]["size"] + sizes["gaussian"]["size"]
+
+        return sizes, total_size
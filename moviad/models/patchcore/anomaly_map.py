@@ -6,26 +6,78 @@ from __future__ import annotations
 
 import torch
 from torch import nn
-from torch.nn import functional as F 
-from torchvision.transforms import GaussianBlur
+from torch.nn import functional as F
 
 class AnomalyMapGenerator(nn.Module):
     """Generate Anomaly Heatmap.
 
+    The gaussian blur is applied as two 1-D convolutions with reflect padding, which gives
+    the same result of ``torchvision.transforms.GaussianBlur`` at a fraction of the cost.
+    The 1-D kernels are computed once per size, device and dtype and then cached.
+
     Args:
-        The anomaly map is upsampled to this dimension.
         sigma (int, optional): Standard deviation for Gaussian Kernel.
             Defaults to ``4``.
+        normalization (str, optional): min-max rescaling of the maps, ``"batch"`` uses the
+            min and max of the whole batch, ``"image"`` those of each map, ``"none"`` keeps the raw scores.
+            Defaults to ``"batch"``.
+        blur_at_feature_resolution (bool, optional): blur the patch scores before upsampling them,
+            with sigma scaled to the feature resolution. Much cheaper, slightly smoother maps.
+            Defaults to ``False``.
     """
 
+    NORMALIZATIONS = ("batch", "image", "none")
+
     def __init__(
         self,
         sigma: int = 4,
+        normalization: str = "batch",
+        blur_at_feature_resolution: bool = False,
     ) -> None:
         super().__init__()
-        kernel_size = 2 * int(4.0 * sigma + 0.5) + 1
-        self.blur = GaussianBlur(kernel_size, sigma)
-        #self.blur = GaussianBlur(4)
+        if normalization not in self.NORMALIZATIONS:
+            raise ValueError(f"Unknown normalization {normalization}, choose one of {self.NORMALIZATIONS}")
+        self.sigma = sigma
+        self.normalization = normalization
+        self.blur_at_feature_resolution = blur_at_feature_resolution
+        self._kernels: dict[tuple, torch.Tensor] = {}
+
+    @staticmethod
+    def kernel_size(sigma: float) -> int:
+        return 2 * int(4.0 * sigma + 0.5) + 1
+
+    def gaussian_kernel(self, sigma: float, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """Return the normalized 1-D gaussian kernel for sigma, from the cache when possible."""
+        key = (sigma, device, dtype)
+        if key not in self._kernels:
+            half = self.kernel_size(sigma) // 2
+            x = torch.linspace(-half, half, 2 * half + 1, device=device, dtype=torch.float64)
+            kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+            self._kernels[key] = (kernel / kernel.sum()).to(dtype)
+        return self._kernels[key]
+
+    def blur(self, x: torch.Tensor, sigma: float | None = None) -> torch.Tensor:
+        """
+        Separable gaussian blur of a batch of maps of shape (B, C, H, W).
+
+        Args:
+            x (torch.Tensor): the maps
+            sigma (float, optional): standard deviation of the kernel, defaults to self.sigma
+
+        Returns:
+            torch.Tensor: the blurred maps, with the shape of x
+        """
+        sigma = self.sigma if sigma is None else sigma
+        kernel = self.gaussian_kernel(sigma, x.device, x.dtype)
+        pad = kernel.shape[0] // 2
+        batch, channels, height, width = x.shape
+
+        # reflect padding needs the maps to be larger than the padding
+        mode = "reflect" if pad < min(height, width) else "replicate"
+        x = F.pad(x.reshape(batch * channels, 1, height, width), (pad, pad, pad, pad), mode=mode)
+        x = F.conv2d(x, kernel.view(1, 1, 1, -1))
+        x = F.conv2d(x, kernel.view(1, 1, -1, 1))
+        return x.reshape(batch, channels, height, width)
 
     def compute_anomaly_map(
         self,
@@ -44,11 +96,15 @@ class AnomalyMapGenerator(nn.Module):
             Tensor: Map of the pixel-level anomaly scores
         """
         if image_size is None:
-            anomaly_map = patch_scores
+            anomaly_map = self.blur(patch_scores)
+        elif self.blur_at_feature_resolution:
+            scale = patch_scores.shape[-1] / image_size[1]
+            anomaly_map = self.blur(patch_scores, sigma=max(self.sigma * scale, 0.5))
+            anomaly_map = F.interpolate(anomaly_map, size=(image_size[0], image_size[1]), mode="bilinear", align_corners=False)
         else:
             anomaly_map = F.interpolate(patch_scores, size=(image_size[0], image_size[1]), mode="bilinear", align_corners=False)
-        anomaly_map = self.blur(anomaly_map)
-        return AnomalyMapGenerator.rescale(anomaly_map)
+            anomaly_map = self.blur(anomaly_map)
+        return self.normalize(anomaly_map)
 
     def forward(
         self,
@@ -72,5 +128,15 @@ class AnomalyMapGenerator(nn.Module):
         """
         return self.compute_anomaly_map(patch_scores, image_size)
 
+    def normalize(self, x: torch.Tensor) -> torch.Tensor:
+        if self.normalization == "batch":
+            return AnomalyMapGenerator.rescale(x)
+        if self.normalization == "image":
+            flat = x.flatten(1)
+            x_min = flat.amin(dim=1).view(-1, *(1,) * (x.dim() - 1))
+            x_max = flat.amax(dim=1).view(-1, *(1,) * (x.dim() - 1))
+            return (x - x_min) / (x_max - x_min).clamp(min=torch.finfo(x.dtype).tiny)
+        return x
+
     def rescale(x):
-        return (x - x.min()) / (x.max() - x.min())
\ No newline at end of file
+        return (x - x.min()) / (x.max() - x.min())
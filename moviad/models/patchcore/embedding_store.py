@@ -0,0 +1,199 @@
+"""Out-of-core storage of the patch embeddings used to build the PatchCore memory bank."""
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from sklearn.random_projection import SparseRandomProjection, johnson_lindenstrauss_min_dim
+
+
+class EmbeddingStore:
+    """Append-only store of patch embeddings spilled to memory-mapped files on disk.
+
+    The embeddings are written as they arrive, in float16 or in int8 with one scale
+    per patch, so the RAM usage does not depend on the number of training images.
+    A uniform reservoir sample of the embeddings is kept in memory to fit the random
+    projection used by the coreset selection.
+
+    Args:
+        dim (int): embedding size
+        directory (str): where the files are written, a temporary directory if None
+        dtype (str): storage type, "float16" or "int8"
+        reservoir_size (int): number of embeddings kept in the reservoir sample
+        seed (int): seed of the reservoir sampling
+    """
+
+    DTYPES = ("float16", "int8")
+
+    def __init__(
+        self,
+        dim: int,
+        directory: str | None = None,
+        dtype: str = "float16",
+        reservoir_size: int = 20000,
+        seed: int = 0,
+    ) -> None:
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported storage type {dtype}, choose one of {self.DTYPES}")
+
+        self.dim = dim
+        self.dtype = dtype
+        self.owns_directory = directory is None
+        self.directory = tempfile.mkdtemp(prefix="moviad_embeddings_") if directory is None else directory
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.embeddings_path = os.path.join(self.directory, "embeddings.bin")
+        self.scales_path = os.path.join(self.directory, "scales.bin")
+        self.projection_path = os.path.join(self.directory, "projection.bin")
+        self._embeddings_file = open(self.embeddings_path, "wb")
+        self._scales_file = open(self.scales_path, "wb") if dtype == "int8" else None
+
+        self.num_embeddings = 0
+        self.reservoir = torch.empty((reservoir_size, dim), dtype=torch.float32)
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self._embeddings: np.memmap | None = None
+        self._scales: np.memmap | None = None
+        # random projection fitted by project, None if the embeddings are copied unprojected
+        self.projector: SparseRandomProjection | None = None
+
+    def __len__(self) -> int:
+        return self.num_embeddings
+
+    def append(self, embeddings: torch.Tensor) -> None:
+        """
+        Write a batch of embeddings at the end of the store and update the reservoir sample.
+
+        Args:
+            embeddings (torch.Tensor): tensor of shape (n, dim)
+        """
+        if self._embeddings_file is None:
+            raise RuntimeError("The store is finalized, no more embeddings can be appended")
+
+        if embeddings.is_quantized:
+            embeddings = embeddings.dequantize()
+        embeddings = embeddings.detach().to("cpu", torch.float32).reshape(-1, self.dim)
+
+        if self.dtype == "int8":
+            scales = embeddings.abs().amax(dim=1).clamp_(min=1e-12) / 127
+            codes = torch.round(embeddings / scales.unsqueeze(1)).to(torch.int8)
+            self._embeddings_file.write(codes.numpy().tobytes())
+            self._scales_file.write(scales.numpy().tobytes())
+        else:
+            self._embeddings_file.write(embeddings.to(torch.float16).numpy().tobytes())
+
+        self.update_reservoir(embeddings)
+        self.num_embeddings += embeddings.shape[0]
+
+    def update_reservoir(self, embeddings: torch.Tensor) -> None:
+        """Vectorized reservoir sampling (algorithm R) of a batch of embeddings."""
+        capacity = self.reservoir.shape[0]
+        positions = torch.arange(self.num_embeddings, self.num_embeddings + embeddings.shape[0])
+
+        filling = positions < capacity
+        self.reservoir[positions[filling]] = embeddings[filling]
+
+        # every later embedding replaces a random slot with probability capacity / (position + 1)
+        slots = (torch.rand(positions.shape, generator=self.generator) * (positions + 1)).long()
+        replace = ~filling & (slots < capacity)
+        self.reservoir[slots[replace]] = embeddings[replace]
+
+    def reservoir_sample(self) -> torch.Tensor:
+        return self.reservoir[:min(self.num_embeddings, self.reservoir.shape[0])]
+
+    def finalize(self) -> None:
+        """Close the files being written and map them in memory for reading."""
+        if self._embeddings_file is not None:
+            self._embeddings_file.close()
+            self._embeddings_file = None
+            if self._scales_file is not None:
+                self._scales_file.close()
+                self._scales_file = None
+
+        if self.num_embeddings == 0:
+            raise RuntimeError("The store does not contain any embedding")
+
+        self._embeddings = np.memmap(
+            self.embeddings_path, dtype=self.dtype, mode="r", shape=(self.num_embeddings, self.dim)
+        )
+        if self.dtype == "int8":
+            self._scales = np.memmap(self.scales_path, dtype=np.float32, mode="r", shape=(self.num_embeddings,))
+
+    def read(self, start: int, stop: int) -> torch.Tensor:
+        """Return the float32 embeddings in [start, stop)."""
+        return self.gather(np.arange(start, min(stop, self.num_embeddings)))
+
+    def gather(self, indices) -> torch.Tensor:
+        """
+        Return the float32 embeddings at the given indices.
+
+        Args:
+            indices: indices of the embeddings, as an array or a tensor
+
+        Returns:
+            torch.Tensor: tensor of shape (len(indices), dim)
+        """
+        if self._embeddings is None:
+            self.finalize()
+
+        indices = np.asarray(indices)
+        embeddings = torch.from_numpy(np.asarray(self._embeddings[indices], dtype=np.float32))
+        if self.dtype == "int8":
+            embeddings *= torch.from_numpy(np.asarray(self._scales[indices])).unsqueeze(1)
+        return embeddings
+
+    def project(self, eps: float = 0.90, chunk_size: int = 65536) -> np.memmap:
+        """
+        Fit a sparse random projection on the reservoir sample and write the projection
+        of every stored embedding to a float16 memory-mapped file, one chunk at a time.
+        The number of components is chosen for the whole store, not for the sample.
+        When it is not smaller than the embedding size the embeddings are copied unprojected.
+
+        Args:
+            eps (float): agression of the sparse random projection
+            chunk_size (int): number of embeddings projected at once
+
+        Returns:
+            np.memmap: read-only float16 array of shape (len(self), projected_dim)
+        """
+        if self._embeddings is None:
+            self.finalize()
+
+        n_components = johnson_lindenstrauss_min_dim(self.num_embeddings, eps=eps)
+        projector = None
+        if n_components < self.dim:
+            projector = SparseRandomProjection(n_components=n_components, random_state=0)
+            projector.fit(self.reservoir_sample().numpy())
+        else:
+            n_components = self.dim
+        self.projector = projector
+        print(f"   Projecting {self.num_embeddings} embeddings from {self.dim} to {n_components} dimensions.")
+
+        projection = np.memmap(
+            self.projection_path, dtype=np.float16, mode="w+", shape=(self.num_embeddings, n_components)
+        )
+        for start in range(0, self.num_embeddings, chunk_size):
+            chunk = self.read(start, start + chunk_size).numpy()
+            if projector is not None:
+                chunk = projector.transform(chunk)
+            projection[start:start + chunk.shape[0]] = chunk
+        projection.flush()
+        del projection
+
+        return np.memmap(self.projection_path, dtype=np.float16, mode="r", shape=(self.num_embeddings, n_components))
+
+    def close(self) -> None:
+        """Release the memory maps, and remove the files if the store created its own directory."""
+        if self._embeddings_file is not None:
+            self._embeddings_file.close()
+            self._embeddings_file = None
+        if self._scales_file is not None:
+            self._scales_file.close()
+            self._scales_file = None
+        self._embeddings, self._scales = None, None
+        if self.owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
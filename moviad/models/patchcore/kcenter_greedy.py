@@ -5,6 +5,7 @@ Returns points that minimizes the maximum distance of any point to a center.
 """
 from __future__ import annotations
 
+import itertools
 from abc import abstractmethod
 
 import torch
@@ -20,6 +21,10 @@ class CoresetExtractor:
     Args:
         embedding (torch.Tensor): Embedding vector extracted from a CNN
         sampling_ratio (float): Ratio to choose coreset size from the embedding size.
+        centers_per_step (int): Number of centers selected at every greedy step. With more than one
+            center per step the selection is approximate, but the number of steps drops accordingly.
+        tolerance (float): Stop the selection once every patch is closer than this distance to a center.
+        tolerance_check_interval (int): Number of steps between two checks of the tolerance.
 
     Example:
         >>> embedding.shape
@@ -31,13 +36,18 @@ class CoresetExtractor:
         torch.Size([219, 1536])
     """
 
-    def __init__(self, quantized, device: torch.device, sampling_ratio: float = 0.1,k: int = 30000) -> None:
+    def __init__(self, quantized, device: torch.device, sampling_ratio: float = 0.1,k: int = 30000,
+                 centers_per_step: int = 1, tolerance: float = 0.0, tolerance_check_interval: int = 100) -> None:
 
         self.quantized = quantized
         self.projector = SparseRandomProjection(n_components="auto", eps=0.90)
         self.k = k
+        self.centers_per_step = max(1, centers_per_step)
+        self.tolerance = tolerance
+        self.tolerance_check_interval = max(1, tolerance_check_interval)
         self.features: torch.Tensor
         self.min_distances: torch.Tensor = None
+        self.radius: float | None = None
 
         self.device = device
 
@@ -78,74 +88,324 @@ class CoresetExtractor:
 
         return idx
 
-    @abstractmethod
+    def project(self, z_lib: torch.Tensor, eps: float = 0.90) -> torch.Tensor:
+        """Reduce the dimension of z_lib with a sparse random projection, fitted on z_lib itself.
+
+        Args:
+            z_lib:  (n, d) tensor of patches.
+            eps:    Agression of the sparse random projection.
+
+        Returns:
+            (n, d') float32 tensor of projected patches, z_lib itself if the projection fails.
+        """
+        print(f"   Fitting random projections. Start dim = {z_lib.shape}.")
+        if self.quantized:
+            z_lib = torch.int_repr(z_lib).to(torch.float64)
+        try:
+            transformer = SparseRandomProjection(eps=eps)
+            z_lib = torch.from_numpy(transformer.fit_transform(z_lib.cpu().numpy()))
+            self.projector = transformer
+            print(f"   DONE.                 Transformed dim = {z_lib.shape}.")
+        except ValueError:
+            print("   Error: could not project vectors. Please increase `eps`.")
+
+        return z_lib.to(torch.float32)
+
+    @staticmethod
+    def squared_distances(z_lib: torch.Tensor, sq_norms: torch.Tensor, centers: torch.Tensor) -> torch.Tensor:
+        """Squared distance of every patch to its closest center, as ||z||^2 + ||c||^2 - 2zc.
+
+        Args:
+            z_lib:      (n, d) tensor of patches, possibly stored as float16.
+            sq_norms:   (n,) float32 tensor of the squared norms of the patches.
+            centers:    indices of the centers.
+
+        Returns:
+            (n,) float32 tensor of squared distances.
+        """
+        return CoresetExtractor.squared_distances_to(z_lib, sq_norms, z_lib[centers], sq_norms[centers])
+
+    @staticmethod
+    def squared_distances_to(
+            z_lib: torch.Tensor, sq_norms: torch.Tensor, centers: torch.Tensor, centers_sq_norms: torch.Tensor
+    ) -> torch.Tensor:
+        """Squared distance of every patch to its closest center, given the center vectors.
+
+        Args:
+            z_lib:              (n, d) tensor of patches.
+            sq_norms:           (n,) float32 tensor of the squared norms of the patches.
+            centers:            (c, d) tensor of centers, with the dtype of z_lib.
+            centers_sq_norms:   (c,) float32 tensor of the squared norms of the centers.
+
+        Returns:
+            (n,) float32 tensor of squared distances.
+        """
+        # the products are computed in float32, as float16 rounding errors and overflows are of
+        # the order of the distances being compared; float16 patches are converted in chunks
+        centers = centers.float()
+        chunk_size = z_lib.shape[0] if z_lib.dtype == torch.float32 else 65536
+        products = torch.cat([
+            torch.mm(z_lib[start:start + chunk_size].float(), centers.T)
+            for start in range(0, z_lib.shape[0], chunk_size)
+        ])
+        distances = products.mul_(-2).add_(centers_sq_norms.unsqueeze(0)).add_(sq_norms.unsqueeze(1))
+        return distances.amin(dim=1).clamp_(min=0)
+
     def get_coreset_idx_randomp(
             self,
             z_lib,
             n: int = 1000,
             k: int = 30000,
             eps: float = 0.90,
-            float16: bool = True,
+            float16: bool = False,
     ):
         """Returns n coreset idx for given z_lib.
 
-        Performance on AMD3700, 32GB RAM, RTX3080 (10GB):
-        CPU: 40-60 it/s, GPU: 500+ it/s (float32), 1500+ it/s (float16)
+        The first patch is always selected, then self.k patches are added greedily, or
+        fewer if the coverage radius falls below self.tolerance. The distances to the
+        closest center are updated in place from precomputed squared norms, with one
+        matmul per step, and the indices stay on device until the end.
 
         Args:
             z_lib:      (n, d) tensor of patches.
             n:          Number of patches to select.
             eps:        Agression of the sparse random projection.
-            float16:    Cast all to float16, saves memory and is a bit faster (on GPU).
-            force_cpu:  Force cpu, useful in case of GPU OOM.
+            float16:    Store the projected patches in float16 on GPU, halving their memory.
+                The distances are still computed in float32, between the float16 patches.
+
+        Returns:
+            coreset indices
+        """
+
+        z_lib = self.project(z_lib, eps).to(self.device)
+        if float16 and z_lib.device.type == "cuda":
+            z_lib = z_lib.half()
+        # norms of the stored patches, so that the distances are the ones between them
+        sq_norms = z_lib.float().pow(2).sum(dim=1)
+        return self.select_greedy(z_lib, sq_norms)
+
+    def select_greedy(self, z_lib: torch.Tensor, sq_norms: torch.Tensor) -> torch.Tensor:
+        """Greedy selection of get_coreset_idx_randomp, on projected patches held on the device.
+
+        Args:
+            z_lib:      (n, d) tensor of projected patches.
+            sq_norms:   (n,) float32 tensor of the squared norms of the patches.
 
         Returns:
             coreset indices
         """
 
-        print(z_lib.device)
-        print(z_lib.shape)
+        n_selected = min(self.k, z_lib.shape[0] - 1) + 1
+        coreset_idx = torch.zeros(n_selected, dtype=torch.long, device=z_lib.device)
+        min_distances = self.squared_distances(z_lib, sq_norms, coreset_idx[:1])
+        min_distances[0] = 0
+
+        position = 1
+        with tqdm(total=n_selected - 1) as progress:
+            for step in itertools.count():
+                if position >= n_selected:
+                    break
+
+                # checking the radius synchronizes with the device, so it is done periodically
+                if self.tolerance > 0 and step % self.tolerance_check_interval == 0:
+                    radius = min_distances.max().sqrt().item()
+                    if radius <= self.tolerance:
+                        print(f"   Coverage radius {radius:.4f} below tolerance, stopping at {position} patches.")
+                        break
+
+                n_centers = min(self.centers_per_step, n_selected - position)
+                if n_centers == 1:
+                    select_idx = torch.argmax(min_distances).unsqueeze(0)
+                else:
+                    select_idx = torch.topk(min_distances, n_centers).indices
+
+                # bookkeeping
+                coreset_idx[position:position + n_centers] = select_idx
+                torch.minimum(
+                    min_distances, self.squared_distances(z_lib, sq_norms, select_idx), out=min_distances
+                )
+                min_distances[select_idx] = 0
+                position += n_centers
+                progress.update(n_centers)
+
+        self.min_distances = min_distances
+        self.radius = min_distances.max().sqrt().item()
+        return coreset_idx[:position].cpu()
+
+    def get_coreset_idx_out_of_core(
+            self,
+            z_lib: np.ndarray,
+            chunk_size: int = 65536,
+            max_resident_bytes: int = 2 * 1024**3,
+            streaming_centers_per_step: int = 64,
+    ) -> torch.Tensor:
+        """Returns coreset idx for a projected library that does not fit in memory.
+
+        Same selection of get_coreset_idx_randomp, on an already projected library such as
+        the memory-mapped projection of an EmbeddingStore. The projection is usually far
+        smaller than the embeddings: when it fits in max_resident_bytes it is loaded on the
+        device once and the selection runs in memory. Otherwise every step streams the library
+        in chunks of chunk_size patches, so only the (n,) distances are kept in memory, and
+        streaming_centers_per_step centers are selected per pass over the library.
 
-        print(f"   Fitting random projections. Start dim = {z_lib.shape}.")
-        try:
-            transformer = SparseRandomProjection(eps=eps)
+        Args:
+            z_lib:      (n, d) array of projected patches, usually a np.memmap.
+            chunk_size: Number of patches moved to the device at once.
+            max_resident_bytes: Largest float32 projection loaded on the device at once.
+            streaming_centers_per_step: Centers selected per pass over a streamed library, 1 for
+                the exact greedy selection at the cost of one pass per center.
 
-            if self.quantized:
-                z_lib = torch.int_repr(z_lib).to(torch.float64).cpu()
-            z_lib = torch.tensor(transformer.fit_transform(z_lib))
-            print(f"   DONE.                 Transformed dim = {z_lib.shape}.")
-        except ValueError:
-            print("   Error: could not project vectors. Please increase `eps`.")
+        Returns:
+            coreset indices
+        """
 
-        select_idx = 0
-        last_item = z_lib[select_idx:select_idx + 1]
-        coreset_idx = [torch.tensor(select_idx)]
-        min_distances = torch.linalg.norm(z_lib - last_item, dim=1, keepdims=True)
-        # The line below is not faster than linalg.norm, although i'm keeping it in for
-        # future reference.
-        # min_distances = torch.sum(torch.pow(z_lib-last_item, 2), dim=1, keepdims=True)
+        n_patches = z_lib.shape[0]
+        if n_patches * z_lib.shape[1] * 4 <= max_resident_bytes:
+            z_resident = torch.cat([
+                torch.from_numpy(np.asarray(z_lib[start:start + chunk_size], dtype=np.float32)).to(self.device)
+                for start in range(0, n_patches, chunk_size)
+            ])
+            return self.select_greedy(z_resident, z_resident.pow(2).sum(dim=1))
+
+        centers_per_step = max(1, streaming_centers_per_step)
+
+        def load(start):
+            chunk = np.asarray(z_lib[start:start + chunk_size], dtype=np.float32)
+            return torch.from_numpy(chunk).to(self.device)
+
+        def update(min_distances, centers, centers_sq_norms):
+            for start in range(0, n_patches, chunk_size):
+                distances = self.squared_distances_to(
+                    load(start), sq_norms[start:start + chunk_size], centers, centers_sq_norms
+                )
+                torch.minimum(
+                    min_distances[start:start + chunk_size], distances, out=min_distances[start:start + chunk_size]
+                )
+
+        def gather(indices):
+            indices = indices.cpu().numpy()
+            centers = torch.from_numpy(np.asarray(z_lib[np.sort(indices)], dtype=np.float32))
+            return centers.to(self.device)
+
+        sq_norms = torch.cat([load(start).pow(2).sum(dim=1) for start in range(0, n_patches, chunk_size)])
+
+        n_selected = min(self.k, n_patches - 1) + 1
+        coreset_idx = torch.zeros(n_selected, dtype=torch.long, device=self.device)
+        min_distances = torch.full((n_patches,), float("inf"), device=self.device)
+        update(min_distances, gather(coreset_idx[:1]), sq_norms[:1])
+        min_distances[0] = 0
+
+        position = 1
+        with tqdm(total=n_selected - 1) as progress:
+            for step in itertools.count():
+                if position >= n_selected:
+                    break
+
+                if self.tolerance > 0 and step % self.tolerance_check_interval == 0:
+                    radius = min_distances.max().sqrt().item()
+                    if radius <= self.tolerance:
+                        print(f"   Coverage radius {radius:.4f} below tolerance, stopping at {position} patches.")
+                        break
+
+                n_centers = min(centers_per_step, n_selected - position)
+                select_idx = torch.topk(min_distances, n_centers).indices
+                select_idx, _ = torch.sort(select_idx)
+
+                coreset_idx[position:position + n_centers] = select_idx
+                update(min_distances, gather(select_idx), sq_norms[select_idx])
+                min_distances[select_idx] = 0
+                position += n_centers
+                progress.update(n_centers)
+
+        self.min_distances = min_distances
+        self.radius = min_distances.max().sqrt().item()
+        return coreset_idx[:position].cpu()
+
+    def projection_fitted(self) -> bool:
+        return hasattr(self.projector, "components_")
+
+    def projection_matrix(self) -> torch.Tensor | None:
+        """(d', d) float32 matrix of the fitted random projection, None if the patches were not projected."""
+        if not self.projection_fitted():
+            return None
+        components = self.projector.components_
+        if hasattr(components, "toarray"):
+            components = components.toarray()
+        return torch.from_numpy(np.asarray(components, dtype=np.float32))
+
+    def extend_coreset_idx(
+            self,
+            centers: torch.Tensor,
+            z_new: torch.Tensor,
+            max_new: int | None = None,
+            radius: float | None = None,
+            chunk_size: int = 4096,
+            projection: torch.Tensor | None = None,
+            radius_rtol: float = 1e-3,
+    ) -> torch.Tensor:
+        """Continue the greedy selection on new patches, given the centers already selected.
+
+        The patches of the previous library are within the coverage radius of the centers,
+        and adding centers can only bring them closer, so the selection is continued on the
+        new patches alone: the farthest new patch is added while it lies beyond the radius.
+        The radius is only meaningful in the space it was measured in, so the patches are
+        projected with the same projection, which is persisted with the model for this purpose.
 
-        if float16:
-            last_item = last_item.half()
-            z_lib = z_lib.half()
-            min_distances = min_distances.half()
+        Args:
+            centers:    (c, d) tensor of the centers already selected, i.e. the memory bank.
+            z_new:      (n, d) tensor of new patches.
+            max_new:    Maximum number of patches to add, no limit if None.
+            radius:     Coverage radius of the centers, defaults to the one of the last selection.
+                When neither is available the selection only stops at max_new.
+            chunk_size: Number of new patches compared to the centers at once.
+            projection: (d', d) matrix of the projection the radius was measured with, defaults
+                to the one fitted by the last selection. Without one the patches are not projected.
+            radius_rtol: Relative tolerance on the squared radius, so that the patches lying on the
+                radius are not selected again because of the rounding of their distances.
 
-        last_item = last_item.to(self.device)
-        z_lib = z_lib.to(self.device)
-        min_distances = min_distances.to(self.device)
+        Returns:
+            indices of the selected new patches
+        """
 
-        for _ in tqdm(range(self.k)):
-            distances = torch.linalg.norm(z_lib - last_item, dim=1, keepdims=True)  # broadcasting step
-            # distances = torch.sum(torch.pow(z_lib-last_item, 2), dim=1, keepdims=True) # broadcasting step
-            min_distances = torch.minimum(distances, min_distances)  # iterative step
-            select_idx = torch.argmax(min_distances)  # selection step
+        radius = self.radius if radius is None else radius
+        radius = 0.0 if radius is None else radius
+        max_new = z_new.shape[0] if max_new is None else min(max_new, z_new.shape[0])
 
-            # bookkeeping
-            last_item = z_lib[select_idx:select_idx + 1]
-            min_distances[select_idx] = 0
-            coreset_idx.append(select_idx.to("cpu"))
+        projection = self.projection_matrix() if projection is None else projection
+        if projection is not None:
+            projection = projection.to(self.device, torch.float32)
 
-        return torch.stack(coreset_idx)
+        def transform(z):
+            if self.quantized:
+                z = torch.int_repr(z).to(torch.float64)
+            z = z.to(self.device, torch.float32)
+            return z if projection is None else z @ projection.T
+
+        z_new, z_centers = transform(z_new), transform(centers)
+        sq_norms, centers_sq_norms = z_new.pow(2).sum(dim=1), z_centers.pow(2).sum(dim=1)
+        min_distances = torch.cat([
+            self.squared_distances_to(
+                z_new[start:start + chunk_size], sq_norms[start:start + chunk_size], z_centers, centers_sq_norms
+            )
+            for start in range(0, z_new.shape[0], chunk_size)
+        ])
+
+        selected = []
+        squared_radius = radius ** 2 * (1 + radius_rtol)
+        while len(selected) < max_new:
+            idx = torch.argmax(min_distances)
+            if min_distances[idx].item() <= squared_radius:
+                break
+            selected.append(idx)
+            torch.minimum(
+                min_distances, self.squared_distances(z_new, sq_norms, idx.unsqueeze(0)), out=min_distances
+            )
+            min_distances[idx] = 0
+
+        self.radius = max(radius, min_distances.max().sqrt().item())
+        if not selected:
+            return torch.zeros(0, dtype=torch.long)
+        return torch.stack(selected).cpu()
 
     @abstractmethod
     def extract_coreset(self, embeddings: torch.Tensor) -> torch.Tensor:
@@ -0,0 +1,333 @@
+"""Searchable indexes over the PatchCore memory bank.
+
+The exact index wraps a NearestNeighborSearch engine, the approximate ones are
+backed by faiss (IVF-Flat, HNSW and IVF-PQ) and trade recall for speed.
+"""
+
+from __future__ import annotations
+
+import time
+from abc import ABC, abstractmethod
+
+import faiss
+import numpy as np
+import torch
+from torch import Tensor
+
+from .memory_bank_storage import decompress_memory_bank
+from .nearest_neighbor_search import NearestNeighborSearch, ChunkedNearestNeighborSearch
+
+
+class MemoryBankIndex(ABC):
+    """Base class of the memory bank indexes.
+
+    An index is built once from the memory bank and then answers k-NN queries
+    with the same conventions of ``PatchCore.nearest_neighbors``.
+    """
+
+    name: str
+
+    @abstractmethod
+    def build(self, memory_bank: Tensor, scale: Tensor | None = None) -> None:
+        """
+        Build the index on the given memory bank, replacing any previous content.
+
+        Args:
+            memory_bank (Tensor): memory bank of shape (num_entries, emb_dim)
+            scale (Tensor): per-channel scale of an int8 memory bank
+        """
+
+    @abstractmethod
+    def search(self, queries: Tensor, n_neighbors: int) -> tuple[Tensor, Tensor]:
+        """
+        Args:
+            queries (Tensor): query embeddings of shape (num_queries, emb_dim)
+            n_neighbors (int): number of neighbours to return for each query
+
+        Returns:
+            Tensor: euclidean distances of shape (num_queries,) if n_neighbors is 1,
+                (num_queries, n_neighbors) otherwise, on the device of the queries
+            Tensor: memory bank locations of the neighbours, with the same shape
+        """
+
+    def add(self, memory_bank: Tensor, entries: Tensor, scale: Tensor | None = None) -> None:
+        """
+        Add new entries at the end of the built index, without rebuilding it.
+
+        Args:
+            memory_bank (Tensor): memory bank after the insertion, whose last rows are the entries
+            entries (Tensor): new entries of shape (num_new_entries, emb_dim)
+            scale (Tensor): per-channel scale of an int8 memory bank
+        """
+        self.build(memory_bank, scale)
+
+    @property
+    @abstractmethod
+    def size(self) -> int:
+        """Number of memory bank entries in the index, 0 if it is not built."""
+
+    def save(self, path: str) -> None:
+        """Save the index, indexes that are cheap to rebuild do not store anything."""
+
+    def load(self, path: str) -> bool:
+        """
+        Load the index saved by ``save``.
+
+        Returns:
+            bool: False if the index must be rebuilt from the memory bank instead
+        """
+        return False
+
+
+class ExactIndex(MemoryBankIndex):
+    """Exact search over the memory bank with a NearestNeighborSearch engine.
+
+    Args:
+        nn_search (NearestNeighborSearch): search engine, defaults to a ChunkedNearestNeighborSearch
+    """
+
+    name = "exact"
+
+    def __init__(self, nn_search: NearestNeighborSearch | None = None) -> None:
+        self.nn_search = nn_search if nn_search is not None else ChunkedNearestNeighborSearch()
+        self.memory_bank: Tensor | None = None
+        self.scale: Tensor | None = None
+
+    def build(self, memory_bank: Tensor, scale: Tensor | None = None) -> None:
+        self.memory_bank, self.scale = memory_bank, scale
+
+    def search(self, queries: Tensor, n_neighbors: int) -> tuple[Tensor, Tensor]:
+        assert self.memory_bank is not None, "The index must be built first."
+        distances, locations = self.nn_search.search(queries, self.memory_bank, n_neighbors, scale=self.scale)
+        return distances.to(queries.device), locations.to(queries.device)
+
+    def add(self, memory_bank: Tensor, entries: Tensor, scale: Tensor | None = None) -> None:
+        self.memory_bank, self.scale = memory_bank, scale
+
+    @property
+    def size(self) -> int:
+        return 0 if self.memory_bank is None else self.memory_bank.shape[0]
+
+
+class FaissIndex(MemoryBankIndex):
+    """Common logic of the faiss backed indexes, which always live on the CPU."""
+
+    def __init__(self) -> None:
+        self.index: faiss.Index | None = None
+
+    @abstractmethod
+    def create_index(self, memory_bank: np.ndarray) -> faiss.Index:
+        """Create the untrained faiss index for the given memory bank."""
+
+    def apply_search_params(self) -> None:
+        """Set the search time parameters on the faiss index."""
+
+    def apply_exhaustive_search_params(self) -> None:
+        """Set search time parameters visiting the whole index, to find the neighbours the search missed."""
+
+    @staticmethod
+    def to_numpy(x: Tensor, scale: Tensor | None = None) -> np.ndarray:
+        x = decompress_memory_bank(x.detach().cpu(), scale)
+        return np.ascontiguousarray(x.numpy(), dtype=np.float32)
+
+    def build(self, memory_bank: Tensor, scale: Tensor | None = None) -> None:
+        x = self.to_numpy(memory_bank, scale)
+        self.index = self.create_index(x)
+        if not self.index.is_trained:
+            self.index.train(x)
+        self.index.add(x)
+
+    def add(self, memory_bank: Tensor, entries: Tensor, scale: Tensor | None = None) -> None:
+        # the trained quantizers are kept, new entries are assigned to the existing cells
+        assert self.index is not None, "The index must be built first."
+        self.index.add(self.to_numpy(entries, scale))
+
+    def search(self, queries: Tensor, n_neighbors: int) -> tuple[Tensor, Tensor]:
+        assert self.index is not None, "The index must be built first."
+        if n_neighbors > self.index.ntotal:
+            raise ValueError(f"Cannot search {n_neighbors} neighbors in an index of {self.index.ntotal} entries")
+        self.apply_search_params()
+
+        # faiss returns squared L2 distances, and -1 locations when fewer than
+        # n_neighbors entries are found in the visited cells: those queries are searched
+        # again over the whole index, as PatchCore reads the memory bank at the locations
+        x = self.to_numpy(queries)
+        distances, locations = self.index.search(x, n_neighbors)
+        missing = (locations < 0).any(axis=1)
+        if missing.any():
+            self.apply_exhaustive_search_params()
+            distances[missing], locations[missing] = self.index.search(np.ascontiguousarray(x[missing]), n_neighbors)
+            if (locations < 0).any():
+                raise RuntimeError(f"The {self.name} index found fewer than {n_neighbors} neighbours of some queries")
+
+        distances = torch.from_numpy(distances).clamp_(min=0).sqrt_().to(queries.device)
+        locations = torch.from_numpy(locations).to(queries.device)
+
+        if n_neighbors == 1:
+            return distances.squeeze(1), locations.squeeze(1)
+        return distances, locations
+
+    @property
+    def size(self) -> int:
+        return 0 if self.index is None else self.index.ntotal
+
+    def save(self, path: str) -> None:
+        assert self.index is not None, "The index must be built first."
+        faiss.write_index(self.index, path)
+
+    def load(self, path: str) -> bool:
+        self.index = faiss.read_index(path)
+        return True
+
+
+class IVFFlatIndex(FaissIndex):
+    """Inverted file index storing the full vectors in each cell.
+
+    Args:
+        nlist (int): number of cells, clipped so that every cell gets enough training points
+        nprobe (int): number of cells visited at search time
+    """
+
+    name = "ivf_flat"
+
+    def __init__(self, nlist: int = 1024, nprobe: int = 8) -> None:
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+    def create_index(self, memory_bank: np.ndarray) -> faiss.Index:
+        n, d = memory_bank.shape
+        # faiss needs at least 39 training points per centroid to train reliably
+        nlist = max(1, min(self.nlist, n // 39))
+        return faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, nlist, faiss.METRIC_L2)
+
+    def apply_search_params(self) -> None:
+        faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+
+    def apply_exhaustive_search_params(self) -> None:
+        ivf = faiss.extract_index_ivf(self.index)
+        ivf.nprobe = ivf.nlist
+
+
+class HNSWIndex(FaissIndex):
+    """Hierarchical navigable small world graph.
+
+    Args:
+        m (int): number of neighbours of each node in the graph
+        ef_construction (int): size of the candidate list while building the graph
+        ef_search (int): size of the candidate list at search time
+    """
+
+    name = "hnsw"
+
+    def __init__(self, m: int = 32, ef_construction: int = 200, ef_search: int = 64) -> None:
+        super().__init__()
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+
+    def create_index(self, memory_bank: np.ndarray) -> faiss.Index:
+        index = faiss.IndexHNSWFlat(memory_bank.shape[1], self.m, faiss.METRIC_L2)
+        index.hnsw.efConstruction = self.ef_construction
+        return index
+
+    def apply_search_params(self) -> None:
+        self.index.hnsw.efSearch = self.ef_search
+
+    def apply_exhaustive_search_params(self) -> None:
+        self.index.hnsw.efSearch = max(self.ef_search, self.index.ntotal)
+
+
+class IVFPQIndex(FaissIndex):
+    """Inverted file index storing product quantized vectors in each cell.
+
+    Args:
+        nlist (int): number of cells, clipped so that every cell gets enough training points
+        m (int): number of subquantizers, lowered to the closest divisor of the embedding size
+        nbits (int): bits of each subquantizer code, lowered when there are too few training points
+        nprobe (int): number of cells visited at search time
+    """
+
+    name = "ivf_pq"
+
+    def __init__(self, nlist: int = 1024, m: int = 16, nbits: int = 8, nprobe: int = 8) -> None:
+        super().__init__()
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+
+    def create_index(self, memory_bank: np.ndarray) -> faiss.Index:
+        n, d = memory_bank.shape
+        nlist = max(1, min(self.nlist, n // 39))
+        m = max(divisor for divisor in range(1, min(self.m, d) + 1) if d % divisor == 0)
+        nbits = max(1, min(self.nbits, int(np.log2(max(2, n // 39)))))
+        return faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, m, nbits)
+
+    def apply_search_params(self) -> None:
+        faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+
+    def apply_exhaustive_search_params(self) -> None:
+        ivf = faiss.extract_index_ivf(self.index)
+        ivf.nprobe = ivf.nlist
+
+
+MEMORY_BANK_INDEXES = {
+    index_class.name: index_class for index_class in (ExactIndex, IVFFlatIndex, HNSWIndex, IVFPQIndex)
+}
+
+
+def build_memory_bank_index(name: str, **params) -> MemoryBankIndex:
+    """
+    Instantiate a memory bank index by name.
+
+    Args:
+        name (str): one of 'exact', 'ivf_flat', 'hnsw', 'ivf_pq'
+        params: build and search parameters of the chosen index
+
+    Returns:
+        MemoryBankIndex: the index, still to be built
+    """
+    if name not in MEMORY_BANK_INDEXES:
+        raise ValueError(f"Unknown memory bank index {name}, choose one of {list(MEMORY_BANK_INDEXES)}")
+    return MEMORY_BANK_INDEXES[name](**params)
+
+
+def compute_index_recall(
+    index: MemoryBankIndex, memory_bank: Tensor, queries: Tensor, scale: Tensor | None = None
+) -> dict:
+    """
+    Compare a built index against the exact search on the same memory bank.
+
+    Args:
+        index (MemoryBankIndex): index built on memory_bank
+        memory_bank (Tensor): memory bank of shape (num_entries, emb_dim)
+        queries (Tensor): query embeddings of shape (num_queries, emb_dim)
+        scale (Tensor): per-channel scale of an int8 memory bank, the one the index was built with
+
+    Returns:
+        dict: recall@1 of the index, mean relative error of its nearest neighbour
+            distances (the PatchCore patch scores), and the search time per query
+            of both the index and the exact search in milliseconds
+    """
+    exact = ExactIndex()
+    exact.build(memory_bank, scale)
+
+    start = time.perf_counter()
+    exact_scores, exact_locations = exact.search(queries, n_neighbors=1)
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores, locations = index.search(queries, n_neighbors=1)
+    index_time = time.perf_counter() - start
+
+    scores, locations = scores.to(exact_scores.device), locations.to(exact_locations.device)
+    relative_error = (scores - exact_scores).abs() / exact_scores.clamp(min=1e-12)
+
+    return {
+        "index": index.name,
+        "recall@1": (locations == exact_locations).float().mean().item(),
+        "score_relative_error": relative_error.mean().item(),
+        "exact_ms_per_query": 1000 * exact_time / len(queries),
+        "index_ms_per_query": 1000 * index_time / len(queries),
+    }
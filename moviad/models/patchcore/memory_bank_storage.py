@@ -0,0 +1,78 @@
+"""Compact storage types of the PatchCore memory bank.
+
+The memory bank can be held as float16, bfloat16 or int8 with one scale per channel.
+The search engines read it tile by tile and accumulate the distances in float32,
+so a dequantized copy of the whole memory bank is never materialized.
+"""
+
+from __future__ import annotations
+
+import torch
+from torch import Tensor
+
+MEMORY_BANK_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+
+def memory_bank_dtype_name(dtype: torch.dtype) -> str:
+    """Name of a memory bank storage type, the inverse of MEMORY_BANK_DTYPES."""
+    for name, storage_dtype in MEMORY_BANK_DTYPES.items():
+        if storage_dtype == dtype:
+            return name
+    return str(dtype).replace("torch.", "")
+
+
+def compute_dtype(dtype: torch.dtype) -> torch.dtype:
+    """Type in which the distances against a memory bank stored as dtype are accumulated."""
+    return torch.float32 if dtype in (torch.float16, torch.bfloat16, torch.int8) else dtype
+
+
+def compress_memory_bank(
+    memory_bank: Tensor, dtype: str, scale: Tensor | None = None
+) -> tuple[Tensor, Tensor | None]:
+    """
+    Convert a float memory bank to a compact storage type.
+
+    Args:
+        memory_bank (Tensor): memory bank of shape (num_entries, emb_dim)
+        dtype (str): one of 'float32', 'float16', 'bfloat16', 'int8'
+        scale (Tensor): per-channel int8 scale to reuse, e.g. to append entries to an
+            existing memory bank, computed from the memory bank if None
+
+    Returns:
+        Tensor: the converted memory bank
+        Tensor: per-channel scale of shape (emb_dim,) for int8, None otherwise
+    """
+    if dtype not in MEMORY_BANK_DTYPES:
+        raise ValueError(f"Unknown memory bank type {dtype}, choose one of {list(MEMORY_BANK_DTYPES)}")
+
+    if dtype != "int8":
+        return memory_bank.to(MEMORY_BANK_DTYPES[dtype]), None
+
+    memory_bank = memory_bank.to(torch.float32)
+    if scale is None:
+        scale = memory_bank.abs().amax(dim=0).clamp_(min=1e-12) / 127
+    scale = scale.to(memory_bank.device)
+    codes = torch.round(memory_bank / scale).clamp_(-127, 127).to(torch.int8)
+    return codes, scale
+
+
+def decompress_memory_bank(memory_bank: Tensor, scale: Tensor | None = None) -> Tensor:
+    """
+    Convert memory bank entries back to float, with their per-channel scale if any.
+
+    Args:
+        memory_bank (Tensor): entries of shape (..., emb_dim)
+        scale (Tensor): per-channel scale of shape (emb_dim,), or None
+
+    Returns:
+        Tensor: the entries in their compute type
+    """
+    entries = memory_bank.to(compute_dtype(memory_bank.dtype))
+    if scale is not None and scale.numel():
+        entries = entries * scale.to(entries.device)
+    return entries
@@ -0,0 +1,360 @@
+"""Nearest neighbour search engines for the PatchCore memory bank."""
+
+from __future__ import annotations
+
+import os
+from abc import abstractmethod
+
+import torch
+import torch.multiprocessing as mp
+from torch import Tensor
+
+from .memory_bank_storage import compute_dtype, decompress_memory_bank
+
+# extra candidates kept by the matmul-based searches, so that the neighbours swapped by
+# their rounding errors are still among the candidates re-ranked with exact distances
+RERANK_MARGIN = 8
+
+
+def num_candidates(n_neighbors: int, num_entries: int) -> int:
+    """Number of candidate neighbours to re-rank to find n_neighbors exact ones."""
+    return min(num_entries, n_neighbors + RERANK_MARGIN)
+
+
+def rerank_exact(
+    queries: Tensor, memory_bank: Tensor, candidates: Tensor, n_neighbors: int,
+    scale: Tensor | None = None, max_bytes: int = 256 * 1024**2,
+) -> tuple[Tensor, Tensor]:
+    """
+    Re-rank candidate neighbours by their exact squared distances, summed from (a - b)^2,
+    and keep the n_neighbors nearest. Ties are broken by the lowest memory bank location,
+    so the result does not depend on the order of the candidates.
+
+    Args:
+        queries (Tensor): query embeddings of shape (num_queries, emb_dim)
+        memory_bank (Tensor): memory bank of shape (num_entries, emb_dim), possibly compact
+        candidates (Tensor): distinct candidate locations of shape (num_queries, num_candidates)
+        n_neighbors (int): number of neighbours to keep for each query
+        scale (Tensor): per-channel scale of an int8 memory bank
+        max_bytes (int): upper bound, in bytes, of the gathered candidate entries
+
+    Returns:
+        Tensor: squared distances of shape (num_queries, n_neighbors), in ascending order
+        Tensor: memory bank locations of the neighbours, with the same shape
+    """
+    candidates, _ = candidates.to(memory_bank.device).sort(dim=1)
+    dtype = compute_dtype(memory_bank.dtype)
+    queries = queries.to(device=memory_bank.device, dtype=dtype)
+    rows = max(1, max_bytes // (candidates.shape[1] * memory_bank.shape[1] * torch.finfo(dtype).bits // 8))
+
+    distances, locations = [], []
+    for start in range(0, candidates.shape[0], rows):
+        chunk = candidates[start:start + rows]
+        entries = decompress_memory_bank(memory_bank[chunk.flatten()], scale).view(*chunk.shape, -1)
+        chunk_distances = (entries - queries[start:start + rows].unsqueeze(1)).pow_(2).sum(dim=2)
+        # a stable sort of candidates sorted by location breaks the ties by location
+        chunk_distances, order = chunk_distances.sort(dim=1, stable=True)
+        distances.append(chunk_distances[:, :n_neighbors])
+        locations.append(chunk.gather(1, order[:, :n_neighbors]))
+    return torch.cat(distances), torch.cat(locations)
+
+
+class NearestNeighborSearch:
+    """Base class of the k-NN search engines used to score patches against a memory bank.
+
+    A search engine receives the query embeddings and the memory bank at every call,
+    so it can be shared between models and it always reflects the current memory bank.
+    """
+
+    @abstractmethod
+    def search(
+        self, queries: Tensor, memory_bank: Tensor, n_neighbors: int, scale: Tensor | None = None
+    ) -> tuple[Tensor, Tensor]:
+        """
+        Find the nearest neighbours of the queries in the memory bank.
+
+        Args:
+            queries (Tensor): query embeddings of shape (num_queries, emb_dim)
+            memory_bank (Tensor): memory bank of shape (num_entries, emb_dim), possibly
+                stored as float16, bfloat16 or int8
+            n_neighbors (int): number of neighbours to return for each query
+            scale (Tensor): per-channel scale of an int8 memory bank, of shape (emb_dim,)
+
+        Returns:
+            Tensor: euclidean distances of shape (num_queries,) if n_neighbors is 1,
+                (num_queries, n_neighbors) otherwise, sorted in ascending order
+            Tensor: memory bank locations of the neighbours, with the same shape
+        """
+
+
+class BruteForceNearestNeighborSearch(NearestNeighborSearch):
+    """Compute the full distance matrix between the queries and the memory bank with ``torch.cdist``.
+
+    ``torch.cdist`` uses the matmul expansion on large inputs, so its nearest candidates
+    are re-ranked with exact distances, as in the other engines.
+    """
+
+    def search(
+        self, queries: Tensor, memory_bank: Tensor, n_neighbors: int, scale: Tensor | None = None
+    ) -> tuple[Tensor, Tensor]:
+        memory_bank = decompress_memory_bank(memory_bank, scale)
+        queries = queries.to(device=memory_bank.device, dtype=memory_bank.dtype)
+        distances = torch.cdist(queries, memory_bank)
+
+        _, candidates = distances.topk(k=num_candidates(n_neighbors, memory_bank.shape[0]), largest=False, dim=1)
+        del distances
+        distances, locations = rerank_exact(queries, memory_bank, candidates, n_neighbors)
+        distances.sqrt_()
+        if n_neighbors == 1:
+            return distances.squeeze(1), locations.squeeze(1)
+        return distances, locations
+
+
+class ChunkedNearestNeighborSearch(NearestNeighborSearch):
+    """Memory-bounded exact k-NN search.
+
+    The queries and the memory bank are split in tiles whose distance matrix fits in
+    ``max_bytes``. The squared distances of a tile are computed with a single matmul
+    using the expansion ||a||^2 + ||b||^2 - 2ab, with the squared norms of the memory
+    bank cached between calls, and a running top-k is merged across the memory bank tiles.
+    The expansion can swap near-tied neighbours, so a few more candidates than n_neighbors
+    are kept and re-ranked with exact distances: the results match the brute force search.
+
+    Compact memory banks are converted to float32 one tile at a time. The per-channel
+    scale of an int8 memory bank is applied to the queries instead of the memory bank,
+    as ||q - s*c||^2 = ||q||^2 + ||s*c||^2 - 2(s*q)c.
+
+    Args:
+        max_bytes (int): upper bound, in bytes, of the temporary buffers allocated for a tile
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2) -> None:
+        if max_bytes <= 0:
+            raise ValueError(f"max_bytes must be positive, got {max_bytes}")
+        self.max_bytes = max_bytes
+        self._cached_bank: Tensor | None = None
+        self._cached_bank_version: int | None = None
+        self._cached_scale: Tensor | None = None
+        self._cached_norms: Tensor | None = None
+
+    def bank_squared_norms(self, memory_bank: Tensor, scale: Tensor | None = None) -> Tensor:
+        """
+        Return the squared norms of the memory bank entries, computing them only
+        when the memory bank changed since the previous call.
+        """
+        if (
+            self._cached_bank is not memory_bank
+            or self._cached_bank_version != memory_bank._version
+            or self._cached_scale is not scale
+        ):
+            dtype = compute_dtype(memory_bank.dtype)
+            chunk = max(1, self.max_bytes // (memory_bank.shape[1] * torch.finfo(dtype).bits // 8))
+            self._cached_norms = torch.cat([
+                decompress_memory_bank(memory_bank[start:start + chunk], scale).pow(2).sum(dim=1)
+                for start in range(0, memory_bank.shape[0], chunk)
+            ])
+            self._cached_bank = memory_bank
+            self._cached_bank_version = memory_bank._version
+            self._cached_scale = scale
+        return self._cached_norms
+
+    def tile_sizes(
+        self, num_queries: int, num_entries: int, n_neighbors: int, element_size: int, emb_dim: int = 0
+    ) -> tuple[int, int]:
+        """
+        Compute the number of queries and memory bank entries of a tile.
+
+        A tile allocates its distance matrix, plus the buffer used to merge it with the
+        running top-k, so both are accounted for in the budget. Whole memory bank rows
+        are preferred, the memory bank is tiled only when a single row does not fit.
+        When the memory bank is converted tile by tile, emb_dim is the number of
+        elements of the converted copy of each memory bank entry.
+
+        Returns:
+            tuple[int, int]: queries per tile, memory bank entries per tile
+        """
+        budget = max(1, self.max_bytes // (2 * element_size))
+        bank_tile = min(num_entries, max(1, budget - n_neighbors))
+        if emb_dim:
+            bank_tile = min(bank_tile, max(1, budget // emb_dim))
+        query_tile = min(num_queries, max(1, budget // (bank_tile + n_neighbors)))
+        return query_tile, bank_tile
+
+    def search(
+        self, queries: Tensor, memory_bank: Tensor, n_neighbors: int, scale: Tensor | None = None
+    ) -> tuple[Tensor, Tensor]:
+        num_queries, num_entries = queries.shape[0], memory_bank.shape[0]
+        if n_neighbors > num_entries:
+            raise ValueError(f"Cannot search {n_neighbors} neighbors in a memory bank of {num_entries} entries")
+
+        dtype = compute_dtype(memory_bank.dtype)
+        convert = dtype != memory_bank.dtype
+        if scale is not None and not scale.numel():
+            scale = None
+
+        queries = queries.to(device=memory_bank.device, dtype=dtype)
+        scaled_queries = queries if scale is None else queries * scale.to(queries)
+        bank_norms = self.bank_squared_norms(memory_bank, scale)
+        candidates = num_candidates(n_neighbors, num_entries)
+        query_tile, bank_tile = self.tile_sizes(
+            num_queries, num_entries, candidates, torch.finfo(dtype).bits // 8,
+            emb_dim=memory_bank.shape[1] if convert else 0,
+        )
+
+        distances = torch.empty((num_queries, n_neighbors), dtype=dtype, device=memory_bank.device)
+        locations = torch.empty((num_queries, n_neighbors), dtype=torch.long, device=memory_bank.device)
+
+        for q_start in range(0, num_queries, query_tile):
+            query = scaled_queries[q_start:q_start + query_tile]
+            query_norms = queries[q_start:q_start + query_tile].pow(2).sum(dim=1, keepdim=True)
+            best_distances, best_locations = None, None
+
+            for b_start in range(0, num_entries, bank_tile):
+                bank = memory_bank[b_start:b_start + bank_tile]
+                if convert:
+                    bank = bank.to(dtype)
+                # ||a||^2 + ||b||^2 - 2ab, computed in place on the matmul output
+                tile = torch.addmm(
+                    bank_norms[b_start:b_start + bank_tile].unsqueeze(0), query, bank.T, beta=1, alpha=-2
+                )
+                tile.add_(query_norms).clamp_(min=0)
+
+                tile_distances, tile_locations = tile.topk(
+                    k=min(candidates, tile.shape[1]), largest=False, dim=1
+                )
+                tile_locations += b_start
+                del tile
+
+                if best_distances is not None:
+                    tile_distances = torch.cat([best_distances, tile_distances], dim=1)
+                    tile_locations = torch.cat([best_locations, tile_locations], dim=1)
+                    tile_distances, merged = tile_distances.topk(
+                        k=min(candidates, tile_distances.shape[1]), largest=False, dim=1
+                    )
+                    tile_locations = tile_locations.gather(1, merged)
+                best_distances, best_locations = tile_distances, tile_locations
+
+            distances[q_start:q_start + query_tile], locations[q_start:q_start + query_tile] = rerank_exact(
+                queries[q_start:q_start + query_tile], memory_bank, best_locations, n_neighbors,
+                scale=scale, max_bytes=self.max_bytes,
+            )
+
+        distances.sqrt_()
+        if n_neighbors == 1:
+            return distances.squeeze(1), locations.squeeze(1)
+        return distances, locations
+
+
+# state of the worker processes of ShardedNearestNeighborSearch, set by the pool initializer
+_worker_shards: list[Tensor] = []
+_worker_scale: Tensor | None = None
+_worker_searches: list[ChunkedNearestNeighborSearch] = []
+
+
+def _init_shard_worker(shards: list[Tensor], scale: Tensor | None, max_bytes: int, num_threads: int) -> None:
+    global _worker_shards, _worker_scale, _worker_searches
+    torch.set_num_threads(num_threads)
+    _worker_shards, _worker_scale = shards, scale
+    _worker_searches = [ChunkedNearestNeighborSearch(max_bytes) for _ in shards]
+
+
+def _search_shard(shard_id: int, queries: Tensor, n_neighbors: int) -> tuple[Tensor, Tensor]:
+    shard = _worker_shards[shard_id]
+    n_neighbors = min(n_neighbors, shard.shape[0])
+    distances, locations = _worker_searches[shard_id].search(queries, shard, n_neighbors, scale=_worker_scale)
+    return distances.reshape(queries.shape[0], -1), locations.reshape(queries.shape[0], -1)
+
+
+class ShardedNearestNeighborSearch(NearestNeighborSearch):
+    """Exact k-NN search split across CPU worker processes.
+
+    The memory bank is moved to shared memory and split in one contiguous shard per
+    worker, so it is never copied. Every worker searches its shard with a
+    ChunkedNearestNeighborSearch, and the local top-k are merged in the calling process,
+    where they are re-ranked with exact distances.
+    The pool is started at the first search and restarted only when the memory bank changes.
+
+    Args:
+        num_workers (int): number of worker processes, defaults to the number of CPU cores
+        max_bytes (int): memory budget of the tiles of each worker
+        threads_per_worker (int): number of torch threads of each worker
+    """
+
+    def __init__(
+        self, num_workers: int | None = None, max_bytes: int = 256 * 1024**2, threads_per_worker: int = 1
+    ) -> None:
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        if self.num_workers <= 0:
+            raise ValueError(f"num_workers must be positive, got {self.num_workers}")
+        self.max_bytes = max_bytes
+        self.threads_per_worker = threads_per_worker
+        self.pool = None
+        self.offsets: list[int] = []
+        self._bank: Tensor | None = None
+        self._bank_version: int | None = None
+        self._scale: Tensor | None = None
+
+    def start(self, memory_bank: Tensor, scale: Tensor | None = None) -> None:
+        """Split the memory bank in shared memory shards and start the worker pool on them."""
+        self.close()
+
+        bank = memory_bank.detach().cpu()
+        if not bank.is_shared():
+            bank.share_memory_()
+        shared_scale = scale.detach().cpu().share_memory_() if scale is not None else None
+
+        shards = [shard for shard in bank.tensor_split(self.num_workers) if shard.shape[0]]
+        self.offsets = [0]
+        for shard in shards[:-1]:
+            self.offsets.append(self.offsets[-1] + shard.shape[0])
+
+        context = mp.get_context("spawn")
+        self.pool = context.Pool(
+            len(shards),
+            initializer=_init_shard_worker,
+            initargs=(shards, shared_scale, self.max_bytes, self.threads_per_worker),
+        )
+        self._bank, self._bank_version, self._scale = memory_bank, memory_bank._version, scale
+
+    def close(self) -> None:
+        """Stop the worker pool."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self._bank = None
+
+    def __del__(self) -> None:
+        self.close()
+
+    def search(
+        self, queries: Tensor, memory_bank: Tensor, n_neighbors: int, scale: Tensor | None = None
+    ) -> tuple[Tensor, Tensor]:
+        num_entries = memory_bank.shape[0]
+        if n_neighbors > num_entries:
+            raise ValueError(f"Cannot search {n_neighbors} neighbors in a memory bank of {num_entries} entries")
+        if scale is not None and not scale.numel():
+            scale = None
+
+        if self._bank is not memory_bank or self._bank_version != memory_bank._version or self._scale is not scale:
+            self.start(memory_bank, scale)
+
+        cpu_queries = queries.detach().to("cpu", compute_dtype(memory_bank.dtype))
+        results = self.pool.starmap(
+            _search_shard, [(shard_id, cpu_queries, n_neighbors) for shard_id in range(len(self.offsets))]
+        )
+
+        # merge the local top-k of the shards, shifting the locations by the shard offsets, and
+        # rank them again with exact distances so that the ties are broken as in the other engines
+        candidates = torch.cat(
+            [shard_locations + offset for (_, shard_locations), offset in zip(results, self.offsets)], dim=1
+        )
+        distances, locations = rerank_exact(
+            queries, memory_bank, candidates, n_neighbors, scale=scale, max_bytes=self.max_bytes
+        )
+        distances.sqrt_()
+
+        distances, locations = distances.to(queries.device), locations.to(queries.device)
+        if n_neighbors == 1:
+            return distances.squeeze(1), locations.squeeze(1)
+        return distances, locations
@@ -5,6 +5,7 @@
 
 from __future__ import annotations
 import os
+import weakref
 
 import cv2 as cv
 import matplotlib.pyplot as plt
@@ -15,8 +16,12 @@ import torch.nn.functional as F
 from torch import Tensor, nn
 
 from .product_quantizer import ProductQuantizer
+from .nearest_neighbor_search import NearestNeighborSearch, ChunkedNearestNeighborSearch
+from .memory_bank_index import MemoryBankIndex
+from .memory_bank_storage import compress_memory_bank, decompress_memory_bank, memory_bank_dtype_name
 from ...models.patchcore.anomaly_map import AnomalyMapGenerator
 from ...utilities.custom_feature_extractor_trimmed import CustomFeatureExtractor
+from ...utilities.feature_cache import FeatureCache
 from ...utilities.get_sizes import *
 
 class PatchCore(nn.Module):
@@ -29,7 +34,13 @@ class PatchCore(nn.Module):
         feature_extractor: CustomFeatureExtractor,
         num_neighbors: int = 9,
         apply_quantization: bool = False,
-        k: int = 10000
+        k: int = 10000,
+        nn_search: NearestNeighborSearch | None = None,
+        memory_bank_index: MemoryBankIndex | None = None,
+        anomaly_map_generator: AnomalyMapGenerator | None = None,
+        compute_anomaly_maps: bool = True,
+        memory_bank_dtype: str = "float32",
+        feature_cache: FeatureCache | None = None,
     ) -> None:
 
         """
@@ -40,6 +51,19 @@ class PatchCore(nn.Module):
             input_size (tuple[int]): size of the input images
             feature_extractor (CustomFeatureExtractor): feature extractor to be used 
             num_neighbors (int): number of neighbors to be considered in the k-nn search
+            nn_search (NearestNeighborSearch): engine used for the k-nn search against the memory bank,
+                defaults to a ChunkedNearestNeighborSearch with its default memory budget
+            memory_bank_index (MemoryBankIndex): index used to score the patches against the memory bank,
+                when None the nn_search engine is used directly on the memory bank
+            anomaly_map_generator (AnomalyMapGenerator): generator of the anomaly maps from the patch scores,
+                defaults to a batch normalized AnomalyMapGenerator blurring at full resolution
+            compute_anomaly_maps (bool): when False the anomaly maps are skipped at test time and
+                None is returned in their place, for deployments that only need the image scores
+            memory_bank_dtype (str): storage type of the memory bank, one of 'float32', 'float16',
+                'bfloat16' and 'int8' with a per-channel scale. The distances are always accumulated
+                in float32. Ignored when the memory bank is product quantized
+            feature_cache (FeatureCache): on-disk cache of the embeddings of the input images, so that
+                runs sharing the backbone configuration extract the features only once
         """
 
         super().__init__()
@@ -50,11 +74,30 @@ class PatchCore(nn.Module):
 
         self.feature_extractor = feature_extractor
         self.feature_pooler = torch.nn.AvgPool2d(3,1,1)
-        self.anomaly_map_generator = AnomalyMapGenerator()
+        self.anomaly_map_generator = anomaly_map_generator if anomaly_map_generator is not None else AnomalyMapGenerator()
+        self.compute_anomaly_maps = compute_anomaly_maps
         self.k = k
         self.register_buffer("memory_bank", Tensor())
         self.memory_bank: Tensor
+        # per-channel scale of an int8 memory bank, empty for the other storage types
+        self.register_buffer("memory_bank_scale", Tensor())
+        self.memory_bank_scale: Tensor
+        self.memory_bank_dtype = memory_bank_dtype
+        # radius of the k-center greedy coverage of the training patches, used to extend the memory bank
+        self.register_buffer("coverage_radius", torch.tensor(0.0))
+        self.coverage_radius: Tensor
+        # random projection the coverage radius was measured with, empty if the patches were not projected
+        self.register_buffer("coverage_projection", Tensor())
+        self.coverage_projection: Tensor
         self.apply_quantization = apply_quantization
+        self.nn_search = nn_search if nn_search is not None else ChunkedNearestNeighborSearch()
+        self.memory_bank_index = memory_bank_index
+        # memory bank tensor, and its version, the memory bank index was built on
+        self._indexed_memory_bank: weakref.ref | None = None
+        self._indexed_memory_bank_version: int | None = None
+        self.feature_cache = feature_cache
+        # fingerprint of the backbone weights, with the versions of the tensors it was computed on
+        self._weights_fingerprint: tuple[tuple, str] | None = None
         if apply_quantization:
             self.product_quantizer = ProductQuantizer()
 
@@ -90,30 +133,13 @@ class PatchCore(nn.Module):
                 anomaly map and anomaly score for testing.
         """
 
-        #extract the features for the input tensor
         self.memory_bank.to(self.device)
-        with torch.no_grad():
-            features = self.feature_extractor(input_tensor.to(self.device))
-
-        #concatenate the embeddings
-        if isinstance(features, dict):
-            features = list(features.values())
-
-        # Apply smoothing (3x3 average pooling) to the features.
-        smoothing = torch.nn.AvgPool2d(kernel_size=3, stride=1, padding=1)
-        features  = [smoothing(feature) for feature in features]
-
-        # Compute maximum shape.
-        H_max = max([f.shape[2] for f in features])
-        W_max = max([f.shape[3] for f in features])
-
-        # Create resize function instance.
-        resizer = torch.nn.Upsample(size=(H_max, W_max), mode="nearest")
-
-        # Apply resize function for all input tensors.
-        features = [resizer(f) for f in features]
-
-        embedding =  torch.cat(features, dim=1)
+        if self.feature_cache is not None and not self.feature_extractor.quantized:
+            embedding = self.feature_cache.get_or_compute(
+                self.feature_cache_namespace(input_tensor), input_tensor, self.compute_embedding
+            )
+        else:
+            embedding = self.compute_embedding(input_tensor)
 
         batch_size, _, width, height = embedding.shape
         embedding = self.reshape_embedding(embedding)
@@ -142,16 +168,70 @@ class PatchCore(nn.Module):
             # compute the anomaly score of the images
             pred_scores = self.compute_anomaly_score(patch_scores, locations, embedding)
 
-            # reshape to w,h
-            patch_scores = patch_scores.reshape((batch_size, 1, width, height))
-
             # get the anomaly map
-            anomaly_maps = self.anomaly_map_generator(patch_scores, image_size = self.input_size)
+            anomaly_maps = None
+            if self.compute_anomaly_maps:
+                # reshape to w,h
+                patch_scores = patch_scores.reshape((batch_size, 1, width, height))
+                anomaly_maps = self.anomaly_map_generator(patch_scores, image_size = self.input_size)
 
             output = (anomaly_maps, pred_scores)
 
         return output
 
+    def compute_embedding(self, input_tensor: Tensor) -> Tensor:
+        """
+        Extract the features of the input tensor, smooth them and concatenate them at the largest resolution
+
+        Args:
+            input_tensor (Tensor): Input tensor
+
+        Returns:
+            Tensor: embedding of shape (batch_size, emb_dim, H, W)
+        """
+
+        #extract the features for the input tensor
+        with torch.no_grad():
+            features = self.feature_extractor(input_tensor.to(self.device))
+
+        #concatenate the embeddings
+        if isinstance(features, dict):
+            features = list(features.values())
+
+        # Apply smoothing (3x3 average pooling) to the features.
+        smoothing = torch.nn.AvgPool2d(kernel_size=3, stride=1, padding=1)
+        features  = [smoothing(feature) for feature in features]
+
+        # Compute maximum shape.
+        H_max = max([f.shape[2] for f in features])
+        W_max = max([f.shape[3] for f in features])
+
+        # Create resize function instance.
+        resizer = torch.nn.Upsample(size=(H_max, W_max), mode="nearest")
+
+        # Apply resize function for all input tensors.
+        features = [resizer(f) for f in features]
+
+        return torch.cat(features, dim=1)
+
+    def feature_cache_namespace(self, input_tensor: Tensor) -> str:
+        """Key of the feature cache entries of this backbone configuration, and of its weights"""
+        return FeatureCache.namespace(
+            "patchcore",
+            self.feature_extractor.model_name,
+            [str(layer) for layer in self.feature_extractor.layers_idx],
+            tuple(input_tensor.shape[1:]),
+            self.backbone_weights_fingerprint(),
+        )
+
+    def backbone_weights_fingerprint(self) -> str:
+        """Fingerprint of the backbone weights, hashed again only when a weight tensor changed"""
+        tensors = self.feature_extractor.model.state_dict(keep_vars=True).values()
+        versions = tuple((id(tensor), tensor._version) for tensor in tensors if isinstance(tensor, Tensor))
+        if self._weights_fingerprint is None or self._weights_fingerprint[0] != versions:
+            self._weights_fingerprint = (versions, FeatureCache.weights_fingerprint(self.feature_extractor.model))
+        return self._weights_fingerprint[1]
+
     def generate_embedding(self, features: dict[str, Tensor]) -> Tensor:
         """Generate embedding from hierarchical feature map.
 
@@ -214,32 +294,37 @@ class PatchCore(nn.Module):
 
     def nearest_neighbors(self, embedding: Tensor, n_neighbors: int, memory_bank: torch.Tensor = None) -> tuple[Tensor, Tensor]:
         """
-        Nearest neighbors using brute force method and euclidean norm.
+        Nearest neighbors using euclidean norm, computed by the memory bank index when
+        one is set, or exactly by the nn_search engine.
 
         Args:
             embedding (Tensor): Features to compare the distance with the memory bank.
             n_neighbors (int): Number of neighbors to look at
+            memory_bank (Tensor): memory bank to search, defaults to the model memory bank
 
         Returns:
             Tensor: Patch scores.
             Tensor: Locations of the nearest neighbor(s).
         """
+        scale = None
         if memory_bank is None:
-            memory_bank = self.memory_bank
-
-        distances = PatchCore.euclidean_distance(embedding, memory_bank, quantized=self.feature_extractor.quantized)
+            if self.memory_bank_index is not None:
+                if self.memory_bank_index_is_stale():
+                    self.build_memory_bank_index()
+                return self.memory_bank_index.search(embedding, n_neighbors)
+            memory_bank, scale = self.memory_bank, self.memory_bank_scale
 
-        if n_neighbors == 1:
-            patch_scores, locations = distances.min(1)
-        else:
-            patch_scores, locations = distances.topk(k = n_neighbors, largest = False, dim = 1)
+        if self.feature_extractor.quantized:
+            embedding, memory_bank = embedding.dequantize(), memory_bank.dequantize()
 
-        return patch_scores, locations
+        return self.nn_search.search(embedding, memory_bank, n_neighbors, scale=scale)
 
 
     def nearest_neighbors_quantized(self, embedding: Tensor, n_neighbors: int) -> tuple[Tensor, Tensor]:
         """
-        Nearest neighbors using brute force method and euclidean norm.
+        Nearest neighbors of the embeddings among the product quantized memory bank, using
+        asymmetric distance computation: the distances are looked up in a per-query table of
+        subspace-to-centroid distances, without decoding the memory bank.
 
         Args:
             embedding (Tensor): Features to compare the distance with the memory bank.
@@ -250,33 +335,26 @@ class PatchCore(nn.Module):
             Tensor: Locations of the nearest neighbor(s).
         """
         self.memory_bank = self.memory_bank.to(self.device)
+        return self.product_quantizer.search(embedding.to(self.device), self.memory_bank, n_neighbors)
 
-        # Top 100 nearest neighbors
-        quantized_embedding = self.product_quantizer.encode(embedding)
-        quantized_embedding = quantized_embedding.to(self.device)
-        distances = PatchCore.euclidean_distance(quantized_embedding, self.memory_bank,
-                                                 quantized=self.feature_extractor.quantized)
-
-        # Top 100 nearest neighbors
-        top_100_patch_scores, top_100_locations = distances.topk(k=100, largest=False, dim=1)
-
-        # Decode the top 100 neighbors from the memory bank
-        top_100_neighbors = self.memory_bank[top_100_locations]
-        patch_scores = []
-        locations = []
-        for embedding_index in range(top_100_neighbors.size(0)):
-            neighbours = top_100_neighbors[embedding_index]
-            decoded_neighbors = self.product_quantizer.decode(neighbours)
-            embedding_value = embedding[embedding_index].unsqueeze(0)
-            decoded_neighbors = decoded_neighbors.to(self.device)
-            neighbour_distances = PatchCore.euclidean_distance(embedding_value, decoded_neighbors, quantized=False)
-            top_patch_score, top_location = neighbour_distances.topk(k=n_neighbors, largest=False, dim=1)
-            patch_scores.append(top_patch_score)
-            locations.append(top_location)
-        patch_scores = torch.cat(patch_scores, dim=0).squeeze()
-        locations = torch.cat(locations, dim=0).squeeze()
-        return patch_scores, locations
+    def memory_bank_vectors(self, indices: Tensor) -> Tensor:
+        """
+        Gather the memory bank entries at the given indices, decoding them when the memory bank is product quantized
+        and converting them back to float when it is stored in a compact type.
 
+        Args:
+            indices (Tensor): memory bank locations, of any shape
+
+        Returns:
+            Tensor: the entries, of shape (*indices.shape, emb_dim)
+        """
+        entries = self.memory_bank[indices.flatten()]
+        if self.apply_quantization:
+            assert self.product_quantizer is not None
+            entries = self.product_quantizer.decode(entries).to(self.device)
+        elif not self.feature_extractor.quantized:
+            entries = decompress_memory_bank(entries, self.memory_bank_scale)
+        return entries.reshape(*indices.shape, -1)
 
     def compute_anomaly_score(self, patch_scores: Tensor, locations: Tensor, embedding: Tensor) -> Tensor:
         """
@@ -290,12 +368,6 @@ class PatchCore(nn.Module):
         Returns:
             Tensor: Image-level anomaly scores
         """
-        memory_bank = self.memory_bank
-        if self.apply_quantization:
-            assert self.product_quantizer is not None
-            memory_bank = self.product_quantizer.decode(memory_bank)
-            memory_bank = memory_bank.to(self.device)
-
         # Don't need to compute weights if num_neighbors is 1
         if self.num_neighbors == 1:
             return patch_scores.amax(1)
@@ -311,10 +383,10 @@ class PatchCore(nn.Module):
         nn_index = locations[torch.arange(batch_size), max_patches]  # indices of m^* in the paper
 
         # 3. Find the support samples of the nearest neighbor in the membank
-        nn_sample = memory_bank[nn_index, :]  # m^* in the paper
+        nn_sample = self.memory_bank_vectors(nn_index)  # m^* in the paper
 
         # indices of N_b(m^*) in the paper
-        memory_bank_effective_size = memory_bank.shape[0]  # edge case when memory bank is too small
+        memory_bank_effective_size = self.memory_bank.shape[0]  # edge case when memory bank is too small
         if self.apply_quantization:
             _, support_samples = self.nearest_neighbors_quantized(
                 nn_sample,
@@ -327,7 +399,7 @@ class PatchCore(nn.Module):
             )
 
         # 4. Find the distance of the patch features to each of the support samples
-        distances = PatchCore.euclidean_distance(max_patches_features.unsqueeze(1), memory_bank[support_samples], self.feature_extractor.quantized)
+        distances = PatchCore.euclidean_distance(max_patches_features.unsqueeze(1), self.memory_bank_vectors(support_samples), self.feature_extractor.quantized)
 
         # 5. Apply softmax to find the weights
         weights = (1 - F.softmax(distances.squeeze(1), 1))[..., 0]
@@ -335,9 +407,225 @@ class PatchCore(nn.Module):
         # 6. Apply the weight factor to the score
         return weights * score  # s in the paper
 
+    def set_memory_bank(self, memory_bank: Tensor) -> None:
+        """
+        Replace the memory bank and rebuild the memory bank index on it
+
+        Parameters:
+        ----------
+            memory_bank (Tensor): the new memory bank, of shape (num_entries, emb_dim), converted
+                to memory_bank_dtype unless it is product quantized or already in that type
+        """
+
+        self.memory_bank = self.compress_memory_bank(memory_bank)
+        self.build_memory_bank_index()
+
+    def compress_memory_bank(self, entries: Tensor, scale: Tensor | None = None) -> Tensor:
+        """
+        Convert float entries to the memory bank storage type, updating memory_bank_scale for int8.
+
+        Parameters:
+        ----------
+            entries (Tensor): entries of shape (num_entries, emb_dim)
+            scale (Tensor): int8 scale to reuse, a new one is computed from the entries if None
+
+        Returns:
+            Tensor: the converted entries
+        """
+
+        if self.apply_quantization or self.feature_extractor.quantized or not entries.is_floating_point():
+            return entries
+        if memory_bank_dtype_name(entries.dtype) == self.memory_bank_dtype and self.memory_bank_dtype != "int8":
+            return entries
+
+        entries, entries_scale = compress_memory_bank(entries, self.memory_bank_dtype, scale)
+        self.memory_bank_scale = entries_scale if entries_scale is not None else Tensor().to(entries.device)
+        return entries
+
+    def extend_memory_bank(self, entries: Tensor) -> None:
+        """
+        Append entries to the memory bank and insert them in the memory bank index,
+        which is rebuilt only if it is out of sync with the memory bank
+
+        Parameters:
+        ----------
+            entries (Tensor): the new entries, of shape (num_new_entries, emb_dim),
+                already product quantized when the memory bank is
+        """
+
+        previous_size = self.memory_bank.shape[0]
+        if not previous_size:
+            self.set_memory_bank(entries)
+            return
+        index_in_sync = self.memory_bank_index is not None and not self.memory_bank_index_is_stale()
+
+        # new int8 entries are stored with the scale of the memory bank, and clipped to its range
+        scale = self.memory_bank_scale if self.memory_bank_scale.numel() else None
+        entries = self.compress_memory_bank(entries.to(self.memory_bank.device), scale)
+        entries = entries.to(dtype=self.memory_bank.dtype)
+        self.memory_bank = torch.cat([self.memory_bank, entries])
+
+        if self.memory_bank_index is not None and not self.apply_quantization:
+            if index_in_sync:
+                self.memory_bank_index.add(self.memory_bank, entries, self.memory_bank_scale)
+                self.mark_memory_bank_indexed()
+            else:
+                self.build_memory_bank_index()
+
+    def redundant_memory_bank_entries(self, num_entries: int) -> Tensor:
+        """
+        Select the memory bank entries that are closest to another entry, so that removing
+        them changes the nearest neighbour distances the least. Of two entries that are each
+        other's nearest neighbour only one is selected in a pass, so close pairs are thinned
+        out rather than removed altogether.
+
+        Parameters:
+        ----------
+            num_entries (int): number of entries to select
+
+        Returns:
+            Tensor: locations of the selected entries in the memory bank
+        """
+
+        bank_size = self.memory_bank.shape[0]
+        num_entries = min(num_entries, bank_size - 1)
+        if num_entries <= 0:
+            return torch.zeros(0, dtype=torch.long)
+
+        entries = self.memory_bank_vectors(torch.arange(bank_size, device=self.memory_bank.device))
+        if self.feature_extractor.quantized:
+            entries = entries.dequantize()
+        remaining = torch.arange(bank_size)
+        selected, num_selected = [], 0
+
+        while num_selected < num_entries:
+            # the closest entry of each entry is itself, the second one is its nearest neighbour
+            candidates = entries[remaining.to(entries.device)]
+            distances, locations = self.nn_search.search(candidates, candidates, 2)
+            order = torch.argsort(distances[:, 1]).cpu().tolist()
+            neighbors = locations[:, 1].cpu().tolist()
+
+            removed = set()
+            for position in order:
+                if num_selected + len(removed) == num_entries:
+                    break
+                if neighbors[position] not in removed:
+                    removed.add(position)
+
+            removed = torch.tensor(sorted(removed), dtype=torch.long)
+            selected.append(remaining[removed])
+            num_selected += removed.shape[0]
+            keep = torch.ones(remaining.shape[0], dtype=torch.bool)
+            keep[removed] = False
+            remaining = remaining[keep]
+
+        return torch.cat(selected)
+
+    def evict_memory_bank_entries(self, max_size: int) -> int:
+        """
+        Shrink the memory bank to max_size entries by removing the most redundant ones,
+        and rebuild the memory bank index
+
+        Parameters:
+        ----------
+            max_size (int): maximum number of entries of the memory bank
+
+        Returns:
+            int: number of removed entries
+        """
+
+        excess = self.memory_bank.shape[0] - max_size
+        if excess <= 0:
+            return 0
+
+        keep = torch.ones(self.memory_bank.shape[0], dtype=torch.bool)
+        keep[self.redundant_memory_bank_entries(excess)] = False
+        keep = keep.to(self.memory_bank.device)
+        if self.coverage_radius.item() > 0:
+            # the patches covered by an evicted entry are now covered within the radius plus
+            # the distance of that entry to the kept ones
+            locations = torch.arange(keep.shape[0], device=keep.device)
+            distances, _ = self.nn_search.search(
+                self.coverage_vectors(locations[~keep]), self.coverage_vectors(locations[keep]), 1
+            )
+            self.coverage_radius = self.coverage_radius + distances.max().to(self.coverage_radius.device)
+        self.memory_bank = self.memory_bank[keep]
+        self.build_memory_bank_index()
+        return excess
+
+    def coverage_vectors(self, indices: Tensor) -> Tensor:
+        """
+        Gather the memory bank entries at the given indices in the space the coverage radius is measured in:
+        as float32, projected with the coverage projection if any.
+
+        Args:
+            indices (Tensor): memory bank locations, of shape (n,)
+
+        Returns:
+            Tensor: the entries, of shape (n, projected_dim)
+        """
+        entries = self.memory_bank_vectors(indices)
+        if self.feature_extractor.quantized:
+            entries = entries.dequantize()
+        entries = entries.to(torch.float32)
+        if self.coverage_projection.numel():
+            entries = entries @ self.coverage_projection.to(entries.device, torch.float32).T
+        return entries
+
+    def estimate_coverage_radius(self) -> float:
+        """
+        Estimate the coverage radius of the memory bank when it is unknown, e.g. for the models trained
+        with k-means or saved without one, as the largest distance between an entry and its nearest neighbour
+
+        Returns:
+            float: the estimated radius, 0 if the memory bank holds fewer than two entries
+        """
+
+        bank_size = self.memory_bank.shape[0]
+        if bank_size < 2:
+            return 0.0
+        entries = self.coverage_vectors(torch.arange(bank_size, device=self.memory_bank.device))
+        # the closest entry of each entry is itself, the second one is its nearest neighbour
+        distances, _ = self.nn_search.search(entries, entries, 2)
+        return distances[:, 1].max().item()
+
+    def build_memory_bank_index(self) -> None:
+        """
+        Build the memory bank index, if any, on the current memory bank.
+        Product quantized memory banks store codes and are searched by nearest_neighbors_quantized.
+        """
+
+        if self.memory_bank_index is not None and not self.apply_quantization and self.memory_bank.numel():
+            self.memory_bank_index.build(self.memory_bank, self.memory_bank_scale)
+            self.mark_memory_bank_indexed()
+
+    def mark_memory_bank_indexed(self) -> None:
+        """Record the memory bank tensor, and its version, the memory bank index is in sync with"""
+
+        self._indexed_memory_bank = weakref.ref(self.memory_bank)
+        self._indexed_memory_bank_version = self.memory_bank._version
+
+    def memory_bank_index_is_stale(self) -> bool:
+        """
+        Whether the memory bank index was built on another memory bank: the memory bank buffer
+        was replaced, e.g. moved by PatchCore.to, or modified in place since the index was built
+        """
+
+        indexed = self._indexed_memory_bank() if self._indexed_memory_bank is not None else None
+        return (
+            indexed is not self.memory_bank
+            or self._indexed_memory_bank_version != self.memory_bank._version
+            or self.memory_bank_index.size != self.memory_bank.shape[0]
+        )
+
+    @staticmethod
+    def memory_bank_index_path(checkpoint_path: str) -> str:
+        """Path of the memory bank index saved next to a model checkpoint"""
+        return checkpoint_path + ".index"
+
     def save_model(self, output_path):
         """
-        Save the Patchcore model
+        Save the Patchcore model, and the memory bank index next to it
 
         Parameters:
         ----------
@@ -349,8 +637,22 @@ class PatchCore(nn.Module):
             assert self.product_quantizer is not None
             self.product_quantizer.save(output_path + "/product_quantizer.bin")
         torch.save(model_state_dict, output_path)
+        self.save_memory_bank_index(output_path)
+
+    def save_memory_bank_index(self, checkpoint_path: str) -> None:
+        """
+        Save the memory bank index next to the model checkpoint
 
-    def save_anomaly_map(self, dirpath, anomaly_map, pred_score, filepath, x_type, mask):
+        Parameters:
+        ----------
+            checkpoint_path (str): path of the model checkpoint
+        """
+
+        if self.memory_bank_index is not None and self.memory_bank_index.size:
+            self.memory_bank_index.save(PatchCore.memory_bank_index_path(checkpoint_path))
+
+    def save_anomaly_map(self, dirpath, anomaly_map, pred_score, filepath, x_type, mask, decision=None,
+                         predicted_mask=None):
         """
         Args:
             dirpath     (str)       : Output directory path.
@@ -358,6 +660,8 @@ class PatchCore(nn.Module):
             filepath    (str)       : Path of the input image.
             x_type      (str)       : Anomaly type (e.g. "good", "crack", etc).
             contour     (float)     : Threshold of contour, or None.
+            decision    (bool)      : Whether the image is anomalous at the calibrated threshold, or None.
+            predicted_mask (np.ndarray): Anomalous pixels at the calibrated threshold, or None.
         """
         def min_max_norm(image):
             a_min, a_max = image.min(), image.max()
@@ -380,7 +684,8 @@ class PatchCore(nn.Module):
         output_image = (anomaly_map_norm / 2 + original_image / 2).astype(np.uint8)
 
         # Create a figure and axes
-        fig, axes = plt.subplots(1, 3, figsize=(10, 5))
+        num_axes = 3 if predicted_mask is None else 4
+        fig, axes = plt.subplots(1, num_axes, figsize=(10 * num_axes / 3, 5))
 
         #convert the images to RGB
         original_image = cv.cvtColor(original_image, cv.COLOR_BGR2RGB)
@@ -398,9 +703,18 @@ class PatchCore(nn.Module):
 
         # Display the final image
         axes[2].imshow(output_image)
-        axes[2].set_title(f'Heatmap {pred_score}')
+        if decision is None:
+            axes[2].set_title(f'Heatmap {pred_score}')
+        else:
+            axes[2].set_title(f'Heatmap {pred_score} ({"anomalous" if decision else "normal"})')
         axes[2].axis('off')
 
+        # Display the anomalous pixels at the calibrated threshold
+        if predicted_mask is not None:
+            axes[3].imshow(predicted_mask.squeeze(), cmap ='gray')
+            axes[3].set_title(f'Predicted Mask')
+            axes[3].axis('off')
+
         # Show the plot
         plt.savefig(str(dirpath + f"/{x_type}_{filename}.jpg"))
 
@@ -418,7 +732,7 @@ class PatchCore(nn.Module):
 
         # get MB size and shape
         sizes["memory_bank"] = {
-            "size" : get_tensor_size(self.memory_bank),
+            "size" : get_tensor_size(self.memory_bank) + get_tensor_size(self.memory_bank_scale),
             "type" : str(self.memory_bank.dtype),
             "shape" : self.memory_bank.shape
         }
@@ -439,10 +753,23 @@ class PatchCore(nn.Module):
 
         state_dict = torch.load(path)
 
-        ## TODO: MemoryBank quantization
-
         if "memory_bank" not in state_dict.keys():
             raise RuntimeError("Memory Bank tensor not in model checkpoint")
 
-        # load the memory bank
-        self.memory_bank = state_dict["memory_bank"]
+        # load the memory bank, with the scale of an int8 memory bank, on the model device so that
+        # moving the model there keeps the buffer the memory bank index is marked as built on
+        self.memory_bank = state_dict["memory_bank"].to(self.device)
+        self.memory_bank_scale = state_dict.get("memory_bank_scale", Tensor()).to(self.device)
+        if not self.apply_quantization and (self.memory_bank.is_floating_point() or self.memory_bank_scale.numel()):
+            self.memory_bank_dtype = memory_bank_dtype_name(self.memory_bank.dtype)
+        if "coverage_radius" in state_dict:
+            self.coverage_radius = state_dict["coverage_radius"]
+        self.coverage_projection = state_dict.get("coverage_projection", Tensor())
+
+        # load the memory bank index saved with the checkpoint, or build it
+        if self.memory_bank_index is not None and not self.apply_quantization:
+            index_path = PatchCore.memory_bank_index_path(path)
+            if os.path.exists(index_path) and self.memory_bank_index.load(index_path):
+                self.mark_memory_bank_indexed()
+            else:
+                self.build_memory_bank_index()
@@ -10,9 +10,13 @@ class ProductQuantizer:
     subspaces: int
     centroid_bits: int = 8
 
-    def __init__(self, subspaces = None, centroids_per_subspace: int = 8):
+    def __init__(self, subspaces = None, centroids_per_subspace: int = 8, max_bytes: int = 256 * 1024**2):
         self.centroid_bits = centroids_per_subspace
         self.subspaces = subspaces
+        self.max_bytes = max_bytes
+        self._centroids = None
+        self._cached_codes = None
+        self._cached_unpacked_codes = None
 
     def fit(self, input : Union[torch.Tensor, np.ndarray], dim=1) -> None:
         if isinstance(input, torch.Tensor):
@@ -24,6 +28,7 @@ class ProductQuantizer:
         self.quantizer = faiss.IndexPQ(input.shape[dim], self.subspaces, self.centroid_bits)
         self.quantizer.train(input)
         self.quantizer.add(input)
+        self.reset_cache()
 
     def encode(self, input : Union[torch.Tensor, np.ndarray], dim = 0) -> torch.Tensor:
         if isinstance(input, torch.Tensor):
@@ -87,3 +92,140 @@ class ProductQuantizer:
 
     def load(self, path: str) -> None:
         self.quantizer = faiss.read_index(path)
+        self.reset_cache()
+
+    def reset_cache(self) -> None:
+        self._centroids = None
+        self._cached_codes = None
+        self._cached_unpacked_codes = None
+
+    def centroids(self, device: torch.device = None) -> torch.Tensor:
+        """
+            Centroids of the sub-quantizers
+
+            Returns:
+                centroids: Tensor of shape (subspaces, 2 ** nbits, subspace_dim)
+        """
+        if self._centroids is None:
+            pq = self.quantizer.pq
+            centroids = faiss.vector_to_array(pq.centroids).reshape(pq.M, pq.ksub, pq.dsub)
+            self._centroids = torch.from_numpy(centroids)
+        if device is not None and self._centroids.device != torch.device(device):
+            self._centroids = self._centroids.to(device)
+        return self._centroids
+
+    def unpack_codes(self, codes: torch.Tensor) -> torch.Tensor:
+        """
+            Split the packed codes returned by encode into one centroid index per subspace.
+            The result for the last codes tensor is cached, since it is usually the memory bank.
+
+            Args:
+                codes: Tensor of shape (n, code_size) holding the code bytes
+
+            Returns:
+                indices: LongTensor of shape (n, subspaces)
+        """
+        if self._cached_codes is codes:
+            return self._cached_unpacked_codes
+
+        pq = self.quantizer.pq
+        packed = codes.to(torch.uint8)
+        if pq.nbits == 8:
+            unpacked = packed.long()
+        else:
+            # faiss writes the codes as a little endian bit stream
+            shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+            bits = ((packed.unsqueeze(-1) >> shifts) & 1).reshape(packed.shape[0], -1)
+            bits = bits[:, :pq.M * pq.nbits].reshape(-1, pq.M, pq.nbits).long()
+            unpacked = (bits << torch.arange(pq.nbits, device=packed.device)).sum(-1)
+
+        self._cached_codes, self._cached_unpacked_codes = codes, unpacked
+        return unpacked
+
+    def distance_table(self, queries: torch.Tensor) -> torch.Tensor:
+        """
+            Squared distances between every query sub-vector and the centroids of its subspace.
+
+            Args:
+                queries: Tensor of shape (n_queries, dim)
+
+            Returns:
+                table: Tensor of shape (n_queries, subspaces, 2 ** nbits)
+        """
+        centroids = self.centroids(queries.device)
+        n_subspaces, _, subspace_dim = centroids.shape
+        queries = queries.to(torch.float32).reshape(queries.shape[0], n_subspaces, subspace_dim)
+
+        table = torch.einsum("qmd,mkd->qmk", queries, centroids).mul_(-2)
+        table += queries.pow(2).sum(-1, keepdim=True)
+        table += centroids.pow(2).sum(-1).unsqueeze(0)
+        return table.clamp_(min=0)
+
+    def asymmetric_distances(self, queries: torch.Tensor, codes: torch.Tensor) -> torch.Tensor:
+        """
+            Asymmetric distance computation (ADC): squared distances between the full precision
+            queries and the encoded vectors, summing the distance table entries selected by the codes.
+            They are equal to the squared distances between the queries and the decoded vectors.
+
+            Args:
+                queries: Tensor of shape (n_queries, dim)
+                codes: Tensor of shape (n, code_size) returned by encode
+
+            Returns:
+                distances: Tensor of shape (n_queries, n)
+        """
+        table = self.distance_table(queries)
+        indices = self.unpack_codes(codes).to(queries.device)
+
+        distances = torch.zeros((queries.shape[0], indices.shape[0]), dtype=table.dtype, device=queries.device)
+        for subspace in range(indices.shape[1]):
+            distances += table[:, subspace].index_select(1, indices[:, subspace])
+        return distances
+
+    def search(self, queries: torch.Tensor, codes: torch.Tensor, n_neighbors: int,
+               rerank: int = 0, reference: torch.Tensor = None) -> (torch.Tensor, torch.Tensor):
+        """
+            Nearest neighbors of the queries among the encoded vectors, using ADC.
+            The queries are processed in tiles whose distance matrix fits in max_bytes.
+
+            Args:
+                queries: Tensor of shape (n_queries, dim)
+                codes: Tensor of shape (n, code_size) returned by encode
+                n_neighbors: number of neighbors to return for each query
+                rerank: if greater than n_neighbors, the rerank best ADC candidates are re-ranked
+                    with exact distances against the reference vectors
+                reference: full precision vectors of shape (n, dim) used for re-ranking,
+                    defaults to the decoded codes
+
+            Returns:
+                distances: euclidean distances of shape (n_queries,) if n_neighbors is 1,
+                    (n_queries, n_neighbors) otherwise
+                locations: indices of the neighbors in codes, with the same shape
+        """
+        n_candidates = min(max(n_neighbors, rerank), codes.shape[0])
+        query_tile = max(1, self.max_bytes // (2 * 4 * codes.shape[0]))
+
+        distances, locations = [], []
+        for start in range(0, queries.shape[0], query_tile):
+            query = queries[start:start + query_tile].to(torch.float32)
+            tile_distances, tile_locations = self.asymmetric_distances(query, codes).topk(
+                k=n_candidates, largest=False, dim=1
+            )
+
+            if n_candidates > n_neighbors:
+                if reference is None:
+                    candidates = self.decode(codes[tile_locations.flatten().to(codes.device)])
+                else:
+                    candidates = reference[tile_locations.flatten().to(reference.device)]
+                candidates = candidates.to(query.device, torch.float32).reshape(*tile_locations.shape, -1)
+                tile_distances = (candidates - query.unsqueeze(1)).pow(2).sum(-1)
+                tile_distances, reranked = tile_distances.topk(k=n_neighbors, largest=False, dim=1)
+                tile_locations = tile_locations.gather(1, reranked)
+
+            distances.append(tile_distances.sqrt_())
+            locations.append(tile_locations)
+
+        distances, locations = torch.cat(distances), torch.cat(locations)
+        if n_neighbors == 1:
+            return distances.squeeze(1), locations.squeeze(1)
+        return distances, locations
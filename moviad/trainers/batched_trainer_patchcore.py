@@ -38,9 +38,9 @@ class BatchPatchCoreTrainer(TrainerPatchCore):
                 self.patchore_model.product_quantizer.fit(coreset)
                 coreset = self.patchore_model.product_quantizer.encode(coreset)
 
-            self.patchore_model.memory_bank = coreset
+            self.patchore_model.set_memory_bank(coreset)
 
-            img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = self.evaluator.evaluate(self.patchore_model)
+            img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = self.evaluator.evaluate(self.patchore_model).values()
 
             if self.logger is not None:
                 self.logger.log({
@@ -0,0 +1,130 @@
+import torch
+from sklearn.random_projection import SparseRandomProjection
+from tqdm import tqdm
+from typing_extensions import override
+
+from moviad.models.patchcore.embedding_store import EmbeddingStore
+from moviad.models.patchcore.kcenter_greedy import CoresetExtractor
+from moviad.models.patchcore.patchcore import PatchCore
+from moviad.trainers.trainer_patchcore import TrainerPatchCore
+
+
+class OutOfCorePatchCoreTrainer(TrainerPatchCore):
+
+    """
+    PatchCore trainer that spills the training embeddings to a memory-mapped store on disk,
+    so that the peak RAM does not grow with the size of the training set
+
+    Args:
+        patchore_model (PatchCore): model to be trained
+        train_dataloder (torch.utils.data.DataLoader): train dataloader
+        test_dataloder (torch.utils.data.DataLoader): test dataloader
+        device (str): device to be used for the training
+        store_dir (str): directory of the embedding store, a temporary directory if None
+        store_dtype (str): storage type of the embeddings, "float16" or "int8"
+        reservoir_size (int): number of embeddings sampled to fit the random projection
+        chunk_size (int): number of embeddings processed at once by the coreset selection
+        max_resident_bytes (int): largest projection of the embeddings loaded on the device,
+            for an in-memory coreset selection
+        streaming_centers_per_step (int): centers selected per pass over a projection
+            larger than max_resident_bytes, streamed from disk
+    """
+
+    def __init__(
+        self,
+        patchore_model: PatchCore,
+        train_dataloader: torch.utils.data.DataLoader,
+        test_dataloder: torch.utils.data.DataLoader,
+        device: str,
+        coreset_extractor: CoresetExtractor = None,
+        save_path=None,
+        logger=None,
+        store_dir: str = None,
+        store_dtype: str = "float16",
+        reservoir_size: int = 20000,
+        chunk_size: int = 65536,
+        max_resident_bytes: int = 2 * 1024**3,
+        streaming_centers_per_step: int = 64,
+    ):
+        if coreset_extractor is not None and not hasattr(coreset_extractor, "get_coreset_idx_out_of_core"):
+            raise TypeError(
+                f"{type(coreset_extractor).__name__} cannot select the coreset out of core, "
+                "use a CoresetExtractor"
+            )
+        super().__init__(
+            patchore_model,
+            train_dataloader,
+            test_dataloder,
+            device,
+            coreset_extractor=coreset_extractor,
+            save_path=save_path,
+            logger=logger,
+        )
+        self.store_dir = store_dir
+        self.store_dtype = store_dtype
+        self.reservoir_size = reservoir_size
+        self.chunk_size = chunk_size
+        self.max_resident_bytes = max_resident_bytes
+        self.streaming_centers_per_step = streaming_centers_per_step
+
+    @override
+    def train(self):
+
+        """
+        This method streams the training embeddings to disk, selects the coreset over
+        the memory-mapped projection and evaluates the model at the end of training
+        """
+
+        store = None
+
+        with torch.no_grad():
+
+            if self.logger is not None:
+                self.logger.watch(self.model)
+            print("Embedding Extraction:")
+            for batch in tqdm(iter(self.train_dataloader)):
+
+                if isinstance(batch, tuple):
+                    embedding = self.model(batch[0].to(self.device))
+                else:
+                    embedding = self.model(batch.to(self.device))
+
+                if store is None:
+                    store = EmbeddingStore(
+                        embedding.shape[1],
+                        directory=self.store_dir,
+                        dtype=self.store_dtype,
+                        reservoir_size=self.reservoir_size,
+                    )
+                store.append(embedding)
+                del embedding
+
+            if store is None:
+                raise RuntimeError("The train dataloader did not yield any batch")
+
+            torch.cuda.empty_cache()
+
+            try:
+                print("Coreset Extraction:")
+                if self.coreset_extractor is None:
+                    self.coreset_extractor = CoresetExtractor(False, self.device, k=self.model.k)
+
+                projection = store.project(chunk_size=self.chunk_size)
+                # the coverage radius is measured in the projection of the store, saved with the model
+                if store.projector is not None:
+                    self.coreset_extractor.projector = store.projector
+                else:
+                    self.coreset_extractor.projector = SparseRandomProjection(n_components="auto", eps=0.90)
+                coreset_idx = self.coreset_extractor.get_coreset_idx_out_of_core(
+                    projection,
+                    self.chunk_size,
+                    max_resident_bytes=self.max_resident_bytes,
+                    streaming_centers_per_step=self.streaming_centers_per_step,
+                )
+                del projection
+
+                coreset = store.gather(coreset_idx.numpy()).to(self.device)
+            finally:
+                store.close()
+
+            return self.finish_training(coreset)
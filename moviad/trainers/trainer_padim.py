@@ -3,6 +3,7 @@ from tqdm import tqdm
 import torch
 
 from moviad.models.padim.padim import Padim
+from moviad.models.padim.online_gaussian import OnlineGaussianEstimator
 from moviad.trainers.trainer import Trainer, TrainerResult
 
 
@@ -16,13 +17,17 @@ class TrainerPadim(Trainer):
         device,
         apply_diagonalization=False,
         logger=None,
+        online_fit=False,
     ):
         """
         Args:
             device: one of the following strings: 'cpu', 'cuda', 'cuda:0', ...
+            online_fit: fit the gaussians batch by batch on the device, instead of
+                collecting the embeddings of the whole training set first
         """
         super().__init__(model, train_dataloader, eval_dataloader, device, logger)
         self.apply_diagonalization = apply_diagonalization
+        self.online_fit = online_fit
 
     def train(self):
         print(f"Train Padim. Backbone: {self.model.backbone_model_name}")
@@ -32,28 +37,10 @@ class TrainerPadim(Trainer):
         if self.logger is not None:
             self.logger.watch(self.model)
 
-        # 1. get the feature maps from the backbone
-        layer_outputs: dict[str, list[torch.Tensor]] = {
-            layer: [] for layer in self.model.layers_idxs
-        }
-        for x in tqdm(self.train_dataloader, "| feature extraction | train | %s |"):
-            outputs = self.model(x.to(self.device))
-            assert isinstance(outputs, dict)
-            for layer, output in outputs.items():
-                layer_outputs[layer].extend(output)
-
-        # 2. use the feature maps to get the embeddings
-        embedding_vectors = self.model.raw_feature_maps_to_embeddings(layer_outputs)
-
-        # 3. fit the multivariate Gaussian distribution
-        if self.apply_diagonalization:
-            self.model.fit_multivariate_diagonal_gaussian(
-                embedding_vectors, update_params=True, logger=self.logger
-            )
+        if self.online_fit:
+            self.fit_online()
         else:
-            self.model.fit_multivariate_gaussian(
-                embedding_vectors, update_params=True, logger=self.logger
-            )
+            self.fit_offline()
 
         metrics = self.evaluator.evaluate(self.model)
 
@@ -64,3 +51,36 @@ class TrainerPadim(Trainer):
         self.print_metrics(metrics)
 
         return TrainerResult(**metrics)
+
+    def fit_online(self):
+        # update the running mean and covariance of every patch with each batch of embeddings
+        estimator = OnlineGaussianEstimator(diagonal=self.apply_diagonalization, dtype=self.model.torch_dtype)
+        for x in tqdm(self.train_dataloader, "| online fit | train | %s |"):
+            estimator.update(self.model.embed(x.to(self.device)))
+
+        mean, cov = estimator.finalize()
+        self.model.set_gaussian(
+            mean, cov, diagonal=self.apply_diagonalization, feature_size=estimator.feature_size
+        )
+
+    def fit_offline(self):
+        # 1. get the embeddings of every batch, fused on the device and reduced to
+        # the random dimensions before they are stored
+        embeddings: list[torch.Tensor] = []
+        for x in tqdm(self.train_dataloader, "| feature extraction | train | %s |"):
+            embeddings.append(self.model.embed(x.to(self.device)).cpu())
+
+        # 2. concatenate the embeddings of the whole training set
+        embedding_vectors = torch.cat(embeddings, 0)
+
+        # 3. fit the multivariate Gaussian distribution
+        if self.model.covariance_model is not None:
+            self.model.fit_covariance_model(embedding_vectors)
+        elif self.apply_diagonalization:
+            self.model.fit_multivariate_diagonal_gaussian(
+                embedding_vectors, update_params=True, logger=self.logger
+            )
+        else:
+            self.model.fit_multivariate_gaussian(
+                embedding_vectors, update_params=True, logger=self.logger
+            )
@@ -4,6 +4,7 @@ from sklearn.cluster import MiniBatchKMeans
 
 from tqdm import tqdm
 import os
+import warnings
 
 from moviad.models.patchcore.patchcore import PatchCore
 from moviad.models.patchcore.kcenter_greedy import CoresetExtractor
@@ -85,16 +86,35 @@ class TrainerPatchCore(Trainer):
 
             coreset = self.coreset_extractor.extract_coreset(embeddings)
 
+            return self.finish_training(coreset)
+
+    def finish_training(self, coreset: torch.Tensor) -> TrainerResult:
+
+        """
+        This method stores the coreset in the memory bank, quantizing it if required,
+        saves the model and evaluates it
+
+        Args:
+            coreset (torch.Tensor): the embeddings selected for the memory bank
+        """
+
+        with torch.no_grad():
+
             if self.model.apply_quantization:
                 assert self.model.product_quantizer is not None, "Product Quantizer not initialized"
 
                 self.model.product_quantizer.fit(coreset)
                 coreset = self.model.product_quantizer.encode(coreset)
 
-            self.model.memory_bank = coreset
+            self.model.set_memory_bank(coreset)
+            radius = getattr(self.coreset_extractor, "radius", None)
+            if radius is not None:
+                self.model.coverage_radius = torch.tensor(radius)
+                projection = self.coreset_extractor.projection_matrix()
+                self.model.coverage_projection = projection if projection is not None else torch.Tensor()
 
             if self.save_path:
-                self.model.save_model(save_path=self.save_path)
+                self.model.save_model(self.save_path)
 
             gpu_device = torch.device("cuda:0")
             self.model.to(gpu_device)   
@@ -112,9 +132,79 @@ class TrainerPatchCore(Trainer):
 
             return TrainerResult(**metrics)
 
+    def update(self, new_data, max_new_patches: int = None, max_memory_bank_size: int = None) -> dict:
+
+        """
+        This method adds the patches of new nominal images to the memory bank without retraining:
+        the k-center greedy selection is continued on the new patches only, against the current
+        memory bank and its coverage radius, and the most redundant entries are evicted if the
+        memory bank grows beyond max_memory_bank_size
+
+        Args:
+            new_data (torch.utils.data.DataLoader | torch.Tensor): the new images, as a dataloader or a batch
+            max_new_patches (int): maximum number of patches added to the memory bank, no limit if None
+            max_memory_bank_size (int): maximum number of memory bank entries, no limit if None
+
+        Returns:
+            dict: number of extracted, added and evicted patches, and the memory bank size
+        """
+
+        if not self.model.memory_bank.numel():
+            raise RuntimeError("The memory bank is empty, the model must be trained before it is updated")
 
+        batches = [new_data] if isinstance(new_data, torch.Tensor) else new_data
 
+        with torch.no_grad():
+            self.model.train()
+
+            embeddings = []
+            print("Embedding Extraction:")
+            for batch in tqdm(iter(batches)):
+                images = batch[0] if isinstance(batch, (tuple, list)) else batch
+                embeddings.append(self.model(images.to(self.device)))
+            embeddings = torch.cat(embeddings, dim=0)
+            num_extracted = embeddings.shape[0]
+
+            if self.coreset_extractor is None:
+                self.coreset_extractor = CoresetExtractor(False, self.device, k=self.model.k)
 
+            memory_bank = self.model.memory_bank
+            centers = self.model.memory_bank_vectors(torch.arange(memory_bank.shape[0], device=memory_bank.device))
+
+            # the radius and the projection it was measured with are the ones saved with the model
+            print("Coreset Extension:")
+            radius = self.model.coverage_radius.item()
+            if radius <= 0:
+                radius = self.model.estimate_coverage_radius()
+                warnings.warn(
+                    f"The model has no coverage radius, e.g. it was not trained with k-center greedy: "
+                    f"using the largest nearest neighbour distance of the memory bank, {radius:.4f}"
+                )
+            projection = self.model.coverage_projection if self.model.coverage_projection.numel() else None
+            new_idx = self.coreset_extractor.extend_coreset_idx(
+                centers, embeddings, max_new=max_new_patches, radius=radius, projection=projection,
+            )
+            new_entries = embeddings[new_idx.to(embeddings.device)]
+            del embeddings, centers
+
+            if self.model.apply_quantization:
+                new_entries = self.model.product_quantizer.encode(new_entries)
 
+            self.model.extend_memory_bank(new_entries)
+            self.model.coverage_radius = torch.tensor(self.coreset_extractor.radius)
+
+            evicted = 0
+            if max_memory_bank_size is not None:
+                evicted = self.model.evict_memory_bank_entries(max_memory_bank_size)
+
+            if self.save_path:
+                self.model.save_model(self.save_path)
 
+            self.model.eval()
 
+        return {
+            "extracted_patches": num_extracted,
+            "added_patches": new_idx.shape[0],
+            "evicted_patches": evicted,
+            "memory_bank_size": self.model.memory_bank.shape[0],
+        }
@@ -0,0 +1,119 @@
+"""
+Calibration of the decision thresholds of an anomaly detection model.
+
+The anomaly scores and maps of a validation set are reduced batch by batch, on their device,
+to histograms of the scores of the normal and anomalous images and pixels. The operating
+points, the thresholds with the best F1 or at a target false positive rate or recall, are
+then read from the cumulative counts and saved next to the model checkpoint, so that the
+deployed model can emit decisions and masks without the validation set.
+
+The thresholds apply to the raw outputs of the model: no normalization over the test set,
+like the min-max rescaling of the Evaluator, can be done at inference time.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field, asdict
+
+import torch
+from tqdm import tqdm
+
+from .streaming_metrics import ScoreHistogram
+
+
+@dataclass
+class OperatingPoints:
+    """Image and pixel thresholds by operating point name, the scores >= threshold being anomalous."""
+
+    image: dict[str, float] = field(default_factory=dict)
+    pixel: dict[str, float] = field(default_factory=dict)
+
+    @staticmethod
+    def path(checkpoint_path: str) -> str:
+        """Path of the operating points saved next to a model checkpoint."""
+        return f"{checkpoint_path}.thresholds.json"
+
+    def save(self, checkpoint_path: str) -> str:
+        path = OperatingPoints.path(checkpoint_path)
+        with open(path, "w") as file:
+            json.dump(asdict(self), file, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, checkpoint_path: str) -> OperatingPoints:
+        with open(OperatingPoints.path(checkpoint_path)) as file:
+            return cls(**json.load(file))
+
+    def decide(self, anom_scores, point: str = "max_f1"):
+        """Image-level decisions, True for the anomalous images."""
+        return anom_scores >= self.image[point]
+
+    def segment(self, anom_maps, point: str = "max_f1"):
+        """Binary masks of the anomalous pixels."""
+        return anom_maps >= self.pixel[point]
+
+
+class ThresholdCalibrator:
+    """
+    Streaming estimation of the operating points of a model on a validation set.
+
+    Args:
+        num_bins (int): number of bins of the score histograms
+        target_fprs (tuple[float]): false positive rates of the fixed-FPR operating points
+        target_recalls (tuple[float]): recalls of the fixed-recall operating points
+    """
+
+    def __init__(
+        self,
+        num_bins: int = 4096,
+        target_fprs: tuple[float, ...] = (0.01, 0.05),
+        target_recalls: tuple[float, ...] = (0.95,),
+    ):
+        self.target_fprs = target_fprs
+        self.target_recalls = target_recalls
+        self.image_histogram = ScoreHistogram(num_bins)
+        self.pixel_histogram = ScoreHistogram(num_bins)
+
+    def update(self, labels, anom_scores, masks=None, anom_maps=None) -> None:
+        """
+        Add a batch of validation results, the pixels only if both the masks and the maps are given.
+        """
+        self.image_histogram.update(torch.as_tensor(labels), torch.as_tensor(anom_scores))
+        if masks is not None and anom_maps is not None:
+            self.pixel_histogram.update(torch.as_tensor(masks), torch.as_tensor(anom_maps))
+
+    def calibrate(self, model, dataloader, device) -> OperatingPoints:
+        """
+        Run the model on a validation dataloader, yielding (image, label, mask, path) batches,
+        and return its operating points.
+
+        Raises:
+            ValueError: if the model rescales its anomaly maps, e.g. with the batch min-max
+                normalization of the PatchCore AnomalyMapGenerator, as inference cannot reproduce it
+        """
+        generator = getattr(model, "anomaly_map_generator", None)
+        if generator is not None and getattr(generator, "normalization", "none") != "none":
+            raise ValueError(
+                f'The anomaly maps are calibrated raw, the model must use normalization "none", not "{generator.normalization}"'
+            )
+        model.eval()
+        for image, label, mask, path in tqdm(dataloader, desc="Calibration"):
+            with torch.no_grad():
+                anom_maps, anom_scores = model(image.to(device))
+            self.update(label, anom_scores, mask, anom_maps)
+        return self.operating_points()
+
+    def histogram_operating_points(self, histogram: ScoreHistogram) -> dict[str, float]:
+        points = {"max_f1": histogram.max_f1_threshold()}
+        for fpr in self.target_fprs:
+            points[f"fpr_{fpr:g}"] = histogram.fpr_threshold(fpr)
+        for recall in self.target_recalls:
+            points[f"recall_{recall:g}"] = histogram.recall_threshold(recall)
+        return points
+
+    def operating_points(self) -> OperatingPoints:
+        pixel = {}
+        if self.pixel_histogram.positives is not None:
+            pixel = self.histogram_operating_points(self.pixel_histogram)
+        return OperatingPoints(image=self.histogram_operating_points(self.image_histogram), pixel=pixel)
@@ -1,80 +1,279 @@
 from __future__ import annotations
 
+import os
 from typing import Callable
 from tqdm import tqdm
 import torch
 import numpy as np
 
-from .metrics import MetricLvl, Metric
+from .metrics import MetricLvl, Metric, RocAuc, F1, AvgPrec, ProAuc
+from .streaming_metrics import ScoreHistogram
+from .metric_engine import MetricEngine
+
+# pixel metrics that can be computed from the score histograms, and the ScoreHistogram method computing them
+STREAMING_METRICS = {RocAuc: "roc_auc", AvgPrec: "average_precision", F1: "max_f1"}
 
 
 def min_max_norm(x):
     return (x - x.min()) / (x.max() - x.min())
 
 
+def min_max_norm_(x):
+    """In-place min_max_norm, which avoids a copy of the anomaly maps of the whole test set."""
+    x_min, x_max = x.min(), x.max()
+    x -= x_min
+    x /= x_max - x_min
+    return x
+
+
 def append(prev, new, dtype=None, to_numpy=True):
     new = new.cpu().numpy() if to_numpy else new
     new = new.astype(dtype) if dtype else new
     return np.concatenate((prev, new), axis=0)
 
 
+def default_metrics() -> list[Metric]:
+    """The metrics reported by the trainers, in the order of the values of the report."""
+    return [
+        RocAuc(MetricLvl.IMAGE),
+        RocAuc(MetricLvl.PIXEL),
+        F1(MetricLvl.IMAGE),
+        F1(MetricLvl.PIXEL),
+        AvgPrec(MetricLvl.IMAGE),
+        AvgPrec(MetricLvl.PIXEL),
+        ProAuc(MetricLvl.PIXEL),
+    ]
+
+
 class Evaluator:
     """
     This class will evaluate the trained model on the test set
     and it will produce the evaluation metrics needed
 
+    The results are written batch by batch into buffers preallocated for the whole test set,
+    float32 for the predictions and uint8 for the ground truth, optionally memory-mapped.
+    The anomaly maps computed on a GPU are copied to pinned host memory on a side stream,
+    so the copy of a batch overlaps with the forward pass of the next one.
+
+    With streaming_bins, the pixel ROC AUC, average precision and F1 are computed from
+    histograms of the scores updated on the device, and the anomaly maps are not collected
+    unless another pixel metric, e.g. the PRO AUC, needs them.
+
     Args:
-        test_dataloader (Dataloader): test dataloader
+        dataloader (Dataloader): test dataloader
         device (torch.device): device where to run the model
     """
 
-    def __init__(self, dataloader, metrics: list[Metric], device):
+    def __init__(
+        self,
+        dataloader,
+        device,
+        metrics: list[Metric] | None = None,
+        memmap_dir: str | None = None,
+        non_blocking: bool = True,
+        streaming_bins: int | None = None,
+        streaming_range: tuple[float, float] | None = None,
+        metric_workers: int | None = None,
+    ):
         """
         Args:
             dataloader (Dataloader): dataloader on which to compute the metrics
             device (torch.device): device where to run the model
+            metrics (list[Metric]): metrics to compute, the default_metrics if None
+            memmap_dir (str): if given, the result buffers are memory-mapped .npy files in this
+                directory, for test sets whose anomaly maps do not fit in memory
+            non_blocking (bool): copy the anomaly maps computed on a GPU asynchronously
+            streaming_bins (int): number of bins of the histograms of the streaming pixel metrics,
+                None for the exact metrics computed on all the pixels
+            streaming_range (tuple[float, float]): fixed range of the histograms, adaptive if None
+            metric_workers (int): number of threads computing the metrics of the levels in parallel
         """
         self.dataloader = dataloader
-        self.metrics = metrics
         self.device = device
+        self.metrics = metrics if metrics is not None else default_metrics()
+        self.memmap_dir = memmap_dir
+        self.non_blocking = non_blocking
+        self.streaming_bins = streaming_bins
+        self.streaming_range = streaming_range
+        self.metric_workers = metric_workers
+        self.histogram: ScoreHistogram | None = None
+        # error bounds of the streaming metrics of the last evaluation, by metric name
+        self.streaming_errors: dict[str, float] = {}
+        self._staging: list[torch.Tensor] = []
+        self._staging_slot = 0
+        self._copy_stream = None
+
+    def is_streaming(self, metric: Metric) -> bool:
+        return (
+            self.streaming_bins is not None
+            and metric.level == MetricLvl.PIXEL
+            and type(metric) in STREAMING_METRICS
+        )
 
-    def evaluate(self, model, postprocess: Callable = min_max_norm):
+    def allocate(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        if self.memmap_dir is None:
+            return np.empty(shape, dtype=dtype)
+        os.makedirs(self.memmap_dir, exist_ok=True)
+        return np.lib.format.open_memmap(
+            os.path.join(self.memmap_dir, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape
+        )
+
+    def staging_buffer(self, anom_maps: torch.Tensor) -> torch.Tensor:
+        """Return the next of two pinned host buffers, sized for the first batch."""
+        if not self._staging or self._staging[0].shape[1:] != anom_maps.shape[1:] \
+                or self._staging[0].shape[0] < anom_maps.shape[0]:
+            self._staging = [
+                torch.empty(anom_maps.shape, dtype=torch.float32, pin_memory=True) for _ in range(2)
+            ]
+        self._staging_slot = 1 - self._staging_slot
+        return self._staging[self._staging_slot][: anom_maps.shape[0]]
+
+    def stage(self, anom_maps) -> tuple[np.ndarray | torch.Tensor, torch.cuda.Event | None]:
         """
-        Args:
-            model: a model object on which you can call model.predict(batched_images)
-                and returns a tuple of anomaly_maps and anomaly_scores
-            output_path (str): path where to store the output masks
+        Start the copy of a batch of anomaly maps to the host.
+
+        Returns:
+            the host maps, to read only after the returned event, if any, has completed
+        """
+        if not (isinstance(anom_maps, torch.Tensor) and anom_maps.is_cuda and self.non_blocking):
+            if isinstance(anom_maps, torch.Tensor):
+                anom_maps = anom_maps.detach().cpu().numpy()
+            return anom_maps, None
+
+        host_maps = self.staging_buffer(anom_maps)
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream(device=anom_maps.device)
+        copy_stream = self._copy_stream
+        copy_stream.wait_stream(torch.cuda.current_stream(anom_maps.device))
+        with torch.cuda.stream(copy_stream):
+            # keep the maps alive until the copy on the side stream is done
+            anom_maps.record_stream(copy_stream)
+            host_maps.copy_(anom_maps.detach(), non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(copy_stream)
+        return host_maps, event
+
+    def collect(self, model) -> dict[str, np.ndarray]:
+        """
+        Run the model on the dataloader and gather the ground truth and the predictions.
+
+        Returns:
+            dict of arrays: gt_mask (uint8), gt_label (uint8), pred_anom_map and pred_anom_score (float32),
+            without the masks and maps when all the pixel metrics are streamed or there are none
+
+        Raises:
+            ValueError: if the model returns no anomaly maps, e.g. PatchCore with compute_anomaly_maps=False,
+                and there are pixel metrics to compute
         """
         model.eval()
 
-        # Initialize results as numpy arrays
-        init = lambda *t: (np.empty((0,), dtype=t_) for t_ in t)
-        gt_mask, gt_label, pred_anom_map, pred_anom_score = init(int, *(float,) * 3)
+        num_samples = len(self.dataloader.dataset)
+        pixel_metrics = [metric.name for metric in self.metrics if metric.level == MetricLvl.PIXEL]
+        keep_maps = any(
+            metric.level == MetricLvl.PIXEL and not self.is_streaming(metric) for metric in self.metrics
+        )
+        self.histogram = None
+        if any(self.is_streaming(metric) for metric in self.metrics):
+            self.histogram = ScoreHistogram(self.streaming_bins, self.streaming_range)
+        results = None
+        pending = None
+        offset = 0
+
+        def flush(pending):
+            # wait for the copy of a staged batch and write it into its slice
+            (start, stop), host_maps, event = pending
+            if event is not None:
+                event.synchronize()
+            if isinstance(host_maps, torch.Tensor):
+                host_maps = host_maps.numpy()
+            results["pred_anom_map"][start:stop] = host_maps
 
         for image, label, mask, path in tqdm(self.dataloader, desc="Eval"):
             with torch.no_grad():  # get anomaly map and score
-                anom_maps, anom_scores = model(image.to(self.device))
+                anom_maps, anom_scores = model(image.to(self.device, non_blocking=True))
+            if anom_maps is None and pixel_metrics:
+                raise ValueError(
+                    f"The model returned no anomaly maps, the pixel metrics {pixel_metrics} cannot be computed: "
+                    "evaluate it with image metrics only"
+                )
+
+            batch_size = len(image)
+            if results is None:
+                results = {
+                    "gt_label": self.allocate("gt_label", (num_samples,), np.uint8),
+                    "pred_anom_score": self.allocate("pred_anom_score", (num_samples,), np.float32),
+                }
+                if keep_maps:
+                    results["gt_mask"] = self.allocate("gt_mask", (num_samples, *mask.shape[1:]), np.uint8)
+                    results["pred_anom_map"] = self.allocate(
+                        "pred_anom_map", (num_samples, *anom_maps.shape[1:]), np.float32
+                    )
+
+            if self.histogram is not None:
+                self.histogram.update(mask, torch.as_tensor(anom_maps))
+
+            if keep_maps:
+                # the previous batch was copied while this one went through the model
+                if pending is not None:
+                    flush(pending)
+                host_maps, event = self.stage(anom_maps)
+                pending = ((offset, offset + batch_size), host_maps, event)
+                # the masks may have been preprocessed on the device
+                results["gt_mask"][offset:offset + batch_size] = (
+                    mask.cpu().numpy() if isinstance(mask, torch.Tensor) else np.asarray(mask)
+                )
 
-            # Append ground truth, anomaly scores, and predicted masks
-            gt_mask = append(gt_mask, mask, dtype=int)
-            gt_label = append(gt_label, label)
-            pred_anom_map = append(pred_anom_map, anom_maps)
-            pred_anom_score = append(pred_anom_score, anom_scores)
+            if isinstance(anom_scores, torch.Tensor):
+                anom_scores = anom_scores.detach().cpu().numpy()
+            results["pred_anom_score"][offset:offset + batch_size] = np.reshape(anom_scores, -1)
+            results["gt_label"][offset:offset + batch_size] = (
+                label.cpu().numpy() if isinstance(label, torch.Tensor) else np.asarray(label)
+            )
+            offset += batch_size
 
-        pred_anom_map = postprocess(pred_anom_map)
+        if pending is not None:
+            flush(pending)
+        if results is None:
+            raise RuntimeError("The evaluation dataloader is empty")
 
-        # TODO: Implement using generic metrics
+        # fewer samples than the dataset, e.g. with drop_last
+        return {name: buffer[:offset] for name, buffer in results.items()}
+
+    def evaluate(self, model, postprocess: Callable = min_max_norm_) -> dict[str, float]:
         """
-        report = []
-        for metric in metrics:
-            if metric.level == MetricLvl.IMAGE:
-                pred = anom_score
-                gt = labels
-            elif metric.level == MetricLvl.PIXEL:
-                pred = anom_maps
-                gt = masks
-            report.append({metric.name:metric.compute(gt, pred)})
+        Args:
+            model: a model object on which you can call model.predict(batched_images)
+                and returns a tuple of anomaly_maps and anomaly_scores
+            postprocess (Callable): applied to the anomaly maps of the whole test set,
+                a min-max normalization in place by default
+
+        Returns:
+            dict: the value of every metric, by metric name
         """
+        results = self.collect(model)
+        if "pred_anom_map" in results:
+            pred_anom_map = postprocess(results["pred_anom_map"])
+
+        # the metrics of each level share one sort of the scores, the levels run in parallel
+        inputs = {MetricLvl.IMAGE: (results["gt_label"], results["pred_anom_score"])}
+        if "pred_anom_map" in results:
+            inputs[MetricLvl.PIXEL] = (results["gt_mask"], pred_anom_map)
+        engine = MetricEngine(
+            [metric for metric in self.metrics if not self.is_streaming(metric)], self.metric_workers
+        )
+        computed = engine.compute(inputs)
+
+        report = {}
+        self.streaming_errors = {}
+        for metric in self.metrics:
+            if self.is_streaming(metric):
+                # rank metrics, unaffected by a monotonic postprocess
+                value, error = getattr(self.histogram, STREAMING_METRICS[type(metric)])()
+                report[metric.name] = value
+                self.streaming_errors[metric.name] = error
+            else:
+                report[metric.name] = computed[metric.name]
+        return report
 
 
 '''
@@ -0,0 +1,66 @@
+"""Computation of a metric report with one sort of the scores per level."""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from .metrics import BinaryCurve, CurveMetric, Metric, MetricLvl
+
+
+class MetricEngine:
+    """
+    Compute a set of metrics on the ground truth and predictions of each level.
+
+    The curve metrics of a level (ROC AUC, ROC curve, average precision, F1) are all derived
+    from a single BinaryCurve, so the scores of the level are sorted once. The levels and the
+    other metrics, e.g. the PRO AUC, are independent tasks run by a thread pool: the sorts and
+    the labeling of the regions release the GIL.
+
+    Args:
+        metrics (list[Metric]): the metrics to compute
+        num_workers (int): number of threads, one per task if None
+    """
+
+    def __init__(self, metrics: list[Metric], num_workers: int | None = None):
+        self.metrics = metrics
+        self.num_workers = num_workers
+
+    @staticmethod
+    def compute_curve_metrics(metrics: list[CurveMetric], gt, pred) -> dict[str, Any]:
+        curve = BinaryCurve(gt, pred)
+        return {metric.name: metric.compute_from_curve(curve) for metric in metrics}
+
+    @staticmethod
+    def compute_metric(metric: Metric, gt, pred) -> dict[str, Any]:
+        return {metric.name: metric.compute(gt, pred)}
+
+    def compute(self, inputs: dict[MetricLvl, tuple]) -> dict[str, Any]:
+        """
+        Args:
+            inputs (dict): ground truth and predictions of each level, as a (gt, pred) tuple
+
+        Returns:
+            dict: the value of every metric, by metric name, in the order of the metrics
+        """
+        tasks = []
+        for level, (gt, pred) in inputs.items():
+            level_metrics = [metric for metric in self.metrics if metric.level == level]
+            curve_metrics = [metric for metric in level_metrics if isinstance(metric, CurveMetric)]
+            if curve_metrics:
+                tasks.append((self.compute_curve_metrics, curve_metrics, gt, pred))
+            tasks.extend(
+                (self.compute_metric, metric, gt, pred)
+                for metric in level_metrics if not isinstance(metric, CurveMetric)
+            )
+
+        results = {}
+        if len(tasks) <= 1 or self.num_workers == 1:
+            for task, *args in tasks:
+                results.update(task(*args))
+        else:
+            with ThreadPoolExecutor(max_workers=self.num_workers or len(tasks)) as pool:
+                for result in pool.map(lambda task: task[0](*task[1:]), tasks):
+                    results.update(result)
+
+        return {metric.name: results[metric.name] for metric in self.metrics if metric.name in results}
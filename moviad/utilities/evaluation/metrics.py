@@ -2,15 +2,9 @@ from __future__ import annotations
 from enum import Enum
 from abc import ABC, abstractmethod
 import faiss
-from sklearn.metrics import (
-    roc_auc_score,
-    roc_curve,
-    precision_recall_curve,
-    average_precision_score,
-    auc,
-)
+from sklearn.metrics import auc
 import numpy as np
-from skimage.measure import label, regionprops
+from skimage.measure import label
 
 from moviad.models.patchcore.product_quantizer import ProductQuantizer
 
@@ -58,44 +52,111 @@ class SimpleMetric(Metric):
     def name(self):
         return f"{self.level.value}_{self.base_name}"
 
-class F1(Metric):
-    @property
-    def name(self):
-        return f"{self.level.value}_f1"
+class BinaryCurve:
+    """
+    Cumulative true and false positive counts at every distinct score, from a single sort.
 
-    def compute(self, gt, pred):
-        if self.level == MetricLvl.PIXEL:
-            pred, gt = pred.flatten(), gt.flatten()
-        precision, recall, _ = precision_recall_curve(gt, pred)
+    The ROC and precision-recall curves and all the metrics derived from them are computed from
+    these counts, as in sklearn, so they can share one sort of the scores.
+
+    Args:
+        gt (np.ndarray): ground truth labels or masks, positive where > 0.5
+        pred (np.ndarray): predicted scores or maps of the same number of elements
+    """
+
+    def __init__(self, gt, pred):
+        gt = np.asarray(gt).ravel() > 0.5
+        pred = np.asarray(pred).ravel()
+
+        # sort the scores in decreasing order, then keep the last index of each distinct score
+        order = np.argsort(pred, kind="stable")[::-1]
+        pred, gt = pred[order], gt[order]
+        threshold_idxs = np.r_[np.flatnonzero(np.diff(pred)), pred.size - 1]
+
+        self.thresholds = pred[threshold_idxs]
+        self.tps = np.cumsum(gt, dtype=np.float64)[threshold_idxs]
+        self.fps = 1 + threshold_idxs - self.tps
+
+    def roc_curve(self, drop_intermediate: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        """False and true positive rates, starting from (0, 0), without the collinear points if drop_intermediate."""
+        tps, fps = self.tps, self.fps
+        if drop_intermediate and len(fps) > 2:
+            keep = np.flatnonzero(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])
+            tps, fps = tps[keep], fps[keep]
+        tps, fps = np.r_[0, tps], np.r_[0, fps]
+        return fps / fps[-1], tps / tps[-1]
+
+    def roc_auc(self) -> float:
+        if self.tps[-1] == 0 or self.fps[-1] == 0:
+            raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+        fpr, tpr = self.roc_curve()
+        return auc(fpr, tpr)
+
+    def precision_recall(self) -> tuple[np.ndarray, np.ndarray]:
+        """Precision and recall at every distinct score, in decreasing order of the scores."""
+        return self.tps / (self.tps + self.fps), self.tps / self.tps[-1]
+
+    def average_precision(self) -> float:
+        precision, recall = self.precision_recall()
+        return float(np.sum(np.diff(recall, prepend=0) * precision))
+
+    def f1(self) -> np.ndarray:
+        """F1 score at every distinct score, in decreasing order of the scores."""
+        precision, recall = self.precision_recall()
         a = 2 * precision * recall
         b = precision + recall
-        f1 = np.divide(a, b, out=np.zeros_like(a), where=b != 0)
-        return np.max(f1)
+        return np.divide(a, b, out=np.zeros_like(a), where=b != 0)
 
+    def max_f1(self) -> float:
+        return float(max(np.max(self.f1()), 0.0))
 
+    def max_f1_threshold(self) -> float:
+        """The score with the best F1, the scores >= threshold being positive."""
+        return float(self.thresholds[np.argmax(self.f1())])
 
-class RocAuc(Metric):
-    """Receiver operating characteristic AUC score."""
 
-    @property
-    def name(self):
-        return f"{self.level.value}_roc_auc"
+class CurveMetric(Metric):
+    """A metric derived from the BinaryCurve of the ground truth and the predictions."""
+
+    @abstractmethod
+    def compute_from_curve(self, curve: BinaryCurve): ...
 
     def compute(self, gt, pred):
         """
         Args:
             gt (np.ndarray): Ground truth labels, either as a binary mask or list of labels.
             pred (np.ndarray): Predicted scores, either as a mask or list of scores.
+        """
+        return self.compute_from_curve(BinaryCurve(gt, pred))
+
+
+class F1(CurveMetric):
+    """Best F1 score over all the thresholds."""
+
+    @property
+    def name(self):
+        return f"{self.level.value}_f1"
 
+    def compute_from_curve(self, curve: BinaryCurve):
+        return curve.max_f1()
+
+
+class RocAuc(CurveMetric):
+    """Receiver operating characteristic AUC score."""
+
+    @property
+    def name(self):
+        return f"{self.level.value}_roc_auc"
+
+    def compute_from_curve(self, curve: BinaryCurve):
+        """
         Returns:
             float: ROC AUC score for the desired metric level.
         """
-        if self.level == MetricLvl.PIXEL:
-            pred, gt = pred.flatten(), gt.flatten()
-        return roc_auc_score(gt, pred)
+        return curve.roc_auc()
 
 
-class RocCurve(Metric):
+class RocCurve(CurveMetric):
     """
     Receiver operating characteristic curve, false positive and true positive rate.
     """
@@ -104,42 +165,29 @@ class RocCurve(Metric):
     def name(self):
         return f"{self.level.value}_fpr_tpr"
 
-    def compute(self, gt, pred):
+    def compute_from_curve(self, curve: BinaryCurve):
         """
-        Args:
-            gt (np.ndarray): Numpy array of ground truth labels.
-            pred (np.ndarray): Numpy array of predicted scores.
-
         Returns:
             tuple: A tuple containing:
             - fpr (np.ndarray): False positive rate.
             - tpr (np.ndarray): True positive rate.
         """
-        if self.level == MetricLvl.PIXEL:
-            pred, gt = pred.flatten(), gt.flatten()
-        fpr, tpr, _ = roc_curve(gt, pred)
-        return fpr, tpr
+        return curve.roc_curve()
 
 
-class AvgPrec(Metric):
+class AvgPrec(CurveMetric):
     """Average Precision metric."""
 
     @property
     def name(self):
-        return f"{self.level.value}_avg_prec"
+        return f"{self.level.value}_pr_auc"
 
-    def compute(self, gt, pred):
+    def compute_from_curve(self, curve: BinaryCurve):
         """
-        Args:
-            gt (array-like): Ground truth binary labels.
-            pred (array-like): Predicted scores or probabilities.
-
         Returns:
             float: The computed average precision score.
         """
-        if self.level == MetricLvl.PIXEL:
-            pred, gt = pred.flatten(), gt.flatten()
-        return average_precision_score(gt, pred)
+        return curve.average_precision()
 
 
 class ProAuc(Metric):
@@ -165,67 +213,61 @@ class ProAuc(Metric):
     def rescale(x):
         return (x - x.min()) / (x.max() - x.min())
 
-    def compute(self, gt, pred):
+    def compute(self, gt, pred, max_step: int = 200, expect_fpr: float = 0.3):
         """
+        The per-region overlap and the false positive rate are evaluated at max_step thresholds
+        evenly spaced between the max and the min score. The ground truth regions are labeled
+        once, then every pixel is assigned the first threshold it exceeds: the PRO and FPR curves
+        are the cumulative sums of the histograms of these indices, weighted by the inverse of
+        the region area for the overlap.
+
         Args:
             gt (np.ndarray): Numpy array of ground truth masks.
             pred (np.ndarray): Numpy array of predicted masks.
+            max_step (int): number of thresholds
+            expect_fpr (float): the curve is integrated up to this false positive rate
         Returns:
             float: PRO AUC score.
         """
-        # remove the channel dimension
-        gt = np.squeeze(gt, axis=1)
-
-        gt[gt <= 0.5] = 0
-        gt[gt > 0.5] = 1
-        gt = gt.astype(np.bool_)
-
-        max_step = 200
-        expect_fpr = 0.3
+        # remove the channel dimension, without modifying the ground truth of the caller
+        gt = np.asarray(gt)
+        if gt.ndim == 4:
+            gt = np.squeeze(gt, axis=1)
+        gt = gt > 0.5
+        pred = np.asarray(pred).reshape(gt.shape)
 
         # set the max and min scores and the delta step
         max_th = pred.max()
         min_th = pred.min()
         delta = (max_th - min_th) / max_step
+        threds = np.array([max_th - step * delta for step in range(max_step)])
+        ascending_threds = threds[::-1]
+
+        # histograms of the index of the first (highest) threshold exceeded by each pixel,
+        # max_step for the pixels that exceed none of them
+        region_overlap = np.zeros(max_step + 1)
+        negatives = np.zeros(max_step + 1)
+        num_regions = 0
+        for gt_map, pred_map in zip(gt, pred):
+            first_exceeded = max_step - np.searchsorted(ascending_threds, pred_map, side="left")
+            negatives += np.bincount(first_exceeded[~gt_map], minlength=max_step + 1)
+
+            # label the regions in the ground truth
+            label_map = label(gt_map, connectivity=2)
+            in_region = label_map > 0
+            if not in_region.any():
+                continue
+            regions = label_map[in_region]
+            areas = np.bincount(regions)
+            region_overlap += np.bincount(
+                first_exceeded[in_region], weights=1.0 / areas[regions], minlength=max_step + 1
+            )
+            num_regions += len(areas) - 1
 
-        pros_mean = []
-        threds = []
-        fprs = []
-
-        binary_score_maps = np.zeros_like(pred, dtype=np.bool_)
-
-        for step in range(max_step):
-            thred = max_th - step * delta
-
-            # segment the scores with different thresholds
-            binary_score_maps[pred <= thred] = 0
-            binary_score_maps[pred > thred] = 1
-
-            pro = []
-            for i in range(len(binary_score_maps)):
-
-                # label the regions in the ground truth
-                label_map = label(gt[i], connectivity=2)
-
-                # calculate some properties for every corresponding region
-                props = regionprops(label_map, binary_score_maps[i])
-
-                # calculate the per-regione overlap
-                for prop in props:
-                    pro.append(prop.intensity_image.sum() / prop.area)
-
-            # append the per-region overlap
-            pros_mean.append(np.array(pro).mean())
-
-            # calculate the false positive rate
-            gt_neg = ~gt
-            fpr = np.logical_and(gt_neg, binary_score_maps).sum() / gt_neg.sum()
-            fprs.append(fpr)
-            threds.append(thred)
-
-        threds = np.array(threds)
-        pros_mean = np.array(pros_mean)
-        fprs = np.array(fprs)
+        # at threshold k, the pixels counted are those whose first exceeded threshold is <= k
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pros_mean = np.cumsum(region_overlap)[:max_step] / num_regions
+            fprs = np.cumsum(negatives)[:max_step] / negatives.sum()
 
         # select the case when the false positive rates are under the expected fpr
         idx = fprs <= expect_fpr
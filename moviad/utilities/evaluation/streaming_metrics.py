@@ -0,0 +1,175 @@
+"""Streaming pixel-level metrics computed from histograms of the anomaly scores.
+
+The anomaly maps of a test set are reduced, batch by batch and on their device, to two
+histograms of the scores of the anomalous and of the normal pixels. The ROC AUC, the
+average precision and the best F1 are then computed from the cumulative counts over the
+bins. Only the order of the pixels that share a bin is unknown, so each metric comes with
+a bound on its error: the maps never need to be held in memory.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import torch
+
+
+class ScoreHistogram:
+    """
+    Histograms of the scores of the positive and negative pixels.
+
+    With a fixed value_range the scores outside of it are clipped to the first and last bins,
+    and the error bounds only hold if the range covers all the scores. Otherwise the range
+    is adaptive: it starts from the scores of the first batch, and whenever a batch falls
+    outside of it, the width of the bins doubles, merging pairs of bins, until the batch fits.
+
+    Args:
+        num_bins (int): number of bins, even
+        value_range (tuple[float, float]): fixed range of the scores, adaptive if None
+    """
+
+    def __init__(self, num_bins: int = 4096, value_range: tuple[float, float] | None = None):
+        if num_bins < 2 or num_bins % 2:
+            raise ValueError(f"The number of bins must be even, got {num_bins}")
+        self.num_bins = num_bins
+        self.adaptive = value_range is None
+        self.low = None if value_range is None else float(value_range[0])
+        self.width = None if value_range is None else (value_range[1] - value_range[0]) / num_bins
+        self.positives: torch.Tensor | None = None
+        self.negatives: torch.Tensor | None = None
+
+    @property
+    def high(self) -> float:
+        return self.low + self.width * self.num_bins
+
+    def coarsen(self, upwards: bool) -> None:
+        """Double the width of the bins, extending the range above or below."""
+        half = torch.zeros(self.num_bins // 2, dtype=self.positives.dtype, device=self.positives.device)
+        merged = [counts.view(-1, 2).sum(dim=1) for counts in (self.positives, self.negatives)]
+        if upwards:
+            self.positives, self.negatives = (torch.cat((counts, half)) for counts in merged)
+        else:
+            self.positives, self.negatives = (torch.cat((half, counts)) for counts in merged)
+            self.low -= self.width * self.num_bins
+        self.width *= 2
+
+    def update(self, gt: torch.Tensor, pred: torch.Tensor) -> None:
+        """
+        Add a batch of pixels to the histograms.
+
+        Args:
+            gt (torch.Tensor): ground truth masks, anomalous where > 0.5
+            pred (torch.Tensor): anomaly maps of the same number of elements
+        """
+        pred = pred.detach().reshape(-1).float()
+        gt = gt.reshape(-1).to(pred.device) > 0.5
+
+        if self.positives is None:
+            self.positives = torch.zeros(self.num_bins, dtype=torch.int64, device=pred.device)
+            self.negatives = torch.zeros(self.num_bins, dtype=torch.int64, device=pred.device)
+        if self.adaptive:
+            batch_min, batch_max = pred.min().item(), pred.max().item()
+            if self.low is None:
+                self.low = batch_min
+                self.width = (batch_max - batch_min) / self.num_bins or 1.0 / self.num_bins
+            while batch_max > self.high:
+                self.coarsen(upwards=True)
+            while batch_min < self.low:
+                self.coarsen(upwards=False)
+
+        bins = ((pred - self.low) / self.width).long().clamp_(0, self.num_bins - 1)
+        self.positives += torch.bincount(bins[gt], minlength=self.num_bins)
+        self.negatives += torch.bincount(bins[~gt], minlength=self.num_bins)
+
+    def counts(self) -> tuple[np.ndarray, np.ndarray]:
+        """Counts of the positives and negatives per bin, from the highest scores to the lowest."""
+        if self.positives is None:
+            raise RuntimeError("The histograms are empty")
+        return (
+            self.positives.flip(0).cpu().numpy().astype(np.float64),
+            self.negatives.flip(0).cpu().numpy().astype(np.float64),
+        )
+
+    def roc_auc(self) -> tuple[float, float]:
+        """
+        ROC AUC, with the pixels of a bin on a straight segment of the curve.
+
+        Returns:
+            the estimate and the bound on its error, half the fraction of the
+            positive-negative pairs that share a bin
+        """
+        positives, negatives = self.counts()
+        total_positives, total_negatives = positives.sum(), negatives.sum()
+        tpr = np.concatenate(([0.0], np.cumsum(positives) / total_positives))
+        fpr = np.concatenate(([0.0], np.cumsum(negatives) / total_negatives))
+        estimate = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+        error = 0.5 * np.sum(positives * negatives) / (total_positives * total_negatives)
+        return float(estimate), float(error)
+
+    def average_precision(self) -> tuple[float, float]:
+        """
+        Average precision, with the precision of the positives of a bin taken at its lower edge,
+        like the tied scores in sklearn.
+
+        Returns:
+            the estimate and the bound on its error, from the worst and best order of the
+            positives and negatives inside each bin
+        """
+        positives, negatives = self.counts()
+        true_positives, false_positives = np.cumsum(positives), np.cumsum(negatives)
+        previous_tp = true_positives - positives
+        previous_predicted = previous_tp + false_positives - negatives
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            precision = true_positives / (true_positives + false_positives)
+            worst = (previous_tp + 1) / (previous_predicted + negatives + 1)
+            best = (previous_tp + positives) / (previous_predicted + positives)
+        weights = positives / positives.sum()
+        has_positives = positives > 0
+        estimate = np.sum(weights[has_positives] * precision[has_positives])
+        error = np.sum(weights[has_positives] * (best - worst)[has_positives])
+        return float(estimate), float(error)
+
+    def max_f1(self) -> tuple[float, float]:
+        """
+        Best F1 over the thresholds at the edges of the bins.
+
+        Returns:
+            the estimate and the bound on its error, from the best F1 reachable by a
+            threshold inside a bin
+        """
+        positives, negatives = self.counts()
+        total_positives = positives.sum()
+        true_positives, false_positives = np.cumsum(positives), np.cumsum(negatives)
+        previous_fp = false_positives - negatives
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            f1 = 2 * true_positives / (true_positives + false_positives + total_positives)
+            reachable = 2 * true_positives / (true_positives + previous_fp + total_positives)
+        estimate = np.nanmax(f1)
+        return float(estimate), float(np.nanmax(reachable) - estimate)
+
+    def lower_edges(self) -> np.ndarray:
+        """Lower edges of the bins, from the highest scores to the lowest, as counts() returns them."""
+        return self.low + self.width * np.arange(self.num_bins - 1, -1, -1, dtype=np.float64)
+
+    def max_f1_threshold(self) -> float:
+        """Threshold at a bin edge with the best F1, the scores >= threshold being anomalous."""
+        positives, negatives = self.counts()
+        true_positives, false_positives = np.cumsum(positives), np.cumsum(negatives)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            f1 = 2 * true_positives / (true_positives + false_positives + positives.sum())
+        return float(self.lower_edges()[np.nanargmax(f1)])
+
+    def fpr_threshold(self, target_fpr: float) -> float:
+        """Lowest threshold at a bin edge whose false positive rate does not exceed target_fpr."""
+        _, negatives = self.counts()
+        fpr = np.cumsum(negatives) / negatives.sum()
+        within = np.flatnonzero(fpr <= target_fpr)
+        # even the highest bin has too many false positives: nothing is anomalous
+        return float(self.lower_edges()[within[-1]]) if len(within) else float(self.high)
+
+    def recall_threshold(self, target_recall: float) -> float:
+        """Highest threshold at a bin edge whose recall reaches target_recall."""
+        positives, _ = self.counts()
+        recall = np.cumsum(positives) / positives.sum()
+        return float(self.lower_edges()[np.argmax(recall >= target_recall - 1e-12)])
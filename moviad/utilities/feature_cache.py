@@ -0,0 +1,157 @@
+"""
+Content-addressed on-disk cache of backbone features.
+
+The features of an image are stored as a .npy file named after the hash of the input
+tensor, in a directory named after the hash of the feature extractor configuration,
+fingerprint of its weights included. Identical inputs are thus recognized whatever
+dataset, path or transform produced them, and any change of the transform changes the
+input tensor, and so the key.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import Callable
+
+import numpy as np
+import torch
+
+
+class FeatureCache:
+
+    def __init__(self, directory: str, dtype: str = "float32"):
+        """
+        Constructor
+
+        Args:
+            directory (str): root directory of the cache
+            dtype (str): type of the stored features, "float32" or "float16"
+        """
+
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported feature cache type {dtype}, choose float32 or float16")
+
+        self.directory = directory
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def namespace(*config) -> str:
+        """
+        Key of a feature extractor configuration, e.g. backbone, layers, input size and
+        the weights_fingerprint of the backbone
+
+        Args:
+            config: the values the features depend on, besides the input image
+        """
+
+        return hashlib.sha1(repr(config).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def weights_fingerprint(module: torch.nn.Module) -> str:
+        """
+        Hash of the weights and buffers of a module, so that a fine-tuned or retrained
+        backbone does not get the features cached for other weights
+
+        Args:
+            module (torch.nn.Module): the backbone
+        """
+
+        digest = hashlib.sha1()
+        for name, value in module.state_dict().items():
+            digest.update(name.encode())
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu().contiguous().reshape(-1)
+                digest.update(f"{value.dtype}".encode())
+                digest.update(value.view(torch.uint8).numpy().tobytes())
+            else:
+                digest.update(repr(value).encode())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def image_key(image: torch.Tensor) -> str:
+        """
+        Key of an input image, the hash of its content, shape and type
+
+        Args:
+            image (torch.Tensor): a single input tensor, e.g. of shape (C, H, W)
+        """
+
+        image = image.detach().cpu().contiguous()
+        digest = hashlib.sha1(f"{tuple(image.shape)}{image.dtype}".encode())
+        digest.update(image.numpy().tobytes())
+        return digest.hexdigest()
+
+    def path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.directory, namespace, key[:2], key + ".npy")
+
+    def load(self, namespace: str, key: str) -> np.ndarray | None:
+        """
+        Return the memory-mapped features of an image, or None if they are not cached.
+        The map is copy-on-write, so that torch can wrap it without a read-only warning,
+        and the writes to the tensor never reach the file
+        """
+
+        path = self.path(namespace, key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="c")
+
+    def store(self, namespace: str, key: str, features: torch.Tensor) -> None:
+        """
+        Store the features of an image, writing to a temporary file first so that
+        concurrent readers never see a partial file
+        """
+
+        path = self.path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            np.save(file, features.detach().cpu().numpy().astype(self.dtype))
+        os.replace(temporary_path, path)
+
+    def get_or_compute(
+        self,
+        namespace: str,
+        images: torch.Tensor,
+        compute: Callable[[torch.Tensor], torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Return the features of a batch of images, computing and storing only the missing ones
+
+        Args:
+            namespace (str): key of the feature extractor configuration
+            images (torch.Tensor): batch of input images
+            compute (Callable): computes the features of a batch of images, of shape (B, ...)
+
+        Returns:
+            torch.Tensor: the features of the batch, on the device of the computed ones or of the images
+        """
+
+        keys = [FeatureCache.image_key(image) for image in images]
+        cached = [self.load(namespace, key) for key in keys]
+        missing = [i for i, features in enumerate(cached) if features is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        device = images.device
+        if missing:
+            computed = compute(images if len(missing) == len(keys) else images[missing])
+            if self.dtype == "float16":
+                # round the fresh features too, so that hits and misses give the same values
+                computed = computed.half().float()
+            for i, image_features in zip(missing, computed):
+                self.store(namespace, keys[i], image_features)
+                cached[i] = image_features
+            if len(missing) == len(keys):
+                return computed
+            device = computed.device
+
+        return torch.stack([
+            torch.from_numpy(np.asarray(features, dtype=np.float32)).to(device)
+            if isinstance(features, np.ndarray) else features.to(device, torch.float32)
+            for features in cached
+        ])
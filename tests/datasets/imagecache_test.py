@@ -0,0 +1,60 @@
+import pickle
+import unittest
+
+import torch
+
+from moviad.datasets.image_cache import DecodedImageCache
+from moviad.datasets.image_loader import LazyImages
+
+
+class DecodedImageCacheTests(unittest.TestCase):
+    def test_least_recently_used_images_are_evicted_by_bytes(self):
+        image_bytes = 3 * 4 * 4 * 4
+        cache = DecodedImageCache(max_bytes=2 * image_bytes)
+        cache.put("a", torch.zeros(3, 4, 4))
+        cache.put("b", torch.ones(3, 4, 4))
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", torch.ones(3, 4, 4))
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.bytes, 2 * image_bytes)
+
+        cache.put("large", torch.zeros(3, 8, 8))
+        self.assertNotIn("large", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_datasets_share_the_images_with_the_same_key(self):
+        cache = DecodedImageCache()
+        decoded = []
+
+        def decode(path):
+            decoded.append(path)
+            return torch.full((3, 2, 2), float(len(path)))
+
+        paths = ["a.png", "bb.png"]
+        train = LazyImages(paths, decode, cache=cache, cache_key=((2, 2), True))
+        test = LazyImages(paths, decode, cache=cache, cache_key=((2, 2), True))
+        other = LazyImages(paths, decode, cache=cache, cache_key=((2, 2), False))
+        for images in (train, test, other):
+            for index in range(len(paths)):
+                images[index]
+
+        self.assertEqual(decoded, paths + paths)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(train.decoded_images + test.decoded_images, 2)
+
+    def test_shared_memory_cache_can_be_pickled(self):
+        cache = DecodedImageCache(shared_memory=True)
+        cache.put("a", torch.rand(3, 4, 4))
+        self.assertTrue(cache.get("a").is_shared())
+
+        restored = pickle.loads(pickle.dumps(cache))
+        torch.testing.assert_close(restored.get("a"), cache.get("a"))
+        restored.put("b", torch.zeros(1))
+        self.assertIn("b", restored)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from moviad.datasets.image_loader import LazyImages
+
+
+class LazyImagesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for index in range(6):
+            path = os.path.join(self.directory.name, f"{index:03d}.png")
+            Image.fromarray(np.full((8, 8, 3), index * 10, dtype=np.uint8)).save(path)
+            self.paths.append(path)
+        self.decoded_paths = []
+        self.to_tensor = transforms.ToTensor()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def decode(self, path):
+        self.decoded_paths.append(path)
+        with Image.open(path) as image:
+            return self.to_tensor(image.convert("RGB"))
+
+    def test_images_are_decoded_on_access(self):
+        images = LazyImages(self.paths, self.decode)
+        self.assertEqual(len(images), 6)
+        self.assertEqual(self.decoded_paths, [])
+
+        torch.testing.assert_close(images[2], torch.full((3, 8, 8), 20 / 255))
+        self.assertEqual(self.decoded_paths, [self.paths[2]])
+        self.assertEqual(images.decoded_bytes, 3 * 8 * 8 * 4)
+
+    def test_preload_decodes_every_image_once(self):
+        images = LazyImages(self.paths, self.decode, num_workers=3)
+        images.preload()
+        self.assertEqual(sorted(self.decoded_paths), self.paths)
+        self.assertEqual(images.decoded_images, 6)
+
+        for index in range(6):
+            torch.testing.assert_close(images[index], torch.full((3, 8, 8), index * 10 / 255))
+        self.assertEqual(len(self.decoded_paths), 6)
+
+    def test_subset_and_extend_keep_the_decoded_images(self):
+        images = LazyImages(self.paths, self.decode)
+        images.preload()
+        moved = images.subset([1, 4])
+        kept = images.subset([0, 2, 3, 5])
+        kept.extend(moved)
+
+        self.assertEqual(kept.paths, [self.paths[index] for index in (0, 2, 3, 5, 1, 4)])
+        torch.testing.assert_close(kept[5], torch.full((3, 8, 8), 40 / 255))
+        self.assertEqual(len(self.decoded_paths), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
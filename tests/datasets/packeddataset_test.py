@@ -0,0 +1,74 @@
+import tempfile
+import unittest
+
+import torch
+from torch.utils.data import Dataset
+
+from moviad.datasets.packed.packed_dataset import PackedIadDataset, pack_dataset
+from moviad.utilities.configurations import Split, LabelName
+
+
+class SyntheticSplit(Dataset):
+    def __init__(self, split: Split, num_samples=5, size=(12, 10)):
+        self.split = split
+        self.category = "synthetic"
+        generator = torch.Generator().manual_seed(0)
+        # images with uint8 levels, packed without loss
+        self.images = torch.randint(0, 256, (num_samples, 3, *size), generator=generator).float() / 255
+        self.masks = torch.zeros(num_samples, 1, *size)
+        self.masks[num_samples // 2:, :, 2:7, 3:5] = 1
+        self.labels = (self.masks.flatten(1).amax(dim=1) > 0).long()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        if self.split == Split.TRAIN:
+            return self.images[idx]
+        return self.images[idx], self.labels[idx], self.masks[idx], f"image_{idx}.png"
+
+
+class PackedDatasetTests(unittest.TestCase):
+    def test_test_split_round_trip(self):
+        source = SyntheticSplit(Split.TEST)
+        with tempfile.TemporaryDirectory() as output_dir:
+            pack_dataset(source, output_dir, batch_size=2)
+            dataset = PackedIadDataset(output_dir, Split.TEST)
+            dataset.load_dataset()
+
+            self.assertEqual(len(dataset), len(source))
+            self.assertEqual(dataset.category, "synthetic")
+            for idx in range(len(source)):
+                image, label, mask, path = dataset[idx]
+                torch.testing.assert_close(image, source.images[idx])
+                torch.testing.assert_close(mask, source.masks[idx])
+                self.assertEqual(label, source.labels[idx].item())
+                self.assertEqual(path, f"image_{idx}.png")
+            self.assertTrue(dataset.contains({"image_path": "image_0.png"}))
+            self.assertGreater(dataset.compute_contamination_ratio(), 0.0)
+
+    def test_train_split_normalization(self):
+        source = SyntheticSplit(Split.TRAIN)
+        with tempfile.TemporaryDirectory() as output_dir:
+            pack_dataset(source, output_dir, norm=True)
+            dataset = PackedIadDataset(output_dir, Split.TRAIN)
+            dataset.load_dataset()
+
+            mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+            std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+            torch.testing.assert_close(dataset[1], (source.images[1] - mean) / std)
+            self.assertTrue((dataset.samples["label_index"] == LabelName.NORMAL.value).all())
+
+            with self.assertRaises(ValueError):
+                PackedIadDataset(output_dir, Split.TEST).load_dataset()
+
+    def test_normalized_images_are_rejected(self):
+        source = SyntheticSplit(Split.TRAIN)
+        source.images = source.images - 0.5
+        with tempfile.TemporaryDirectory() as output_dir:
+            with self.assertRaises(ValueError):
+                pack_dataset(source, output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+from moviad.datasets.preprocessing import BatchPreprocessor, PreprocessedDataLoader, raw_collate
+
+
+class RawSamples(Dataset):
+    def __init__(self, sizes):
+        generator = torch.Generator().manual_seed(0)
+        self.images = [torch.randint(0, 256, (3, *size), dtype=torch.uint8, generator=generator) for size in sizes]
+        self.masks = [torch.zeros(1, *size, dtype=torch.uint8) for size in sizes]
+        for mask in self.masks[1:]:
+            mask[:, :4, :4] = 255
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.images[idx], int(idx > 0), self.masks[idx], f"image_{idx}.png"
+
+
+class BatchPreprocessorTests(unittest.TestCase):
+    def test_images_match_the_per_sample_transforms(self):
+        dataset = RawSamples([(32, 32)] * 3)
+        preprocessor = BatchPreprocessor((16, 16))
+        transform = transforms.Compose([
+            transforms.ConvertImageDtype(torch.float32),
+            transforms.Resize((16, 16), antialias=True),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        ])
+
+        images, labels, masks, paths = preprocessor(next(iter(DataLoader(dataset, batch_size=3))))
+        expected = torch.stack([transform(image) for image in dataset.images])
+        torch.testing.assert_close(images, expected, atol=1e-4, rtol=1e-4)
+        self.assertEqual(masks.shape, (3, 1, 16, 16))
+        self.assertEqual(set(masks.unique().tolist()), {0.0, 1.0})
+        self.assertEqual(masks[1, 0, :2, :2].tolist(), [[1.0, 1.0], [1.0, 1.0]])
+        self.assertEqual(masks[0].sum().item(), 0)
+
+    def test_images_of_different_sizes(self):
+        dataset = RawSamples([(32, 32), (24, 40)])
+        dataloader = DataLoader(dataset, batch_size=2, collate_fn=raw_collate)
+        images, labels, masks, paths = next(iter(dataloader))
+        self.assertIsInstance(images, list)
+
+        loader = PreprocessedDataLoader(dataloader, BatchPreprocessor((16, 16), normalize=False))
+        self.assertEqual(len(loader), 1)
+        self.assertIs(loader.dataset, dataset)
+        images, labels, masks, paths = next(iter(loader))
+        self.assertEqual(images.shape, (2, 3, 16, 16))
+        self.assertEqual(masks.shape, (2, 1, 16, 16))
+        self.assertTrue(0 <= images.min() and images.max() <= 1)
+        self.assertEqual(labels.tolist(), [0, 1])
+
+    def test_training_batches(self):
+        images = torch.randint(0, 256, (4, 3, 8, 8), dtype=torch.uint8)
+        processed = BatchPreprocessor((8, 8), normalize=False)(images)
+        torch.testing.assert_close(processed, images.float() / 255)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from moviad.datasets.sample_index import SampleIndex
+
+
+class SampleIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.samples = SampleIndex.from_dataframe(pd.DataFrame({
+            "image_path": [f"test/{index:03d}.png" for index in range(6)],
+            "label_index": [0, 0, 1, 1, 0, 1],
+            "mask_path": ["", "", "gt/002.png", "gt/003.png", "", "gt/005.png"],
+        }))
+
+    def test_columns_and_selection(self):
+        self.assertEqual(len(self.samples), 6)
+        self.assertEqual(self.samples["image_path"][3], "test/003.png")
+        self.assertEqual(self.samples["label_index"].dtype, np.int64)
+
+        abnormal = self.samples[self.samples["label_index"] == 1]
+        self.assertEqual(len(abnormal), 3)
+        self.assertEqual(list(abnormal["mask_path"]), ["gt/002.png", "gt/003.png", "gt/005.png"])
+        self.assertEqual(list(self.samples[np.array([4, 0])]["image_path"]), ["test/004.png", "test/000.png"])
+
+    def test_contains(self):
+        self.assertTrue(self.samples.contains("test/002.png"))
+        self.assertFalse(self.samples.contains("train/002.png"))
+        self.assertFalse(self.samples[np.array([0, 1])].contains("test/002.png"))
+
+    def test_concat(self):
+        moved = self.samples[np.array([2, 5])]
+        kept = self.samples[np.setdiff1d(np.arange(6), [2, 5])]
+        merged = kept.concat(moved)
+
+        self.assertEqual(len(merged), 6)
+        self.assertEqual(list(merged["label_index"]), [0, 0, 1, 0, 1, 1])
+        self.assertTrue(merged.contains("test/005.png"))
+        with self.assertRaises(ValueError):
+            merged.concat(SampleIndex({"image_path": np.array(["a.png"], dtype=object)}))
+
+    def test_to_dataframe(self):
+        dataframe = self.samples.to_dataframe()
+        self.assertEqual(list(dataframe.columns), ["image_path", "label_index", "mask_path"])
+        self.assertEqual(len(dataframe), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score, auc, average_precision_score, precision_recall_curve, roc_curve
+from skimage.measure import label, regionprops
+from torch.utils.data import DataLoader, Dataset
+
+from moviad.models.patchcore.anomaly_map import AnomalyMapGenerator
+from moviad.utilities.evaluation.evaluator import Evaluator
+from moviad.utilities.evaluation.metrics import MetricLvl, RocAuc, ProAuc, AvgPrec, F1, RocCurve, BinaryCurve
+from moviad.utilities.evaluation.metric_engine import MetricEngine
+from moviad.utilities.evaluation.calibration import ThresholdCalibrator, OperatingPoints
+from moviad.utilities.evaluation.streaming_metrics import ScoreHistogram
+
+
+class SyntheticAnomalyDataset(Dataset):
+    def __init__(self, num_samples=10, size=16):
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.rand(num_samples, 3, size, size, generator=generator)
+        # the first pixel holds the index of the image, for the oracle model
+        self.images[:, 0, 0, 0] = torch.arange(num_samples)
+        self.masks = torch.zeros(num_samples, 1, size, size)
+        self.masks[num_samples // 2:, :, 4:9, 4:9] = 1
+        self.labels = (self.masks.flatten(1).amax(dim=1) > 0).long()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.images[idx], self.labels[idx], self.masks[idx], f"image_{idx}.png"
+
+
+class MaskOracle(torch.nn.Module):
+    """Predicts the ground truth masks of the dataset, plus a little noise."""
+
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+
+    def forward(self, images):
+        idx = images[:, 0, 0, 0].long()
+        maps = self.dataset.masks[idx] + 0.1 * images.mean(dim=1, keepdim=True)
+        return maps, maps.flatten(1).amax(dim=1)
+
+
+class ScoreOracle(MaskOracle):
+    """Predicts the image scores only, as PatchCore with compute_anomaly_maps=False."""
+
+    def forward(self, images):
+        return None, super().forward(images)[1]
+
+
+class EvaluatorTests(unittest.TestCase):
+    def setUp(self):
+        self.dataset = SyntheticAnomalyDataset()
+        self.model = MaskOracle(self.dataset)
+
+    def test_collect_fills_preallocated_buffers(self):
+        evaluator = Evaluator(DataLoader(self.dataset, batch_size=3), device="cpu")
+        results = evaluator.collect(self.model)
+
+        self.assertEqual(results["pred_anom_map"].dtype, np.float32)
+        self.assertEqual(results["gt_mask"].dtype, np.uint8)
+        self.assertEqual(results["pred_anom_map"].shape, (10, 1, 16, 16))
+        np.testing.assert_array_equal(results["gt_label"], self.dataset.labels.numpy())
+        np.testing.assert_array_equal(results["gt_mask"], self.dataset.masks.numpy())
+
+        # memory-mapped buffers and a dataloader dropping the last batch
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            evaluator = Evaluator(DataLoader(self.dataset, batch_size=3, drop_last=True), "cpu", memmap_dir=memmap_dir)
+            memmapped = evaluator.collect(self.model)
+            self.assertIsInstance(memmapped["pred_anom_map"], np.memmap)
+            np.testing.assert_array_equal(memmapped["pred_anom_map"], results["pred_anom_map"][:9])
+            del memmapped
+
+    def test_evaluate_returns_report(self):
+        evaluator = Evaluator(DataLoader(self.dataset, batch_size=4), device="cpu")
+        report = evaluator.evaluate(self.model)
+
+        self.assertEqual(
+            list(report),
+            ["img_roc_auc", "pxl_roc_auc", "img_f1", "pxl_f1", "img_pr_auc", "pxl_pr_auc", "pxl_au_pro"],
+        )
+        self.assertAlmostEqual(report["img_roc_auc"], 1.0)
+        self.assertAlmostEqual(report["pxl_roc_auc"], 1.0)
+
+        evaluator = Evaluator(DataLoader(self.dataset, batch_size=4), "cpu", metrics=[RocAuc(MetricLvl.PIXEL)])
+        report = evaluator.evaluate(self.model, postprocess=lambda maps: maps)
+        maps, _ = self.model(self.dataset.images)
+        expected = roc_auc_score(self.dataset.masks.flatten().numpy(), maps.flatten().numpy())
+        self.assertAlmostEqual(report["pxl_roc_auc"], expected, places=5)
+
+    def test_models_without_anomaly_maps(self):
+        model = ScoreOracle(self.dataset)
+        with self.assertRaises(ValueError):
+            Evaluator(DataLoader(self.dataset, batch_size=4), device="cpu").evaluate(model)
+
+        metrics = [RocAuc(MetricLvl.IMAGE), F1(MetricLvl.IMAGE)]
+        report = Evaluator(DataLoader(self.dataset, batch_size=4), "cpu", metrics=metrics).evaluate(model)
+        self.assertEqual(list(report), ["img_roc_auc", "img_f1"])
+        self.assertAlmostEqual(report["img_roc_auc"], 1.0)
+
+
+
+def reference_au_pro(gt, pred, max_step=200, expect_fpr=0.3):
+    """The per-threshold AU-PRO, relabeling the ground truth and calling regionprops at every threshold."""
+    gt = np.squeeze(gt, axis=1) > 0.5
+    pred = np.squeeze(pred, axis=1)
+    max_th, min_th = pred.max(), pred.min()
+    delta = (max_th - min_th) / max_step
+    pros_mean, fprs = [], []
+    for step in range(max_step):
+        binary_score_maps = pred > max_th - step * delta
+        pro = []
+        for i in range(len(binary_score_maps)):
+            for prop in regionprops(label(gt[i], connectivity=2), binary_score_maps[i]):
+                pro.append(prop.intensity_image.sum() / prop.area)
+        pros_mean.append(np.mean(pro))
+        fprs.append(np.logical_and(~gt, binary_score_maps).sum() / (~gt).sum())
+    pros_mean, fprs = np.array(pros_mean), np.array(fprs)
+    idx = fprs <= expect_fpr
+    return auc(ProAuc.rescale(fprs[idx]), ProAuc.rescale(pros_mean[idx]))
+
+
+class ProAucTests(unittest.TestCase):
+    def test_matches_per_threshold_regionprops(self):
+        rng = np.random.default_rng(0)
+        gt = np.zeros((6, 1, 24, 24), dtype=np.uint8)
+        gt[1, :, 2:6, 3:9] = 1
+        gt[1, :, 15:20, 15:17] = 1
+        gt[3, :, 10:14, 10:14] = 1
+        gt[4, :, 0:3, 20:24] = 1
+        pred = (rng.random(gt.shape) + 0.8 * gt * rng.random(gt.shape)).astype(np.float32)
+        gt_copy = gt.copy()
+
+        au_pro = ProAuc(MetricLvl.PIXEL).compute(gt, pred)
+
+        np.testing.assert_array_equal(gt, gt_copy)
+        self.assertAlmostEqual(au_pro, reference_au_pro(gt, pred), places=6)
+
+
+class StreamingMetricsTests(unittest.TestCase):
+    def test_histogram_metrics_within_error_bounds(self):
+        generator = torch.Generator().manual_seed(0)
+        gt = torch.rand(8, 1, 32, 32, generator=generator) > 0.9
+        pred = torch.randn(8, 1, 32, 32, generator=generator) + 1.5 * gt
+        # the last batch widens the range, the adaptive histogram has to grow
+        pred[6:] *= 3
+
+        histogram = ScoreHistogram(num_bins=256)
+        for gt_batch, pred_batch in zip(gt.split(3), pred.split(3)):
+            histogram.update(gt_batch, pred_batch)
+        flat_gt, flat_pred = gt.flatten().numpy(), pred.flatten().numpy()
+        precision, recall, _ = precision_recall_curve(flat_gt, flat_pred)
+        exact = {
+            "roc_auc": roc_auc_score(flat_gt, flat_pred),
+            "average_precision": average_precision_score(flat_gt, flat_pred),
+            "max_f1": np.max(2 * precision * recall / np.maximum(precision + recall, 1e-12)),
+        }
+        for name, exact_value in exact.items():
+            value, error = getattr(histogram, name)()
+            self.assertLess(error, 0.1, name)
+            self.assertLessEqual(abs(value - exact_value), error + 1e-9, name)
+
+    def test_evaluator_streams_pixel_metrics(self):
+        dataset = SyntheticAnomalyDataset()
+        metrics = [RocAuc(MetricLvl.PIXEL), AvgPrec(MetricLvl.PIXEL), F1(MetricLvl.PIXEL), RocAuc(MetricLvl.IMAGE)]
+        evaluator = Evaluator(DataLoader(dataset, batch_size=4), "cpu", metrics=metrics, streaming_bins=1024)
+
+        self.assertNotIn("pred_anom_map", evaluator.collect(MaskOracle(dataset)))
+        report = evaluator.evaluate(MaskOracle(dataset))
+        self.assertEqual(set(evaluator.streaming_errors), {"pxl_roc_auc", "pxl_pr_auc", "pxl_f1"})
+        self.assertAlmostEqual(report["pxl_roc_auc"], 1.0, delta=evaluator.streaming_errors["pxl_roc_auc"])
+        self.assertAlmostEqual(report["img_roc_auc"], 1.0)
+
+
+class MetricEngineTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.labels = rng.random(200) > 0.7
+        # rounded scores, so that there are ties
+        self.scores = np.round(rng.random(200) + 0.5 * self.labels, 1)
+        self.masks = (rng.random((6, 1, 16, 16)) > 0.8).astype(np.uint8)
+        self.maps = rng.random((6, 1, 16, 16)).astype(np.float32) + 0.5 * self.masks
+
+    def test_curve_matches_sklearn(self):
+        curve = BinaryCurve(self.labels, self.scores)
+        precision, recall, _ = precision_recall_curve(self.labels, self.scores)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(precision),
+                       where=precision + recall != 0)
+        fpr, tpr, _ = roc_curve(self.labels, self.scores)
+
+        self.assertAlmostEqual(curve.roc_auc(), roc_auc_score(self.labels, self.scores))
+        self.assertAlmostEqual(curve.average_precision(), average_precision_score(self.labels, self.scores))
+        self.assertAlmostEqual(curve.max_f1(), np.max(f1))
+        np.testing.assert_allclose(curve.roc_curve(), (fpr, tpr))
+
+    def test_engine_report_matches_metrics(self):
+        metrics = [
+            RocAuc(MetricLvl.IMAGE), AvgPrec(MetricLvl.IMAGE), F1(MetricLvl.IMAGE), RocCurve(MetricLvl.IMAGE),
+            RocAuc(MetricLvl.PIXEL), AvgPrec(MetricLvl.PIXEL), ProAuc(MetricLvl.PIXEL),
+        ]
+        report = MetricEngine(metrics).compute({
+            MetricLvl.IMAGE: (self.labels, self.scores),
+            MetricLvl.PIXEL: (self.masks, self.maps),
+        })
+
+        self.assertEqual(list(report), [metric.name for metric in metrics])
+        self.assertAlmostEqual(report["img_roc_auc"], roc_auc_score(self.labels, self.scores))
+        self.assertAlmostEqual(report["pxl_roc_auc"], roc_auc_score(self.masks.ravel(), self.maps.ravel()))
+        self.assertAlmostEqual(report["pxl_au_pro"], ProAuc(MetricLvl.PIXEL).compute(self.masks, self.maps))
+
+
+class ThresholdCalibrationTests(unittest.TestCase):
+    def test_calibrate_save_and_apply(self):
+        dataset = SyntheticAnomalyDataset()
+        model = MaskOracle(dataset)
+        calibrator = ThresholdCalibrator(num_bins=512, target_fprs=(0.0,), target_recalls=(1.0,))
+        operating_points = calibrator.calibrate(model, DataLoader(dataset, batch_size=3), "cpu")
+
+        self.assertEqual(set(operating_points.image), {"max_f1", "fpr_0", "recall_1"})
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint_path = f"{directory}/model.pt"
+            operating_points.save(checkpoint_path)
+            loaded = OperatingPoints.load(checkpoint_path)
+        self.assertEqual(loaded, operating_points)
+
+        # the oracle separates the classes, every operating point is perfect
+        anom_maps, anom_scores = model(dataset.images)
+        for point in operating_points.image:
+            torch.testing.assert_close(loaded.decide(anom_scores, point), dataset.labels.bool())
+            torch.testing.assert_close(loaded.segment(anom_maps, point), dataset.masks.bool())
+
+    def test_normalized_anomaly_maps_are_rejected(self):
+        dataset = SyntheticAnomalyDataset()
+        model = MaskOracle(dataset)
+        model.anomaly_map_generator = AnomalyMapGenerator(normalization="batch")
+        with self.assertRaises(ValueError):
+            ThresholdCalibrator().calibrate(model, DataLoader(dataset, batch_size=3), "cpu")
+
+    def test_fixed_fpr_and_recall_thresholds(self):
+        calibrator = ThresholdCalibrator(num_bins=10, target_fprs=(0.25,), target_recalls=(0.5,))
+        scores = torch.arange(10, dtype=torch.float32)
+        labels = torch.tensor([0, 0, 0, 0, 0, 1, 0, 1, 1, 1])
+        calibrator.update(labels, scores)
+        points = calibrator.operating_points()
+
+        # one false positive out of six normal images is the most within the target FPR,
+        # the two highest scores give half the recall, the five highest the best F1
+        flagged = lambda point: torch.nonzero(points.decide(scores, point)).flatten().tolist()
+        self.assertEqual(flagged("fpr_0.25"), [5, 6, 7, 8, 9])
+        self.assertEqual(flagged("recall_0.5"), [8, 9])
+        self.assertEqual(flagged("max_f1"), [5, 6, 7, 8, 9])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
 import unittest
 
+import numpy as np
 import torch
+from scipy.spatial.distance import mahalanobis
 from torch.utils.data import DataLoader
 from torchvision.transforms import transforms, InterpolationMode
 
@@ -9,6 +11,10 @@ from moviad.datasets.builder import DatasetConfig
 from moviad.datasets.mvtec.mvtec_dataset import MVTecDataset
 from moviad.entrypoints.padim import PadimArgs
 from moviad.models.padim.padim import Padim
+from moviad.models.padim.online_gaussian import OnlineGaussianEstimator
+from moviad.models.padim.covariance import build_covariance_model
+from moviad.models.padim.mahalanobis import precision_matrices, mahalanobis_distances, \
+    mahalanobis_distances_diagonal, cholesky_with_jitter
 from moviad.profiler.pytorch_profiler import Profiler
 from moviad.trainers.trainer_padim import TrainerPadim
 from moviad.utilities.configurations import TaskType, Split
@@ -93,7 +99,7 @@ class PadimTrainTests(unittest.TestCase):
         with profiler.profile_step():
             trainer.train()
             img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = (
-                evaluator.evaluate(padim)
+                evaluator.evaluate(padim).values()
             )
 
         print("Evaluation performances:")
@@ -164,7 +170,7 @@ class PadimTrainTests(unittest.TestCase):
         with profiler.profile_step():
             trainer.train()
             img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = (
-                evaluator.evaluate(padim)
+                evaluator.evaluate(padim).values()
             )
 
         profiler.end_profiling()
@@ -183,5 +189,100 @@ class PadimTrainTests(unittest.TestCase):
         )
 
 
+class PadimMahalanobisTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.embeddings = rng.standard_normal((4, 8, 12)).astype(np.float32)
+        self.mean = rng.standard_normal((8, 12)).astype(np.float32)
+        factors = rng.standard_normal((12, 8, 8))
+        # (C, C, H*W) covariances, as stored by Padim
+        self.cov = (factors @ factors.transpose(0, 2, 1) + 0.01 * np.eye(8)).transpose(1, 2, 0)
+
+    def test_batched_distances_match_scipy(self):
+        precision = precision_matrices(self.cov, dtype=torch.float64)
+        distances = mahalanobis_distances(
+            torch.from_numpy(self.embeddings).double(), torch.from_numpy(self.mean).double(), precision
+        )
+        expected = np.array([
+            [
+                mahalanobis(sample[:, i], self.mean[:, i], np.linalg.inv(self.cov[:, :, i]))
+                for i in range(12)
+            ]
+            for sample in self.embeddings
+        ])
+        np.testing.assert_allclose(distances.numpy(), expected, rtol=1e-6)
+
+    def test_float32_precision_with_jitter(self):
+        precision = precision_matrices(self.cov)
+        self.assertEqual(precision.dtype, torch.float32)
+        torch.testing.assert_close(
+            precision.double(), precision_matrices(self.cov, dtype=torch.float64), rtol=1e-2, atol=1e-3
+        )
+
+        # rank deficient covariances are factorized with a jitter instead of failing
+        factors = torch.randn(5, 8, 3)
+        singular = factors @ factors.transpose(1, 2)
+        cholesky = cholesky_with_jitter(singular.clone())
+        self.assertTrue(torch.isfinite(cholesky).all())
+        torch.testing.assert_close(cholesky @ cholesky.transpose(1, 2), singular, rtol=1e-3, atol=1e-3)
+
+    def test_diagonal_distances(self):
+        variances = np.stack([np.diag(self.cov[:, :, i]) for i in range(12)], axis=1)
+        distances = mahalanobis_distances_diagonal(
+            torch.from_numpy(self.embeddings), torch.from_numpy(self.mean), torch.from_numpy(variances).float()
+        )
+        expected = np.sqrt((((self.embeddings - self.mean) ** 2) / variances).sum(axis=1))
+        np.testing.assert_allclose(distances.numpy(), expected, rtol=1e-4)
+
+    def test_vectorized_embedding_concat(self):
+        x, y = torch.rand(2, 4, 8, 8), torch.rand(2, 3, 4, 4)
+        z = Padim.embedding_concat(x, y)
+        self.assertEqual(z.shape, (2, 7, 8, 8))
+        torch.testing.assert_close(z[:, :4], x)
+        torch.testing.assert_close(z[:, 4:, 5, 2], y[:, :, 2, 1])
+
+    def test_online_gaussian_matches_batch_fit(self):
+        embeddings = torch.randn(25, 8, 3, 4) * 3 + 1
+        flat = embeddings.view(25, 8, 12).double().numpy()
+        expected_cov = np.stack([np.cov(flat[:, :, i], rowvar=False) + 0.01 * np.eye(8) for i in range(12)], axis=2)
+
+        for diagonal in (False, True):
+            estimator = OnlineGaussianEstimator(diagonal=diagonal)
+            for batch in embeddings.split(7):
+                estimator.update(batch)
+            mean, cov = estimator.finalize()
+
+            np.testing.assert_allclose(mean, flat.mean(axis=0), atol=1e-8)
+            if diagonal:
+                np.testing.assert_allclose(cov, np.diagonal(expected_cov, axis1=0, axis2=1).T, atol=1e-8)
+            else:
+                np.testing.assert_allclose(cov, expected_cov, atol=1e-8)
+
+    def test_compact_covariance_models(self):
+        embeddings, mean = torch.from_numpy(self.embeddings).double(), torch.from_numpy(self.mean).double()
+        cov = torch.from_numpy(self.cov).permute(2, 0, 1)
+        exact = mahalanobis_distances(embeddings, mean, precision_matrices(self.cov, dtype=torch.float64))
+
+        # a full rank and a one patch per cluster model are exact
+        for name, params in (("low_rank", {"rank": 8}), ("clustered", {"grid": (3, 4)})):
+            model = build_covariance_model(name, dtype=torch.float64, **params)
+            model.fit(mean, cov, feature_size=(3, 4))
+            torch.testing.assert_close(model.distances(embeddings), exact, rtol=1e-3, atol=1e-3)
+
+        shared = build_covariance_model("shared", dtype=torch.float64)
+        shared.fit(mean, cov, feature_size=(3, 4))
+        pooled = np.repeat(self.cov.mean(axis=2, keepdims=True), 12, axis=2)
+        expected = mahalanobis_distances(embeddings, mean, precision_matrices(pooled, dtype=torch.float64))
+        torch.testing.assert_close(shared.distances(embeddings), expected, rtol=1e-3, atol=1e-3)
+
+        low_rank = build_covariance_model("low_rank", rank=2, dtype=torch.float64)
+        low_rank.fit(mean, cov, feature_size=(3, 4))
+        self.assertEqual(low_rank.distances(embeddings).shape, (4, 12))
+        self.assertEqual(low_rank.params["projection"].shape, (12, 2, 8))
+        full_size = (mean.numel() + cov.numel()) * 8 / 1024**2
+        self.assertLess(shared.size, low_rank.size)
+        self.assertLess(low_rank.size, full_size)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,27 +1,36 @@
 import os.path
+import tempfile
 import unittest
+import warnings
 
 import numpy as np
 import torch
 from sklearn.cluster import MiniBatchKMeans
 from torch.utils.data import Subset
-from torchvision.transforms import transforms, InterpolationMode
+from torchvision.transforms import transforms, InterpolationMode, GaussianBlur
 
 from moviad.datasets.builder import DatasetConfig, DatasetFactory, DatasetType
 from moviad.datasets.mvtec.mvtec_dataset import MVTecDataset
 from moviad.datasets.realiad.realiad_dataset import RealIadDataset
 from moviad.datasets.realiad.realiad_dataset_configurations import RealIadCategory, RealIadClassEnum
 from moviad.entrypoints.patchcore import PatchCoreArgs
+from moviad.models.patchcore.anomaly_map import AnomalyMapGenerator
+from moviad.models.patchcore.embedding_store import EmbeddingStore
+from moviad.models.patchcore.memory_bank_storage import compress_memory_bank, decompress_memory_bank
 from moviad.models.patchcore.kcenter_greedy import CoresetExtractor
 from moviad.models.patchcore.kmeans_coreset_extractor import MiniBatchKMeansCoresetExtractor, KMeansCoresetExtractor
 from moviad.models.patchcore.patchcore import PatchCore
 from moviad.models.patchcore.product_quantizer import ProductQuantizer
+from moviad.models.patchcore.nearest_neighbor_search import BruteForceNearestNeighborSearch, \
+    ChunkedNearestNeighborSearch, ShardedNearestNeighborSearch
+from moviad.models.patchcore.memory_bank_index import IVFFlatIndex, build_memory_bank_index, compute_index_recall
 from moviad.profiler.pytorch_profiler import Profiler
 from moviad.trainers.batched_trainer_patchcore import BatchPatchCoreTrainer
 from moviad.trainers.trainer_patchcore import TrainerPatchCore
 from moviad.utilities.configurations import TaskType, Split
 from moviad.utilities.custom_feature_extractor_trimmed import CustomFeatureExtractor
 from moviad.utilities.evaluation.evaluator import Evaluator
+from moviad.utilities.feature_cache import FeatureCache
 from moviad.utilities.evaluation.metrics import compute_product_quantization_efficiency
 from tests.logger.wandb_logger import WandbLogger
 
@@ -114,7 +123,7 @@ class PatchCoreTrainTests(unittest.TestCase):
         patchcore_model.load("./patchcore_model.pt", "./product_quantizer.bin")
 
         evaluator = Evaluator(test_dataloader, self.args.device)
-        img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(patchcore_model)
+        img_roc, pxl_roc, f1_img, f1_pxl, img_pr, pxl_pr, pxl_pro = evaluator.evaluate(patchcore_model).values()
 
         print("Evaluation performances:")
         print(f"""
@@ -173,5 +182,346 @@ class PatchCoreTrainTests(unittest.TestCase):
         print(f"Model memory size: {model_memory_size}")
 
 
+class PatchCoreSearchTests(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.memory_bank = torch.rand([5000, 160], dtype=torch.float32)
+        self.queries = torch.rand([784, 160], dtype=torch.float32)
+
+    def test_chunked_search_matches_brute_force(self):
+        brute_force = BruteForceNearestNeighborSearch()
+        # a budget far smaller than a single distance row forces tiling of both queries and memory bank
+        chunked = ChunkedNearestNeighborSearch(max_bytes=64 * 1024)
+
+        for n_neighbors in (1, 9):
+            expected_scores, expected_locations = brute_force.search(self.queries, self.memory_bank, n_neighbors)
+            scores, locations = chunked.search(self.queries, self.memory_bank, n_neighbors)
+
+            self.assertEqual(scores.shape, expected_scores.shape)
+            self.assertTrue(torch.allclose(scores, expected_scores, atol=1e-4))
+            self.assertTrue(torch.equal(locations, expected_locations))
+
+    def test_chunked_search_compact_memory_bank(self):
+        for dtype in ("float16", "bfloat16", "int8"):
+            memory_bank, scale = compress_memory_bank(self.memory_bank, dtype)
+            expected, _ = BruteForceNearestNeighborSearch().search(
+                self.queries, decompress_memory_bank(memory_bank, scale), 1
+            )
+            search = ChunkedNearestNeighborSearch(max_bytes=64 * 1024)
+            distances, _ = search.search(self.queries, memory_bank, 1, scale=scale)
+            self.assertEqual(distances.dtype, torch.float32)
+            torch.testing.assert_close(distances, expected, atol=1e-3, rtol=1e-3)
+
+    def test_sharded_search_matches_brute_force(self):
+        sharded = ShardedNearestNeighborSearch(num_workers=3, max_bytes=64 * 1024)
+        try:
+            for n_neighbors in (1, 9):
+                expected_scores, expected_locations = BruteForceNearestNeighborSearch().search(
+                    self.queries, self.memory_bank, n_neighbors
+                )
+                scores, locations = sharded.search(self.queries, self.memory_bank, n_neighbors)
+                self.assertTrue(torch.allclose(scores, expected_scores, atol=1e-4))
+                self.assertTrue(torch.equal(locations, expected_locations))
+        finally:
+            sharded.close()
+
+    def test_chunked_search_tiles_respect_budget(self):
+        chunked = ChunkedNearestNeighborSearch(max_bytes=64 * 1024)
+        query_tile, bank_tile = chunked.tile_sizes(784, 5000, 9, 4)
+        self.assertLessEqual(2 * query_tile * (bank_tile + 9) * 4, chunked.max_bytes)
+
+    def test_memory_bank_index_recall(self):
+        # probing every cell makes the inverted file search exhaustive
+        index = IVFFlatIndex(nlist=16, nprobe=16)
+        index.build(self.memory_bank)
+        report = compute_index_recall(index, self.memory_bank, self.queries)
+        self.assertEqual(report["recall@1"], 1.0)
+
+        index = build_memory_bank_index("hnsw", ef_search=128)
+        index.build(self.memory_bank)
+        report = compute_index_recall(index, self.memory_bank, self.queries)
+        self.assertGreater(report["recall@1"], 0.5)
+
+        # an int8 memory bank is compared against the exact search on the same scaled codes
+        memory_bank, scale = compress_memory_bank(self.memory_bank, "int8")
+        index = IVFFlatIndex(nlist=16, nprobe=16)
+        index.build(memory_bank, scale)
+        report = compute_index_recall(index, memory_bank, self.queries, scale)
+        self.assertEqual(report["recall@1"], 1.0)
+        self.assertLess(report["score_relative_error"], 1e-3)
+
+    def test_product_quantizer_asymmetric_search(self):
+        # 200 training points make the quantizer use 5-bit codes, exercising the code unpacking
+        for memory_bank in (self.memory_bank, self.memory_bank[:200]):
+            pq = ProductQuantizer()
+            pq.fit(memory_bank)
+            codes = pq.encode(memory_bank)
+            decoded = pq.decode(codes)
+
+            distances = pq.asymmetric_distances(self.queries, codes)
+            self.assertTrue(torch.allclose(distances.sqrt(), torch.cdist(self.queries, decoded), atol=1e-3))
+
+            scores, locations = pq.search(self.queries, codes, n_neighbors=3)
+            expected_scores, _ = torch.cdist(self.queries, decoded).topk(k=3, largest=False, dim=1)
+            self.assertEqual(locations.shape, (self.queries.shape[0], 3))
+            self.assertTrue(torch.allclose(scores, expected_scores, atol=1e-3))
+
+            # re-ranking against the original vectors returns their exact distances
+            scores, locations = pq.search(self.queries, codes, n_neighbors=1, rerank=20, reference=memory_bank)
+            exact = (memory_bank[locations] - self.queries).norm(dim=1)
+            self.assertTrue(torch.allclose(scores, exact, atol=1e-4))
+
+    def test_memory_bank_index_save_and_load(self):
+        index = build_memory_bank_index("ivf_pq", nlist=16, m=8)
+        index.build(self.memory_bank)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "patchcore_model.pt.index")
+            index.save(path)
+            loaded = build_memory_bank_index("ivf_pq", nlist=16, m=8)
+            self.assertTrue(loaded.load(path))
+
+        self.assertEqual(loaded.size, self.memory_bank.shape[0])
+        _, locations = index.search(self.queries, n_neighbors=3)
+        _, loaded_locations = loaded.search(self.queries, n_neighbors=3)
+        self.assertTrue(torch.equal(locations, loaded_locations))
+
+    def test_memory_bank_index_fills_missing_neighbors(self):
+        # a single probed cell holds fewer entries than the requested neighbours
+        index = IVFFlatIndex(nlist=64, nprobe=1)
+        index.build(self.memory_bank)
+        distances, locations = index.search(self.queries[:16], n_neighbors=300)
+        self.assertTrue((locations >= 0).all())
+        self.assertTrue(torch.isfinite(distances).all())
+
+        expected, _ = BruteForceNearestNeighborSearch().search(self.queries[:16], self.memory_bank, 300)
+        self.assertTrue(torch.allclose(distances, expected, atol=1e-3))
+
+
+class PatchCoreUpdateTests(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        feature_extractor = CustomFeatureExtractor("mobilenet_v2", ["features.4", "features.7", "features.10"],
+                                                   "cpu", True, False, None)
+        self.model = PatchCore("cpu", input_size=(64, 64), feature_extractor=feature_extractor, k=100)
+        self.images = torch.rand([4, 3, 64, 64])
+
+        # the state finish_training leaves the model in, without the evaluation
+        self.model.train()
+        with torch.no_grad():
+            embeddings = self.model(self.images)
+        coreset_extractor = CoresetExtractor(False, "cpu", k=100)
+        coreset = embeddings[coreset_extractor.get_coreset_idx_randomp(embeddings)]
+        self.model.set_memory_bank(coreset)
+        self.model.coverage_radius = torch.tensor(coreset_extractor.radius)
+        projection = coreset_extractor.projection_matrix()
+        self.model.coverage_projection = projection if projection is not None else torch.Tensor()
+        self.trainer = TrainerPatchCore(self.model, None, None, "cpu", coreset_extractor=coreset_extractor)
+
+    def test_update_with_covered_images(self):
+        bank_size = self.model.memory_bank.shape[0]
+        result = self.trainer.update(self.images)
+        self.assertEqual(result["added_patches"], 0)
+        self.assertEqual(self.model.memory_bank.shape[0], bank_size)
+
+        result = self.trainer.update(torch.rand([2, 3, 64, 64]) * 4)
+        self.assertGreater(result["added_patches"], 0)
+        self.assertEqual(result["memory_bank_size"], bank_size + result["added_patches"])
+
+    def test_update_without_coverage_radius(self):
+        # models trained with k-means, or saved without a radius, have a zero one
+        self.model.coverage_radius = torch.tensor(0.0)
+        with self.assertWarns(UserWarning):
+            result = self.trainer.update(self.images)
+        self.assertEqual(result["added_patches"], 0)
+        self.assertGreater(self.model.coverage_radius.item(), 0)
+
+    def test_eviction_grows_coverage_radius(self):
+        radius = self.model.coverage_radius.item()
+        bank_size = self.model.memory_bank.shape[0]
+        self.assertEqual(self.model.evict_memory_bank_entries(60), bank_size - 60)
+        self.assertEqual(self.model.memory_bank.shape[0], 60)
+        self.assertGreater(self.model.coverage_radius.item(), radius)
+
+        # the training patches are still within the radius of the remaining entries
+        self.assertEqual(self.trainer.update(self.images)["added_patches"], 0)
+
+    def test_update_saves_coverage_radius(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.trainer.save_path = os.path.join(tmp_dir, "patchcore_model.pt")
+            result = self.trainer.update(torch.rand([2, 3, 64, 64]) * 4, max_memory_bank_size=80)
+            self.assertGreater(result["evicted_patches"], 0)
+
+            loaded = PatchCore("cpu", input_size=(64, 64), feature_extractor=self.model.feature_extractor, k=100)
+            loaded.load_model(self.trainer.save_path)
+        self.assertEqual(loaded.memory_bank.shape[0], 80)
+        self.assertEqual(loaded.coverage_radius.item(), self.model.coverage_radius.item())
+        torch.testing.assert_close(loaded.coverage_projection, self.model.coverage_projection)
+
+
+class PatchCoreAnomalyMapTests(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.patch_scores = torch.rand([4, 1, 28, 28], dtype=torch.float32)
+
+    def test_separable_blur_matches_torchvision(self):
+        generator = AnomalyMapGenerator(sigma=4, normalization="none")
+        maps = torch.rand([2, 1, 64, 64], dtype=torch.float32)
+        expected = GaussianBlur(AnomalyMapGenerator.kernel_size(4), 4)(maps)
+        torch.testing.assert_close(generator.blur(maps), expected, atol=1e-5, rtol=1e-4)
+
+    def test_image_normalization(self):
+        generator = AnomalyMapGenerator(normalization="image")
+        maps = generator(self.patch_scores * torch.arange(1, 5).view(-1, 1, 1, 1), image_size=(224, 224))
+        self.assertEqual(maps.shape, (4, 1, 224, 224))
+        torch.testing.assert_close(maps.flatten(1).amin(1), torch.zeros(4))
+        torch.testing.assert_close(maps.flatten(1).amax(1), torch.ones(4))
+
+    def test_blur_at_feature_resolution(self):
+        generator = AnomalyMapGenerator(normalization="none", blur_at_feature_resolution=True)
+        reference = AnomalyMapGenerator(normalization="none")
+        ramp = torch.linspace(0, 1, 28)
+        patch_scores = (ramp.view(-1, 1) + ramp.view(1, -1)).expand(4, 1, 28, 28)
+        maps = generator(patch_scores, image_size=(224, 224))
+        expected = reference(patch_scores, image_size=(224, 224))
+        self.assertEqual(maps.shape, expected.shape)
+        self.assertLess((maps - expected).abs().mean().item(), 0.05)
+
+
+class PatchCoreFeatureCacheTests(unittest.TestCase):
+
+    def test_feature_cache_computes_missing_features_only(self):
+        images = torch.rand([4, 3, 32, 32])
+        computed = []
+
+        def compute(batch):
+            computed.append(batch.shape[0])
+            return batch.mean(dim=1, keepdim=True) * 2
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FeatureCache(directory)
+            namespace = FeatureCache.namespace("resnet18", ["layer1", "layer2"], (3, 32, 32))
+            first = cache.get_or_compute(namespace, images[:2], compute)
+            features = cache.get_or_compute(namespace, images, compute)
+
+            self.assertEqual(computed, [2, 2])
+            self.assertEqual((cache.hits, cache.misses), (2, 4))
+            torch.testing.assert_close(features[:2], first)
+            torch.testing.assert_close(features, compute(images))
+
+            other_namespace = FeatureCache.namespace("resnet18", ["layer2", "layer3"], (3, 32, 32))
+            calls = len(computed)
+            cache.get_or_compute(other_namespace, images, compute)
+            self.assertEqual(computed[calls:], [4])
+
+            # the cached features are served as writable tensors
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                cache.get_or_compute(namespace, images[:3], compute)
+
+    def test_feature_cache_weights_fingerprint(self):
+        backbone = torch.nn.Conv2d(3, 8, 3)
+        fingerprint = FeatureCache.weights_fingerprint(backbone)
+        self.assertEqual(FeatureCache.weights_fingerprint(backbone), fingerprint)
+
+        with torch.no_grad():
+            backbone.weight[0, 0, 0, 0] += 1
+        self.assertNotEqual(FeatureCache.weights_fingerprint(backbone), fingerprint)
+
+
+class PatchCoreCoresetTests(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.embeddings = torch.rand([3000, 160], dtype=torch.float32)
+
+    def test_kcenter_greedy_selects_farthest_patch(self):
+        sampler = CoresetExtractor(False, "cpu", k=50)
+        z_lib = torch.rand([500, 16], dtype=torch.float32)
+        sampler.project = lambda z, eps: z
+        coreset_idx = sampler.get_coreset_idx_randomp(z_lib)
+
+        # reference greedy with explicit distances
+        min_distances = torch.linalg.norm(z_lib - z_lib[:1], dim=1)
+        expected = [0]
+        for _ in range(50):
+            expected.append(int(torch.argmax(min_distances)))
+            min_distances = torch.minimum(min_distances, torch.linalg.norm(z_lib - z_lib[expected[-1]], dim=1))
+        self.assertEqual(coreset_idx.tolist(), expected)
+
+    def test_kcenter_greedy_batched_centers(self):
+        sampler = CoresetExtractor(False, "cpu", k=200, centers_per_step=16)
+        coreset_idx = sampler.get_coreset_idx_randomp(self.embeddings)
+        self.assertEqual(coreset_idx.shape[0], 201)
+        self.assertEqual(len(set(coreset_idx.tolist())), 201)
+
+    def test_kcenter_greedy_tolerance(self):
+        sampler = CoresetExtractor(False, "cpu", k=2000, tolerance=1e6, tolerance_check_interval=1)
+        coreset_idx = sampler.get_coreset_idx_randomp(self.embeddings)
+        self.assertEqual(coreset_idx.shape[0], 1)
+
+    def test_kcenter_greedy_out_of_core(self):
+        z_lib = torch.rand([500, 16], dtype=torch.float32)
+        sampler = CoresetExtractor(False, "cpu", k=50)
+        sampler.project = lambda z, eps: z
+        expected = sampler.get_coreset_idx_randomp(z_lib)
+
+        # a projection that fits in memory is loaded once, a larger one is streamed at every step
+        for max_resident_bytes in (2 * 1024**3, 0):
+            coreset_idx = CoresetExtractor(False, "cpu", k=50).get_coreset_idx_out_of_core(
+                z_lib.numpy(), chunk_size=64, max_resident_bytes=max_resident_bytes, streaming_centers_per_step=1
+            )
+            self.assertEqual(coreset_idx.tolist(), expected.tolist())
+
+        # by default a streamed selection picks a block of centers per pass
+        for centers_per_step in (8, 64):
+            coreset_idx = CoresetExtractor(False, "cpu", k=50).get_coreset_idx_out_of_core(
+                z_lib.numpy(), chunk_size=64, max_resident_bytes=0, streaming_centers_per_step=centers_per_step
+            )
+            self.assertEqual(len(set(coreset_idx.tolist())), 51)
+
+    def test_kcenter_greedy_extension(self):
+        sampler = CoresetExtractor(False, "cpu", k=50)
+        z_lib = torch.rand([500, 16], dtype=torch.float32)
+        sampler.project = lambda z, eps: z
+        centers = z_lib[sampler.get_coreset_idx_randomp(z_lib)]
+
+        # patches already covered by the centers are not added, far away ones are
+        self.assertEqual(sampler.extend_coreset_idx(centers, z_lib).shape[0], 0)
+        z_new = torch.cat([z_lib[:100], z_lib[:3] + torch.tensor([[10.0], [20.0], [30.0]])])
+        self.assertEqual(sorted(sampler.extend_coreset_idx(centers, z_new).tolist()), [100, 101, 102])
+        self.assertEqual(sampler.extend_coreset_idx(centers, z_new, max_new=1).shape[0], 1)
+
+    def test_kcenter_greedy_extension_after_reload(self):
+        z_lib = torch.rand([3000, 512], dtype=torch.float32)
+        sampler = CoresetExtractor(False, "cpu", k=50)
+        centers = z_lib[sampler.get_coreset_idx_randomp(z_lib)]
+        projection = sampler.projection_matrix()
+        self.assertEqual(projection.shape[1], 512)
+
+        # a new extractor measures the distances in the projection the radius was measured in
+        reloaded = CoresetExtractor(False, "cpu", k=50)
+        new_idx = reloaded.extend_coreset_idx(centers, z_lib, radius=sampler.radius, projection=projection)
+        self.assertEqual(new_idx.shape[0], 0)
+
+    def test_embedding_store(self):
+        for dtype, tolerance in (("float16", 1e-3), ("int8", 1e-2)):
+            store = EmbeddingStore(160, dtype=dtype, reservoir_size=100)
+            for batch in self.embeddings.split(700):
+                store.append(batch)
+
+            self.assertEqual(len(store), 3000)
+            self.assertEqual(store.reservoir_sample().shape, (100, 160))
+            indices = np.array([0, 1234, 2999])
+            torch.testing.assert_close(store.gather(indices), self.embeddings[indices], atol=tolerance, rtol=0)
+
+            projection = store.project(chunk_size=1000)
+            self.assertEqual(projection.shape[0], 3000)
+            store.close()
+            self.assertFalse(os.path.exists(store.directory))
+
+
 if __name__ == '__main__':
     unittest.main()